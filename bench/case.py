@@ -0,0 +1,125 @@
+"""
+Runs one benchmark case in this process and writes its measurements as json, see Environment.run_case.
+
+usage: python -m bench.case case result.json [argument ...]
+
+The working directory has to contain config/global.ini. Wall time includes importing the modules needed by the case,
+not the interpreter startup. Subprocesses are those started by this process (the fake ssh starts further ones on the
+"proxmox node", see the commands counted by Environment.run_case).
+"""
+import configparser
+import contextlib
+import json
+import os
+import resource
+import runpy
+import sys
+import time
+import traceback
+
+_subprocesses = {}
+
+
+def _audit(event: str, args: tuple):
+    if event != 'subprocess.Popen':
+        return
+    argv = args[1] if isinstance(args[1], (list, tuple)) else [args[1]]
+    argv = [os.fsdecode(x) for x in argv]
+    # shell=True: ["/bin/sh", "-c", command]
+    if len(argv) > 2 and argv[1] == '-c':
+        argv = argv[2].split()
+    program = os.path.basename(argv[0]) if argv else ''
+    _subprocesses[program] = _subprocesses.get(program, 0) + 1
+
+
+def _get_servers(config: configparser.ConfigParser):
+    return config['global']['proxmox_servers'].replace(' ', '').split(',')
+
+
+def backup_run(config: configparser.ConfigParser, prefix: str):
+    """like "main.py backup run", with snapshot_name_prefix prefix"""
+    from lib.backup import Backup
+    from lib.helper import unique_list
+    backup = Backup(_get_servers(config), config)
+    backup.init_proxmox()
+    backup.set_snapshot_name_prefix(prefix)
+    backup.run_backup(unique_list(backup.get_vms_proxmox()))
+
+
+def get_vms(config: configparser.ConfigParser):
+    from lib.backup import Backup
+    Backup(_get_servers(config), config).get_vms()
+
+
+def remove_restore_point(config: configparser.ConfigParser, match: str):
+    """removes the restore points of all vm's whose name matches"""
+    from lib.restore_point import RestorePoint
+    RestorePoint(_get_servers(config), config).remove_restore_point(match=match)
+
+
+def restore_run(config: configparser.ConfigParser, vm_uuid: str):
+    """restores the latest restore point of a (stopped) vm"""
+    from lib.restore import Restore
+    from lib.restore_point import RestorePoint
+    restore_point = RestorePoint(_get_servers(config), config).get_restore_points(vm_uuid)[-1]['name']
+    Restore(_get_servers(config), config).run(vm_uuid, restore_point)
+
+
+def restore_instant(config: configparser.ConfigParser, vm_uuid: str):
+    """instant restore of the latest restore point of a (stopped) vm, completed right away"""
+    from lib.restore import Restore
+    from lib.restore_point import RestorePoint
+    restore_point = RestorePoint(_get_servers(config), config).get_restore_points(vm_uuid)[-1]['name']
+    restore = Restore(_get_servers(config), config)
+    restore.run_instant(vm_uuid, restore_point)
+    restore.complete_instant_restore(vm_uuid)
+
+
+def main_py(config: configparser.ConfigParser, *argv: str):
+    """main.py with the given arguments, its output is discarded"""
+    sys.argv = ['main.py'] + list(argv)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            runpy.run_path(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py'), run_name='__main__')
+        except SystemExit as exit:
+            if exit.code:
+                raise RuntimeError(f'main.py {" ".join(argv)} exited with code {exit.code}')
+
+
+CASES = {
+    'backup_run': backup_run,
+    'get_vms': get_vms,
+    'remove_restore_point': remove_restore_point,
+    'restore_run': restore_run,
+    'restore_instant': restore_instant,
+    'main': main_py
+}
+
+
+def main(case: str, result_path: str, *args: str):
+    config = configparser.ConfigParser()
+    config.read('config/global.ini')
+    from lib.helper import Log, map_loglevel
+    Log.set_loglevel(map_loglevel(config['global']['log_level']))
+    sys.addaudithook(_audit)
+    error = None
+    started = time.perf_counter()
+    try:
+        CASES[case](config, *args)
+    except Exception as exception:
+        error = f'{type(exception).__name__}: {exception}'
+        traceback.print_exc()
+    wall = time.perf_counter() - started
+    with open(result_path, 'w') as file:
+        json.dump({
+            'wall': wall,
+            'subprocesses': sum(_subprocesses.values()),
+            'subprocesses_by_program': _subprocesses,
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'error': error
+        }, file)
+    return 1 if error else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1], sys.argv[2], *sys.argv[3:]))
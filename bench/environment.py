@@ -0,0 +1,219 @@
+import configparser
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from lib.helper import parse_size
+from .fakes.calls import count_calls
+from .fakes.proxmox import FakeProxmox, FakeVm, POOL, create_server
+from .fakes.store import BLOCK_SIZE, RbdStore
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKUP_POOL = 'backup'
+
+# settings of config/global.example.ini which need a real cluster, or which would make runs incomparable
+CONFIG_OVERRIDES = {
+    'log_level': 'warn',
+    'log_file': '',
+    'user': 'root@pam',
+    'password': 'bench',
+    'verify_ssl': 'False',
+    'ssh_multiplexing': 'False',
+    'ignore_storages': '',
+    'ceph_backup_pool': BACKUP_POOL,
+    'ceph_backend': 'cli',
+    'vm_metadata_storage': 'raw',
+    'wait_for_snapshot_tries': '30',
+    # adaptive compression and the multi stream / resumable copies run python helpers using python3-rbd on the node
+    'transport_compression': 'lz4:1',
+    'initial_copy_streams': '1',
+    'initial_copy_resumable': 'False',
+    'transfer_bandwidth_limit': '0',
+    'metrics_textfile': '',
+    'metrics_port': '0'
+}
+
+_WRAPPER = '''#!{python} -S
+import sys
+sys.path.insert(0, {repository!r})
+from bench.fakes.{module} import main
+sys.exit(main({arguments}))
+'''
+
+
+class Environment:
+    """
+    A proxmox cluster with vms vm's (disks rbd images each) and a backup cluster, both faked within workdir:
+
+    - a fake proxmox https api (see FakeProxmox), in a thread of this process
+    - fake rbd, ssh, pv and lz4 executables in workdir/bin (see bench/fakes), the rbd images of the proxmox cluster are
+      in workdir/proxmox-cluster, those of the backup cluster in workdir/backup-cluster
+    - config/global.ini, from config/global.example.ini with CONFIG_OVERRIDES and the given overrides
+
+    Cases (see bench/case.py) run in a fresh python process each, with workdir as working directory.
+    """
+    workdir: str
+    store: RbdStore
+    proxmox: FakeProxmox
+    _vms: int
+    _disks: int
+    _disk_size: int
+    _disk_data: int
+    _overrides: {str: str}
+    _keep: bool
+    _server: object
+    _changes: int
+
+    def __init__(self, vms: int, disks: int = 1, nodes: int = 3, latency: float = 0.0, disk_size: str = '1G', disk_data: str = '256K',
+                 overrides: {str: str} = None, workdir: str = None, keep: bool = False):
+        """
+        :param latency: seconds each proxmox api request takes
+        :param disk_data: data written to each disk, in blocks spread over the disk
+        """
+        self.workdir = workdir if workdir else tempfile.mkdtemp(prefix=f'proxmox-rbd-backup-bench-{vms}-')
+        os.makedirs(self.workdir, exist_ok=True)
+        self.store = RbdStore(os.path.join(self.workdir, 'proxmox-cluster'))
+        self.proxmox = FakeProxmox(self.store, [f'pve{x + 1}' for x in range(max(1, nodes))], latency)
+        self._vms = vms
+        self._disks = disks
+        self._disk_size = parse_size(disk_size)
+        self._disk_data = parse_size(disk_data)
+        self._overrides = overrides if overrides else {}
+        self._keep = keep
+        self._server = None
+        self._changes = 0
+
+    def __enter__(self):
+        self.setup()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _create_certificate(self):
+        certificate, key = os.path.join(self.workdir, 'cert.pem'), os.path.join(self.workdir, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', certificate, '-days', '2', '-subj', '/CN=localhost'],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return certificate, key
+
+    def _create_executables(self):
+        directory = os.path.join(self.workdir, 'bin')
+        os.makedirs(directory, exist_ok=True)
+        for program, module, arguments in [('rbd', 'rbd', 'sys.argv[1:]'), ('ssh', 'ssh', 'sys.argv[1:]'),
+                                           ('pv', 'passthrough', '"pv", sys.argv[1:]'), ('lz4', 'passthrough', '"lz4", sys.argv[1:]')]:
+            path = os.path.join(directory, program)
+            with open(path, 'w') as file:
+                file.write(_WRAPPER.format(python=sys.executable, repository=REPOSITORY, module=module, arguments=arguments))
+            os.chmod(path, 0o755)
+
+    def _create_vms(self):
+        blocks = max(1, self._disk_data // BLOCK_SIZE)
+        for index in range(self._vms):
+            vm = FakeVm(100 + index, self.proxmox.nodes[index % len(self.proxmox.nodes)], self._disks, agent=index % 2 == 0)
+            for disk in vm.disks:
+                self.store.create_image(POOL, disk, self._disk_size)
+                with self.store.open_data(POOL, disk, mode='r+b') as file:
+                    for block in range(blocks):
+                        file.seek(block * (self._disk_size // blocks) // BLOCK_SIZE * BLOCK_SIZE)
+                        file.write(os.urandom(BLOCK_SIZE))
+            self.proxmox.add_vm(vm)
+
+    def _write_config(self):
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(os.path.join(REPOSITORY, 'config', 'global.example.ini'))
+        for section in [x for x in config.sections() if x != 'global']:
+            config.remove_section(section)
+        config['global']['proxmox_servers'] = f'127.0.0.1:{self._server.server_address[1]}'
+        config['global']['catalog_path'] = os.path.join(self.workdir, 'catalog.sqlite')
+        for key, value in list(CONFIG_OVERRIDES.items()) + list(self._overrides.items()):
+            config['global'][key] = value
+        os.makedirs(os.path.join(self.workdir, 'config'), exist_ok=True)
+        with open(os.path.join(self.workdir, 'config', 'global.ini'), 'w') as file:
+            config.write(file)
+
+    def setup(self):
+        certificate, key = self._create_certificate()
+        self._create_executables()
+        self._create_vms()
+        os.makedirs(os.path.join(self.workdir, 'backup-cluster', BACKUP_POOL), exist_ok=True)
+        self._server = create_server(self.proxmox, certificate, key)
+        threading.Thread(target=self._server.serve_forever, name='fake-proxmox', daemon=True).start()
+        self._write_config()
+
+    def close(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if not self._keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def get_vm_uuids(self) -> [str]:
+        return [x.uuid for x in self.proxmox.vms.values()]
+
+    def change_disks(self):
+        """overwrites one block of every disk of the proxmox cluster, so the next incremental backup has data to transfer"""
+        self._changes += 1
+        for vm in self.proxmox.vms.values():
+            for disk in vm.disks:
+                with self.store.open_data(POOL, disk, mode='r+b') as file:
+                    file.seek(self._changes * BLOCK_SIZE % self._disk_size)
+                    file.write(os.urandom(BLOCK_SIZE))
+
+    def stop_vm(self, uuid: str):
+        """a vm has to be stopped to restore it"""
+        for vm in self.proxmox.vms.values():
+            if vm.uuid == uuid:
+                vm.status = 'stopped'
+
+    def get_process_environment(self) -> {str: str}:
+        environment = dict(os.environ)
+        environment['PATH'] = os.path.join(self.workdir, 'bin') + os.pathsep + environment.get('PATH', '')
+        environment['PYTHONPATH'] = REPOSITORY + (os.pathsep + environment['PYTHONPATH'] if environment.get('PYTHONPATH') else '')
+        environment['BENCH_RBD_ROOT'] = os.path.join(self.workdir, 'backup-cluster')
+        environment['BENCH_RBD_REMOTE_ROOT'] = self.store.root
+        environment['BENCH_CALLS'] = os.path.join(self.workdir, 'calls.log')
+        return environment
+
+    def run_case(self, case: str, *args: str, timeout: float = None) -> dict:
+        """
+        Runs a case of bench/case.py in a fresh process.
+
+        :param timeout: seconds after which the case is killed and reported as failed
+
+        :return: {"wall": seconds, "subprocesses": n, "commands": n, "commands_by_program": {program: n},
+                  "api_requests": n, "peak_rss": bytes, "error": message or None}
+        """
+        result_path = os.path.join(self.workdir, 'result.json')
+        log_hint = f', see {self.workdir}/bench.log' if self._keep else ''
+        calls_path = self.get_process_environment()['BENCH_CALLS']
+        calls = count_calls(calls_path)
+        requests = self.proxmox.get_stats()['requests']
+        started = time.monotonic()
+        with open(os.path.join(self.workdir, 'bench.log'), 'a') as log:
+            log.write(f'\n### {case} {" ".join(args)}\n')
+            log.flush()
+            process = subprocess.Popen([sys.executable, '-m', 'bench.case', case, result_path] + list(args), cwd=self.workdir,
+                                       env=self.get_process_environment(), stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+            try:
+                code = process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                # the whole process group, including the fake executables it waits for
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                return {'wall': time.monotonic() - started, 'error': f'timed out after {timeout} seconds{log_hint}'}
+        if not os.path.exists(result_path):
+            return {'wall': time.monotonic() - started, 'error': f'case exited with code {code} without result{log_hint}'}
+        with open(result_path) as file:
+            result = json.load(file)
+        os.remove(result_path)
+        commands = dict([(key, value - calls.get(key, 0)) for key, value in count_calls(calls_path).items() if value - calls.get(key, 0) > 0])
+        result['commands'] = sum(commands.values())
+        result['commands_by_program'] = commands
+        result['api_requests'] = self.proxmox.get_stats()['requests'] - requests
+        return result
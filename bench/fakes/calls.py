@@ -0,0 +1,31 @@
+"""
+Invocation log of the fake executables: one line per call, appended to the file in $BENCH_CALLS.
+"""
+import os
+
+
+def record_call(program: str):
+    path = os.environ.get('BENCH_CALLS')
+    if not path:
+        return
+    # a single O_APPEND write per line, concurrent processes do not interleave
+    descriptor = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(descriptor, f'{program}\n'.encode('utf-8'))
+    finally:
+        os.close(descriptor)
+
+
+def count_calls(path: str) -> {str: int}:
+    """
+    :return: {program: number of calls}
+    """
+    counts = {}
+    if not os.path.exists(path):
+        return counts
+    with open(path) as file:
+        for line in file:
+            program = line.strip()
+            if program:
+                counts[program] = counts.get(program, 0) + 1
+    return counts
@@ -0,0 +1,21 @@
+"""
+Fake "pv" and "lz4": copy stdin to stdout, whatever the arguments, so the transfer pipelines keep their shape without
+the cpu cost of the real tools.
+"""
+import os
+import sys
+from .calls import record_call
+
+
+def main(program: str, argv: [str]) -> int:
+    record_call(program)
+    input, output = sys.stdin.fileno(), sys.stdout.fileno()
+    try:
+        while True:
+            data = os.read(input, 1024 * 1024)
+            if not data:
+                return 0
+            while data:
+                data = data[os.write(output, data):]
+    except BrokenPipeError:
+        return 141
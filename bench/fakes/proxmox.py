@@ -0,0 +1,296 @@
+"""
+Fake proxmox https api, serving the endpoints used by this project from in-memory vm's:
+
+    access/ticket, nodes, storage, cluster/resources, nodes/{node}/qemu (create), nodes/{node}/qemu/{id}/pending|config|
+    snapshot|feature|agent/info and nodes/{node}/tasks/{upid}/status
+
+Creating / removing a vm snapshot creates / removes the rbd snapshots of the vm disks in the RbdStore of the proxmox
+cluster right away, the returned task is finished when it is polled. Every request takes latency seconds and is counted
+(see get_stats).
+"""
+import json
+import re
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit, unquote
+from .store import RbdStore, StoreError
+
+STORAGE = 'ceph-vm'
+POOL = 'rbd'
+AGENT_COMMANDS = ['guest-exec', 'guest-fsfreeze-freeze', 'guest-fsfreeze-status', 'guest-fsfreeze-thaw', 'guest-fstrim', 'guest-info', 'guest-ping']
+
+
+def get_vm_uuid(vm_id: int) -> str:
+    return f'00000000-0000-4000-8000-{vm_id:012d}'
+
+
+def get_disk_name(vm_id: int, index: int) -> str:
+    return f'vm-{vm_id}-disk-{index}'
+
+
+class FakeVm:
+    id: int
+    node: str
+    name: str
+    uuid: str
+    status: str
+    agent: bool
+    disks: [str]
+    snapshots: [dict]
+    config: {str: str} or None
+
+    def __init__(self, vm_id: int, node: str, disks: int = 1, status: str = 'running', agent: bool = True):
+        self.id = vm_id
+        self.node = node
+        self.name = f'bench-{vm_id}'
+        self.uuid = get_vm_uuid(vm_id)
+        self.status = status
+        self.agent = agent
+        self.disks = [get_disk_name(vm_id, x) for x in range(disks)]
+        self.snapshots = []
+        # set by a config update, replaces the generated config
+        self.config = None
+
+    def set_config(self, config: {str: str}):
+        self.config = dict(config)
+        self.name = config.get('name', self.name)
+        self.agent = config.get('agent', '0') != '0'
+        for part in config.get('smbios1', '').split(','):
+            if part.startswith('uuid='):
+                self.uuid = part[len('uuid='):]
+        self.disks = [value.split(',')[0].split(':', 1)[1] for key, value in sorted(config.items())
+                      if re.match(r'^(scsi|sata|ide|virtio|efidisk)\d+$', key) and value.startswith(f'{STORAGE}:')]
+
+    def get_config(self):
+        if self.config is not None:
+            return dict(self.config)
+        config = {
+            'name': self.name,
+            'smbios1': f'uuid={self.uuid}',
+            'memory': '2048',
+            'cores': '2',
+            'ostype': 'l26',
+            'boot': 'order=scsi0',
+            'description': f'benchmark vm {self.id}'
+        }
+        if self.agent:
+            # proxmox leaves the key out, if the agent is disabled
+            config['agent'] = '1'
+        for index, disk in enumerate(self.disks):
+            config[f'scsi{index}'] = f'{STORAGE}:{disk},discard=on,size=1G'
+        return config
+
+
+class FakeProxmox:
+    """
+    State of the fake cluster, see create_server.
+    """
+    store: RbdStore
+    nodes: [str]
+    vms: {int: FakeVm}
+    latency: float
+    requests: int
+    requests_by_method: {str: int}
+    _lock: threading.RLock
+
+    def __init__(self, store: RbdStore, nodes: [str], latency: float = 0.0):
+        self.store = store
+        self.nodes = nodes
+        self.vms = {}
+        self.latency = latency
+        self.requests = 0
+        self.requests_by_method = {}
+        self._lock = threading.RLock()
+
+    def add_vm(self, vm: FakeVm):
+        self.vms[vm.id] = vm
+
+    def count(self, method: str):
+        with self._lock:
+            self.requests += 1
+            self.requests_by_method[method] = self.requests_by_method.get(method, 0) + 1
+
+    def get_stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'by_method': dict(self.requests_by_method)}
+
+    def _get_vm(self, node: str, vm_id: str) -> FakeVm:
+        vm = self.vms.get(int(vm_id))
+        if not vm or vm.node != node:
+            raise KeyError(f'vm {vm_id} does not exist on node {node}')
+        return vm
+
+    @staticmethod
+    def _task(node: str, task_type: str, vm_id: int):
+        return f'UPID:{node}:{threading.get_ident() % 0xffffffff:08X}:00000000:{int(time.time()):08X}:{task_type}:{vm_id}:root@pam:'
+
+    def create_snapshot(self, vm: FakeVm, name: str, description: str = ''):
+        with self._lock:
+            if name in [x['name'] for x in vm.snapshots]:
+                raise ValueError(f'snapshot name \'{name}\' already used')
+            parent = vm.snapshots[-1]['name'] if vm.snapshots else None
+            vm.snapshots.append({'name': name, 'description': description, 'snaptime': int(time.time()), 'vmstate': 0, 'parent': parent})
+        for disk in vm.disks:
+            self.store.create_snapshot(POOL, disk, name)
+        return self._task(vm.node, 'qmsnapshot', vm.id)
+
+    def remove_snapshot(self, vm: FakeVm, name: str, force: bool = False):
+        """
+        :param force: ignore disks without the snapshot
+        """
+        with self._lock:
+            snapshot = [x for x in vm.snapshots if x['name'] == name]
+            if not snapshot:
+                raise KeyError(f'snapshot \'{name}\' does not exist')
+            vm.snapshots.remove(snapshot[0])
+            for other in vm.snapshots:
+                if other['parent'] == name:
+                    other['parent'] = snapshot[0]['parent']
+        for disk in vm.disks:
+            try:
+                self.store.remove_snapshot(POOL, disk, name)
+            except StoreError:
+                if not force:
+                    raise
+        return self._task(vm.node, 'qmdelsnapshot', vm.id)
+
+    def create_vm(self, node: str, params: {str: str}):
+        with self._lock:
+            vm_id = int(params.pop('vmid'))
+            if node not in self.nodes:
+                raise KeyError(f'node {node} does not exist')
+            if vm_id in self.vms:
+                raise ValueError(f'vm {vm_id} already exists')
+            vm = FakeVm(vm_id, node, 0, status='stopped')
+            vm.set_config(params)
+            for disk in vm.disks:
+                if not self.store.is_image_existing(POOL, disk):
+                    raise ValueError(f'volume {STORAGE}:{disk} does not exist')
+            self.vms[vm_id] = vm
+        return self._task(node, 'qmcreate', vm_id)
+
+    def update_config(self, vm: FakeVm, params: {str: str}):
+        with self._lock:
+            config = vm.get_config()
+            for key in [x for x in params.pop('delete', '').split(',') if x]:
+                config.pop(key, None)
+            config.update(params)
+            vm.set_config(config)
+        return self._task(vm.node, 'qmconfig', vm.id)
+
+    def handle(self, method: str, path: str, params: {str: str}):
+        """
+        :return: the "data" of the response
+        :raises KeyError: for 404
+        """
+        if method == 'POST' and path == 'access/ticket':
+            return {'ticket': 'PVE:root@pam:00000000::bench', 'CSRFPreventionToken': '00000000:bench', 'username': params.get('username')}
+        if method == 'GET' and path == 'nodes':
+            return [{'node': x, 'status': 'online', 'type': 'node'} for x in self.nodes]
+        if method == 'GET' and path == 'storage':
+            return [{'storage': STORAGE, 'type': 'rbd', 'shared': 1, 'content': 'images,rootdir', 'pool': POOL, 'krbd': 0, 'digest': 'bench'}]
+        if method == 'GET' and path == 'cluster/resources':
+            return [{'type': 'qemu', 'id': f'qemu/{x.id}', 'vmid': x.id, 'node': x.node, 'name': x.name, 'status': x.status} for x in self.vms.values()]
+
+        match = re.match(r'^nodes/([^/]+)/tasks/([^/]+)/status$', path)
+        if match and method == 'GET':
+            return {'upid': match.group(2), 'node': match.group(1), 'status': 'stopped', 'exitstatus': 'OK'}
+
+        match = re.match(r'^nodes/([^/]+)/qemu$', path)
+        if match and method == 'POST':
+            return self.create_vm(match.group(1), params)
+
+        match = re.match(r'^nodes/([^/]+)/qemu/(\d+)/(.+)$', path)
+        if not match:
+            raise KeyError(path)
+        vm = self._get_vm(match.group(1), match.group(2))
+        resource = match.group(3)
+        if method == 'GET' and resource == 'pending':
+            return [{'key': key, 'value': value} for key, value in sorted(vm.get_config().items())] + [{'key': 'digest', 'value': 'bench'}]
+        if method == 'GET' and resource == 'config':
+            return dict(vm.get_config(), digest='bench')
+        if method == 'POST' and resource == 'config':
+            return self.update_config(vm, params)
+        if method == 'GET' and resource == 'feature':
+            return {'hasFeature': 1, 'nodes': self.nodes}
+        if method == 'GET' and resource == 'agent/info':
+            if not vm.agent or vm.status != 'running':
+                raise ValueError('QEMU guest agent is not running')
+            return {'result': {'version': '5.2.0', 'supported_commands': [{'name': x, 'enabled': True, 'success-response': True} for x in AGENT_COMMANDS]}}
+        if method == 'GET' and resource == 'snapshot':
+            with self._lock:
+                current = {'name': 'current', 'description': 'You are here!', 'running': 1 if vm.status == 'running' else 0}
+                if vm.snapshots:
+                    current['parent'] = vm.snapshots[-1]['name']
+                return [dict(x) for x in vm.snapshots] + [current]
+        if method == 'POST' and resource == 'snapshot':
+            return self.create_snapshot(vm, params['snapname'], params.get('description', ''))
+        match = re.match(r'^snapshot/([^/]+)$', resource)
+        if match and method == 'DELETE':
+            return self.remove_snapshot(vm, match.group(1), params.get('force') == '1')
+        raise KeyError(path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes, with nagle each keep-alive response waits for the delayed ack
+    disable_nagle_algorithm = True
+    proxmox: FakeProxmox
+
+    def _respond(self, status: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, method: str):
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+        params = dict([(key, values[-1]) for key, values in parse_qs(url.query).items()])
+        params.update(dict([(key, values[-1]) for key, values in parse_qs(body).items()]))
+        self.proxmox.count(method)
+        if self.proxmox.latency > 0:
+            time.sleep(self.proxmox.latency)
+        path = unquote(url.path)
+        if not path.startswith('/api2/json/'):
+            self._respond(404, {'data': None})
+            return
+        try:
+            self._respond(200, {'data': self.proxmox.handle(method, path[len('/api2/json/'):].strip('/'), params)})
+        except KeyError as error:
+            self._respond(404, {'data': None, 'message': str(error)})
+        except ValueError as error:
+            self._respond(500, {'data': None, 'message': str(error)})
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_server(proxmox: FakeProxmox, certificate: str, key: str, address: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    """
+    :return: the https server, not started yet (serve_forever), server_address holds the actual port
+    """
+    handler = type('Handler', (_Handler,), {'proxmox': proxmox})
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certificate, key)
+    # the tls handshake happens in the request thread, not in the accepting one
+    server.socket = context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+    return server
@@ -0,0 +1,397 @@
+"""
+Fake "rbd" command line tool on top of RbdStore ($BENCH_RBD_ROOT), implementing the subcommands and output formats
+used by this project: ls, info, du, status, snap, create, rm, resize, feature, object-map, image-meta, export,
+export-diff, import, import-diff (rbd diff v1 streams) and migration. "device map" is not supported, use
+vm_metadata_storage = raw.
+
+"migration prepare --import-only" reads native source specs from the store $BENCH_RBD_PEER_ROOT, the cluster name of
+the spec is not checked.
+"""
+import json
+import os
+import struct
+import sys
+from .calls import record_call
+from .store import BLOCK_SIZE, RbdStore, StoreError, iterate_blocks
+
+_OPTIONS_WITH_VALUE = ['-p', '--pool', '--format', '-s', '--size', '--image-feature', '--from-snap', '--snap', '-c', '--conf',
+                       '--id', '-n', '--name', '--cluster', '--keyring', '--export-format', '--import-format', '--object-size',
+                       '--source-spec']
+_SIZE_UNITS = {'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+class UsageError(Exception):
+    pass
+
+
+def parse_size(value: str) -> int:
+    """rbd sizes, a number without unit is in MiB"""
+    value = value.strip().upper()
+    if value[-1:] in _SIZE_UNITS:
+        return int(float(value[:-1]) * _SIZE_UNITS[value[-1]])
+    return int(value) * _SIZE_UNITS['M']
+
+
+class Arguments:
+    positional: [str]
+    options: {str: [str]}
+    flags: {str}
+
+    def __init__(self, argv: [str]):
+        self.positional = []
+        self.options = {}
+        self.flags = set()
+        index = 0
+        while index < len(argv):
+            arg = argv[index]
+            if arg in _OPTIONS_WITH_VALUE:
+                if index + 1 >= len(argv):
+                    raise UsageError(f'option {arg} requires a value')
+                self.options.setdefault(arg.lstrip('-'), []).append(argv[index + 1])
+                index += 2
+                continue
+            if arg.startswith('--') and '=' in arg:
+                key, _, value = arg.partition('=')
+                self.options.setdefault(key.lstrip('-'), []).append(value)
+            elif arg.startswith('-') and arg != '-':
+                self.flags.add(arg.lstrip('-'))
+            else:
+                self.positional.append(arg)
+            index += 1
+
+    def get(self, *names: str, default: str = None):
+        for name in names:
+            if name in self.options:
+                return self.options[name][-1]
+        return default
+
+    def pop(self, what: str) -> str:
+        if not self.positional:
+            raise UsageError(f'{what} was not specified')
+        return self.positional.pop(0)
+
+    def is_json(self):
+        return self.get('format') == 'json'
+
+
+def parse_spec(args: Arguments, spec: str) -> (str, str, str or None):
+    """
+    :return: (pool, image, snapshot) of "[pool/]image[@snapshot]"
+    """
+    pool = args.get('p', 'pool', default='rbd')
+    if '/' in spec:
+        pool, spec = spec.split('/', 1)
+    image, _, snapshot = spec.partition('@')
+    return pool, image, snapshot or None
+
+
+def _print_json(value):
+    sys.stdout.write(json.dumps(value) + '\n')
+
+
+def _list(store: RbdStore, args: Arguments):
+    pool = args.positional[0] if args.positional else args.get('p', 'pool', default='rbd')
+    images = store.list_images(pool)
+    if 'l' not in args.flags and 'long' not in args.flags:
+        _print_json(images) if args.is_json() else sys.stdout.write(''.join([f'{x}\n' for x in images]))
+        return
+    entries = []
+    for image in images:
+        try:
+            info = store.get_info(pool, image)
+        except StoreError:
+            continue
+        entries.append({'image': image, 'id': image, 'size': info['size'], 'format': 2})
+        for snapshot in info['snapshots']:
+            entries.append({'image': image, 'id': image, 'snapshot': snapshot['name'], 'snapshot_id': snapshot['id'], 'size': snapshot['size'],
+                            'format': 2, 'protected': 'true' if snapshot.get('protected') else 'false'})
+    _print_json(entries)
+
+
+def _info(store: RbdStore, args: Arguments):
+    pool, image, snapshot = parse_spec(args, args.pop('image'))
+    info = store.get_info(pool, image)
+    size, _ = store.get_extents(pool, image, snapshot)
+    _print_json({'name': image, 'id': image, 'size': size, 'objects': (size + 4194303) // 4194304, 'order': 22, 'object_size': 4194304,
+                  'snapshot_count': len(info['snapshots']), 'block_name_prefix': f'rbd_data.{image}', 'format': 2,
+                  'features': info['features'], 'op_features': [], 'flags': []})
+
+
+def _du(store: RbdStore, args: Arguments):
+    pool, image, _ = parse_spec(args, args.pop('image'))
+    info = store.get_info(pool, image)
+    images = [{'name': image, 'id': image, 'snapshot': x['name'], 'snapshot_id': x['id'], 'provisioned_size': x['size'],
+               'used_size': store.get_used(pool, image, x['name'])} for x in info['snapshots']]
+    images.append({'name': image, 'id': image, 'provisioned_size': info['size'], 'used_size': store.get_used(pool, image)})
+    _print_json({'images': images, 'total_provisioned_size': info['size'], 'total_used_size': sum([x['used_size'] for x in images])})
+
+
+def _snap(store: RbdStore, args: Arguments):
+    action = args.pop('snap command')
+    spec = args.pop('image or snapshot')
+    if action in ['ls', 'list']:
+        pool, image, _ = parse_spec(args, spec)
+        _print_json([{'id': x['id'], 'name': x['name'], 'size': x['size'], 'protected': 'true' if x.get('protected') else 'false', 'timestamp': x['timestamp']}
+                     for x in store.get_info(pool, image)['snapshots']])
+        return
+    if action == 'purge':
+        pool, image, _ = parse_spec(args, spec)
+        store.purge_snapshots(pool, image)
+        return
+    pool, image, snapshot = parse_spec(args, spec)
+    snapshot = snapshot if snapshot else args.get('snap')
+    if not snapshot:
+        raise UsageError('snapshot name was not specified')
+    if action in ['create', 'add']:
+        store.create_snapshot(pool, image, snapshot)
+    elif action in ['rm', 'remove']:
+        store.remove_snapshot(pool, image, snapshot)
+    elif action in ['protect', 'unprotect']:
+        store.set_snapshot_protected(pool, image, snapshot, action == 'protect')
+    else:
+        raise UsageError(f'unknown snap command: {action}')
+
+
+def _status(store: RbdStore, args: Arguments):
+    pool, image, _ = parse_spec(args, args.pop('image'))
+    info = store.get_info(pool, image)
+    status = {'watchers': []}
+    if 'migration' in info:
+        status['migration'] = dict(info['migration'], dest_pool_name=pool, dest_image_name=image, state_description='')
+    _print_json(status)
+
+
+def _migration(store: RbdStore, args: Arguments):
+    action = args.pop('migration command')
+    pool, image, _ = parse_spec(args, args.pop('image'))
+    if action == 'prepare':
+        if 'import-only' not in args.flags or not args.get('source-spec'):
+            raise UsageError('only "migration prepare --import-only --source-spec" is supported by the fake rbd')
+        spec = json.loads(args.get('source-spec'))
+        if spec.get('type') != 'native':
+            raise UsageError(f'source spec type {spec.get("type")} is not supported by the fake rbd')
+        store.prepare_migration_import(pool, image, RbdStore(os.environ['BENCH_RBD_PEER_ROOT']), spec['pool_name'], spec['image_name'], spec['snap_name'])
+    elif action == 'execute':
+        store.set_migration_state(pool, image, 'executed')
+    elif action == 'commit':
+        store.set_migration_state(pool, image, None)
+    elif action == 'abort':
+        store.abort_migration(pool, image)
+    else:
+        raise UsageError(f'unknown migration command: {action}')
+
+
+def _image_meta(store: RbdStore, args: Arguments):
+    action = args.pop('image-meta command')
+    pool, image, _ = parse_spec(args, args.pop('image'))
+    if action in ['list', 'ls']:
+        meta = store.get_info(pool, image)['meta']
+        if args.is_json():
+            _print_json(meta)
+        elif meta:
+            sys.stdout.write(f'There are {len(meta)} metadata on this image:\n\n' + ''.join([f'{key}  {value}\n' for key, value in meta.items()]))
+    elif action == 'get':
+        key = args.pop('key')
+        meta = store.get_info(pool, image)['meta']
+        if key not in meta:
+            raise StoreError(f'failed to get metadata {key} of image : (2) No such file or directory')
+        sys.stdout.write(meta[key] + '\n')
+    elif action == 'set':
+        key = args.pop('key')
+        store.set_meta(pool, image, key, args.pop('value'))
+    elif action in ['remove', 'rm']:
+        store.set_meta(pool, image, args.pop('key'), None)
+    else:
+        raise UsageError(f'unknown image-meta command: {action}')
+
+
+def _feature(store: RbdStore, args: Arguments):
+    action = args.pop('feature command')
+    pool, image, _ = parse_spec(args, args.pop('image'))
+    features = [y for x in args.positional for y in x.split(',') if y]
+    if action == 'enable':
+        store.update_features(pool, image, enable=features)
+    elif action == 'disable':
+        store.update_features(pool, image, disable=features)
+    else:
+        raise UsageError(f'unknown feature command: {action}')
+
+
+def _export(store: RbdStore, args: Arguments):
+    pool, image, snapshot = parse_spec(args, args.pop('image'))
+    path = args.positional[0] if args.positional else '-'
+    size, _ = store.get_extents(pool, image, snapshot)
+    output = sys.stdout.buffer if path == '-' else open(path, 'wb')
+    with store.open_data(pool, image, snapshot) as file:
+        remaining = size
+        while remaining > 0:
+            data = file.read(min(remaining, 1024 * 1024))
+            # the data file can be shorter than the image, the rest reads as zeros
+            data = data if data else bytes(min(remaining, 1024 * 1024))
+            output.write(data)
+            remaining -= len(data)
+    output.flush()
+
+
+def _export_diff(store: RbdStore, args: Arguments):
+    pool, image, snapshot = parse_spec(args, args.pop('image'))
+    from_snapshot = args.get('from-snap')
+    output = sys.stdout.buffer
+    size, extents = store.get_extents(pool, image, snapshot)
+    output.write(b'rbd diff v1\n')
+    for record, name in [(b'f', from_snapshot), (b't', snapshot)]:
+        if name:
+            output.write(record + struct.pack('<I', len(name.encode('utf-8'))) + name.encode('utf-8'))
+    output.write(b's' + struct.pack('<Q', size))
+    zeros = bytes(BLOCK_SIZE)
+    with store.open_data(pool, image, snapshot) as file:
+        if from_snapshot:
+            _, from_extents = store.get_extents(pool, image, from_snapshot)
+            with store.open_data(pool, image, from_snapshot) as from_file:
+                for offset in iterate_blocks(extents + from_extents):
+                    length = min(BLOCK_SIZE, size - offset)
+                    if length <= 0:
+                        continue
+                    file.seek(offset)
+                    from_file.seek(offset)
+                    data = file.read(length).ljust(length, b'\0')
+                    if data == from_file.read(length).ljust(length, b'\0'):
+                        continue
+                    if data == zeros[:length]:
+                        output.write(b'z' + struct.pack('<QQ', offset, length))
+                    else:
+                        output.write(b'w' + struct.pack('<QQ', offset, length) + data)
+        else:
+            for offset in iterate_blocks(extents):
+                length = min(BLOCK_SIZE, size - offset)
+                file.seek(offset)
+                data = file.read(length)
+                if data and data != zeros[:len(data)]:
+                    output.write(b'w' + struct.pack('<QQ', offset, len(data)) + data)
+    output.write(b'e')
+    output.flush()
+
+
+def _read_exact(input, length: int) -> bytes:
+    data = input.read(length)
+    if len(data) != length:
+        raise StoreError('unexpected end of the diff stream')
+    return data
+
+
+def _import_diff(store: RbdStore, args: Arguments):
+    path = args.pop('path')
+    pool, image, _ = parse_spec(args, args.pop('image'))
+    input = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    if _read_exact(input, 12) != b'rbd diff v1\n':
+        raise StoreError('invalid diff header')
+    info = store.get_info(pool, image)
+    end_snapshot = None
+    with store.locked(pool, image), store.open_data(pool, image, mode='r+b') as file:
+        while True:
+            record = _read_exact(input, 1)
+            if record == b'e':
+                break
+            if record in [b'f', b't']:
+                name = _read_exact(input, struct.unpack('<I', _read_exact(input, 4))[0]).decode('utf-8')
+                if record == b'f' and name not in [x['name'] for x in info['snapshots']]:
+                    raise StoreError(f'start snapshot \'{name}\' does not exist in the image, aborting')
+                end_snapshot = name if record == b't' else end_snapshot
+            elif record == b's':
+                size = struct.unpack('<Q', _read_exact(input, 8))[0]
+                if size != info['size']:
+                    info['size'] = size
+                    file.truncate(size)
+            elif record in [b'w', b'z']:
+                offset, length = struct.unpack('<QQ', _read_exact(input, 16))
+                file.seek(offset)
+                if record == b'w':
+                    file.write(_read_exact(input, length))
+                else:
+                    file.write(bytes(length))
+            else:
+                raise StoreError(f'invalid diff record: {record}')
+    if info['size'] != store.get_info(pool, image)['size']:
+        store.resize_image(pool, image, info['size'])
+    if end_snapshot:
+        store.create_snapshot(pool, image, end_snapshot)
+
+
+def _import(store: RbdStore, args: Arguments):
+    path = args.pop('path')
+    pool, image, _ = parse_spec(args, args.pop('image'))
+    input = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    store.create_image(pool, image, 0)
+    zeros = bytes(1024 * 1024)
+    size = 0
+    with store.locked(pool, image), store.open_data(pool, image, mode='r+b') as file:
+        while True:
+            data = input.read(1024 * 1024)
+            if not data:
+                break
+            if data != zeros[:len(data)]:
+                file.seek(size)
+                file.write(data)
+            size += len(data)
+    store.resize_image(pool, image, size)
+
+
+def run(store: RbdStore, args: Arguments):
+    command = args.pop('command')
+    if command in ['ls', 'list']:
+        _list(store, args)
+    elif command == 'info':
+        _info(store, args)
+    elif command == 'du':
+        _du(store, args)
+    elif command == 'status':
+        _status(store, args)
+    elif command == 'migration':
+        _migration(store, args)
+    elif command == 'snap':
+        _snap(store, args)
+    elif command == 'create':
+        pool, image, _ = parse_spec(args, args.pop('image'))
+        features = [y for x in args.options.get('image-feature', []) for y in x.split(',') if y]
+        store.create_image(pool, image, parse_size(args.get('s', 'size', default='0')), features if features else None)
+    elif command in ['rm', 'remove']:
+        pool, image, _ = parse_spec(args, args.pop('image'))
+        store.remove_image(pool, image)
+    elif command in ['rename', 'mv']:
+        pool, image, _ = parse_spec(args, args.pop('image'))
+        store.rename_image(pool, image, parse_spec(args, args.pop('destination'))[1])
+    elif command == 'resize':
+        pool, image, _ = parse_spec(args, args.pop('image'))
+        store.resize_image(pool, image, parse_size(args.get('s', 'size')))
+    elif command == 'feature':
+        _feature(store, args)
+    elif command == 'object-map':
+        args.pop('object-map command')
+        store.get_info(*parse_spec(args, args.pop('image'))[:2])
+    elif command == 'image-meta':
+        _image_meta(store, args)
+    elif command == 'export':
+        _export(store, args)
+    elif command == 'export-diff':
+        _export_diff(store, args)
+    elif command == 'import':
+        _import(store, args)
+    elif command == 'import-diff':
+        _import_diff(store, args)
+    else:
+        raise UsageError(f'{command} is not supported by the fake rbd')
+
+
+def main(argv: [str]) -> int:
+    record_call('rbd')
+    try:
+        run(RbdStore(os.environ['BENCH_RBD_ROOT']), Arguments(argv))
+    except UsageError as error:
+        print(f'rbd: {error}', file=sys.stderr)
+        return 1
+    except StoreError as error:
+        print(f'rbd: {error}', file=sys.stderr)
+        return 2
+    except BrokenPipeError:
+        return 141
+    return 0
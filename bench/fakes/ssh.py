@@ -0,0 +1,51 @@
+"""
+Fake "ssh": runs the remote command locally with bash, against the rbd store of the proxmox cluster
+($BENCH_RBD_REMOTE_ROOT instead of $BENCH_RBD_ROOT, which becomes the peer cluster of rbd migrations). Master connection control (-O, -N) succeeds without doing anything.
+"""
+import os
+import sys
+from .calls import record_call
+
+_OPTIONS_WITH_VALUE = 'BbcDEeFIiJLlmOopQRSWw'
+
+
+def parse(argv: [str]) -> ({str: str}, str or None, [str]):
+    """
+    :return: (options, destination, remote command), options may also follow the destination
+    """
+    options = {}
+    destination = None
+    index = 0
+    while index < len(argv):
+        arg = argv[index]
+        if not arg.startswith('-') or arg == '-':
+            if destination is not None:
+                break
+            destination = arg
+            index += 1
+            continue
+        flag = arg[1:2]
+        if flag in _OPTIONS_WITH_VALUE:
+            value = arg[2:] if len(arg) > 2 else (argv[index + 1] if index + 1 < len(argv) else '')
+            options[flag] = value
+            index += 1 if len(arg) > 2 else 2
+            continue
+        for flag in arg[1:]:
+            options[flag] = ''
+        index += 1
+    return options, destination, argv[index:]
+
+
+def main(argv: [str]) -> int:
+    record_call('ssh')
+    options, destination, command = parse(argv)
+    if 'O' in options or 'N' in options:
+        return 0
+    if destination is None or not command:
+        print('ssh: interactive sessions are not supported by the fake ssh', file=sys.stderr)
+        return 255
+    environment = dict(os.environ)
+    environment['BENCH_RBD_ROOT'] = os.environ['BENCH_RBD_REMOTE_ROOT']
+    environment['BENCH_RBD_PEER_ROOT'] = os.environ['BENCH_RBD_ROOT']
+    # like sshd, the remote shell gets the arguments joined with spaces
+    os.execvpe('bash', ['bash', '-c', ' '.join(command)], environment)
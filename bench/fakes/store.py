@@ -0,0 +1,306 @@
+"""
+File backed stand-in for the images of a ceph cluster, shared by the fake rbd executable and the fake proxmox api.
+
+Layout: root/pool/image/image.json (size, features, image-meta, snapshots), root/pool/image/head (data) and
+root/pool/image/snap-<id> (data of a snapshot). Data files are sparse, unallocated ranges read as zeros. Every change
+of an image holds an exclusive flock on root/pool/image.lock, so concurrent rbd processes behave.
+
+This module is executed by the fake executables with "python3 -S", it must only use the standard library.
+"""
+import errno
+import fcntl
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+BLOCK_SIZE = 64 * 1024
+TIMESTAMP_FORMAT = '%a %b %d %H:%M:%S %Y'
+
+
+class StoreError(Exception):
+    pass
+
+
+def get_extents(path: str, size: int) -> [(int, int)]:
+    """
+    :return: [(offset, length)] of the allocated ranges of a (sparse) file within [0, size)
+    """
+    if not os.path.exists(path):
+        return []
+    extents = []
+    with open(path, 'rb') as file:
+        descriptor = file.fileno()
+        end = min(size, os.fstat(descriptor).st_size)
+        offset = 0
+        while offset < end:
+            try:
+                start = os.lseek(descriptor, offset, os.SEEK_DATA)
+            except OSError as error:
+                if error.errno == errno.ENXIO:
+                    break
+                # no SEEK_DATA support, the whole file is allocated
+                return [(0, end)] if end > 0 else []
+            if start >= end:
+                break
+            stop = min(os.lseek(descriptor, start, os.SEEK_HOLE), end)
+            extents.append((start, stop - start))
+            offset = stop
+    return extents
+
+
+def copy_sparse(source: str, target: str):
+    """copies a file, keeping its holes"""
+    size = os.path.getsize(source) if os.path.exists(source) else 0
+    with open(target, 'wb') as output:
+        if size:
+            with open(source, 'rb') as input:
+                for offset, length in get_extents(source, size):
+                    input.seek(offset)
+                    output.seek(offset)
+                    output.write(input.read(length))
+        output.truncate(size)
+
+
+def iterate_blocks(extents: [(int, int)], block_size: int = BLOCK_SIZE):
+    """
+    :return: offsets of the blocks (block_size aligned) touching the extents, ascending
+    """
+    offsets = set()
+    for offset, length in extents:
+        for block in range(offset // block_size * block_size, offset + length, block_size):
+            offsets.add(block)
+    return sorted(offsets)
+
+
+class RbdStore:
+    root: str
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _get_image_path(self, pool: str, image: str):
+        return os.path.join(self.root, pool, image)
+
+    def _get_data_path(self, pool: str, image: str, snapshot: dict = None):
+        return os.path.join(self._get_image_path(pool, image), f'snap-{snapshot["id"]}' if snapshot else 'head')
+
+    @contextmanager
+    def _lock(self, pool: str, image: str):
+        os.makedirs(os.path.join(self.root, pool), exist_ok=True)
+        with open(os.path.join(self.root, pool, f'.{image}.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _read_info(self, pool: str, image: str) -> dict:
+        try:
+            with open(os.path.join(self._get_image_path(pool, image), 'image.json')) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            raise StoreError(f'image {pool}/{image} does not exist')
+
+    def _write_info(self, pool: str, image: str, info: dict):
+        path = os.path.join(self._get_image_path(pool, image), 'image.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(info, file)
+        os.replace(path + '.tmp', path)
+
+    def _get_snapshot(self, info: dict, pool: str, image: str, name: str):
+        for snapshot in info['snapshots']:
+            if snapshot['name'] == name:
+                return snapshot
+        raise StoreError(f'snapshot {pool}/{image}@{name} does not exist')
+
+    def list_pools(self):
+        return sorted([x for x in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, x))]) if os.path.isdir(self.root) else []
+
+    def list_images(self, pool: str) -> [str]:
+        path = os.path.join(self.root, pool)
+        if not os.path.isdir(path):
+            return []
+        return sorted([x for x in os.listdir(path) if os.path.exists(os.path.join(path, x, 'image.json'))])
+
+    def is_image_existing(self, pool: str, image: str):
+        return os.path.exists(os.path.join(self._get_image_path(pool, image), 'image.json'))
+
+    def get_info(self, pool: str, image: str) -> dict:
+        """
+        :return: {"size": bytes, "features": [...], "meta": {key: value}, "snapshots": [{"id", "name", "size", "timestamp", "protected"}],
+                  "created": unix time, "migration": {"source_pool_name", "source_image_name", "source_snap_name", "state"} while migrating}
+        """
+        return self._read_info(pool, image)
+
+    def create_image(self, pool: str, image: str, size: int, features: [str] = None):
+        with self._lock(pool, image):
+            if self.is_image_existing(pool, image):
+                raise StoreError(f'image {pool}/{image} already exists')
+            os.makedirs(self._get_image_path(pool, image), exist_ok=True)
+            with open(self._get_data_path(pool, image), 'wb') as file:
+                file.truncate(size)
+            self._write_info(pool, image, {
+                'size': size,
+                'features': features if features is not None else ['layering', 'exclusive-lock', 'object-map', 'fast-diff', 'deep-flatten'],
+                'meta': {},
+                'snapshots': [],
+                'next_snapshot_id': 1,
+                'created': time.time()
+            })
+
+    def remove_image(self, pool: str, image: str):
+        with self._lock(pool, image):
+            info = self._read_info(pool, image)
+            if info['snapshots']:
+                raise StoreError(f'image {pool}/{image} has snapshots')
+            shutil.rmtree(self._get_image_path(pool, image))
+
+    def rename_image(self, pool: str, image: str, new_name: str):
+        with self._lock(pool, image), self._lock(pool, new_name):
+            self._read_info(pool, image)
+            if self.is_image_existing(pool, new_name):
+                raise StoreError(f'image {pool}/{new_name} already exists')
+            os.rename(self._get_image_path(pool, image), self._get_image_path(pool, new_name))
+
+    def resize_image(self, pool: str, image: str, size: int):
+        with self._lock(pool, image):
+            info = self._read_info(pool, image)
+            info['size'] = size
+            with open(self._get_data_path(pool, image), 'r+b') as file:
+                file.truncate(size)
+            self._write_info(pool, image, info)
+
+    def update_features(self, pool: str, image: str, enable: [str] = None, disable: [str] = None):
+        with self._lock(pool, image):
+            info = self._read_info(pool, image)
+            features = [x for x in info['features'] if x not in (disable or [])]
+            info['features'] = features + [x for x in enable or [] if x not in features]
+            self._write_info(pool, image, info)
+
+    def create_snapshot(self, pool: str, image: str, name: str):
+        with self._lock(pool, image):
+            info = self._read_info(pool, image)
+            if name in [x['name'] for x in info['snapshots']]:
+                raise StoreError(f'snapshot {pool}/{image}@{name} already exists')
+            snapshot = {'id': info['next_snapshot_id'], 'name': name, 'size': info['size'], 'timestamp': time.strftime(TIMESTAMP_FORMAT), 'protected': False}
+            copy_sparse(self._get_data_path(pool, image), self._get_data_path(pool, image, snapshot))
+            info['snapshots'].append(snapshot)
+            info['next_snapshot_id'] += 1
+            self._write_info(pool, image, info)
+
+    def remove_snapshot(self, pool: str, image: str, name: str):
+        with self._lock(pool, image):
+            info = self._read_info(pool, image)
+            snapshot = self._get_snapshot(info, pool, image, name)
+            if snapshot.get('protected'):
+                raise StoreError(f'snapshot {pool}/{image}@{name} is protected')
+            info['snapshots'].remove(snapshot)
+            self._write_info(pool, image, info)
+            os.remove(self._get_data_path(pool, image, snapshot))
+
+    def purge_snapshots(self, pool: str, image: str):
+        with self._lock(pool, image):
+            info = self._read_info(pool, image)
+            if [x for x in info['snapshots'] if x.get('protected')]:
+                raise StoreError(f'image {pool}/{image} has protected snapshots')
+            for snapshot in info['snapshots']:
+                os.remove(self._get_data_path(pool, image, snapshot))
+            info['snapshots'] = []
+            self._write_info(pool, image, info)
+
+    def set_snapshot_protected(self, pool: str, image: str, name: str, protected: bool):
+        with self._lock(pool, image):
+            info = self._read_info(pool, image)
+            self._get_snapshot(info, pool, image, name)['protected'] = protected
+            self._write_info(pool, image, info)
+
+    def prepare_migration_import(self, pool: str, image: str, source: 'RbdStore', source_pool: str, source_image: str, source_snapshot: str):
+        """
+        Creates image with the data of a snapshot of another store, rbd copies it on "migration execute" instead. The
+        snapshots of the source image up to source_snapshot are imported, too.
+        """
+        source_info = source.get_info(source_pool, source_image)
+        snapshots = []
+        for snapshot in source_info['snapshots']:
+            snapshots.append(snapshot)
+            if snapshot['name'] == source_snapshot:
+                break
+        else:
+            raise StoreError(f'snapshot {source_pool}/{source_image}@{source_snapshot} does not exist')
+        self.create_image(pool, image, snapshots[-1]['size'])
+        with self._lock(pool, image):
+            info = self._read_info(pool, image)
+            for snapshot in snapshots:
+                snapshot = dict(snapshot, id=info['next_snapshot_id'], protected=False)
+                copy_sparse(source._get_data_path(source_pool, source_image, source._get_snapshot(source_info, source_pool, source_image, snapshot['name'])),
+                            self._get_data_path(pool, image, snapshot))
+                info['snapshots'].append(snapshot)
+                info['next_snapshot_id'] += 1
+            copy_sparse(self._get_data_path(pool, image, info['snapshots'][-1]), self._get_data_path(pool, image))
+            info['migration'] = {'source_pool_name': source_pool, 'source_image_name': source_image, 'source_snap_name': source_snapshot, 'state': 'prepared'}
+            self._write_info(pool, image, info)
+
+    def abort_migration(self, pool: str, image: str):
+        """removes the target image of a migration"""
+        with self._lock(pool, image):
+            info = self._read_info(pool, image)
+            if 'migration' not in info:
+                raise StoreError(f'image {pool}/{image} is not being migrated')
+            shutil.rmtree(self._get_image_path(pool, image))
+
+    def set_migration_state(self, pool: str, image: str, state: str or None):
+        """
+        :param state: "executed" once the data is copied, None commits the migration
+        """
+        with self._lock(pool, image):
+            info = self._read_info(pool, image)
+            if 'migration' not in info:
+                raise StoreError(f'image {pool}/{image} is not being migrated')
+            if state:
+                info['migration']['state'] = state
+            else:
+                del info['migration']
+            self._write_info(pool, image, info)
+
+    def set_meta(self, pool: str, image: str, key: str, value: str or None):
+        """
+        :param value: None removes the key
+        """
+        with self._lock(pool, image):
+            info = self._read_info(pool, image)
+            if value is None:
+                if key not in info['meta']:
+                    raise StoreError(f'image-meta {key} of {pool}/{image} does not exist')
+                del info['meta'][key]
+            else:
+                info['meta'][key] = value
+            self._write_info(pool, image, info)
+
+    def get_used(self, pool: str, image: str, snapshot: str = None) -> int:
+        info = self._read_info(pool, image)
+        path = self._get_data_path(pool, image, self._get_snapshot(info, pool, image, snapshot) if snapshot else None)
+        return sum([length for _, length in get_extents(path, info['size'])])
+
+    def get_extents(self, pool: str, image: str, snapshot: str = None) -> (int, [(int, int)]):
+        """
+        :return: (size, allocated extents) of the image or of one of its snapshots
+        """
+        info = self._read_info(pool, image)
+        if snapshot:
+            snap = self._get_snapshot(info, pool, image, snapshot)
+            return snap['size'], get_extents(self._get_data_path(pool, image, snap), snap['size'])
+        return info['size'], get_extents(self._get_data_path(pool, image), info['size'])
+
+    def open_data(self, pool: str, image: str, snapshot: str = None, mode: str = 'rb'):
+        info = self._read_info(pool, image)
+        return open(self._get_data_path(pool, image, self._get_snapshot(info, pool, image, snapshot) if snapshot else None), mode)
+
+    def write(self, pool: str, image: str, offset: int, data: bytes):
+        with self.open_data(pool, image, mode='r+b') as file:
+            file.seek(offset)
+            file.write(data)
+
+    @contextmanager
+    def locked(self, pool: str, image: str):
+        """holds the lock of an image, i.e. while applying a diff"""
+        with self._lock(pool, image):
+            yield
@@ -0,0 +1,128 @@
+"""
+Scale benchmark of the orchestration: backup runs, listing, restoring and removing restore points against a fake proxmox cluster
+and fake rbd / ssh / pv / lz4 executables (see bench/environment.py), without touching a real cluster.
+
+usage: python -m bench.run [--vms 10 100 1000] [--output results.json] [--compare baseline.json] ...
+"""
+import argparse
+import json
+import platform
+import sys
+from datetime import datetime
+from tabulate import tabulate
+from lib.helper import sizeof_fmt
+from .environment import Environment
+
+
+def get_cases(environment: Environment) -> [(str, [str])]:
+    """
+    :return: [(name, bench.case arguments)], in the order they run; later cases work on the restore points of earlier ones
+    """
+    uuid = environment.get_vm_uuids()[0]
+    return [
+        ('backup run (initial)', ['backup_run', 'bench_initial_']),
+        ('backup run (incremental)', ['backup_run', 'bench_']),
+        ('Backup.get_vms', ['get_vms']),
+        ('main.py backup list', ['main', 'backup', 'list']),
+        ('main.py restore-point list', ['main', 'restore-point', 'list', uuid]),
+        ('Restore.run (latest restore point)', ['restore_run', uuid]),
+        ('Restore.run_instant + complete_instant_restore', ['restore_instant', environment.get_vm_uuids()[-1]]),
+        ('RestorePoint.remove_restore_point', ['remove_restore_point', r'^bench_initial_'])
+    ]
+
+
+def run_scenario(vms: int, args) -> [dict]:
+    overrides = dict([x.split('=', 1) for x in args.set])
+    if args.engine:
+        overrides['transfer_engine'] = args.engine
+    if args.concurrency:
+        overrides['backup_concurrency'] = str(args.concurrency)
+    results = []
+    print(f'scenario: {vms} vm\'s', file=sys.stderr, flush=True)
+    with Environment(vms, disks=args.disks, nodes=args.nodes, latency=args.api_latency, disk_size=args.disk_size, disk_data=args.disk_data,
+                     overrides=overrides, keep=args.keep) as environment:
+        if args.keep:
+            print(f'  workdir: {environment.workdir}', file=sys.stderr, flush=True)
+        for name, case in get_cases(environment):
+            if case[0] == 'backup_run' and results:
+                environment.change_disks()
+            if case[0] in ['restore_run', 'restore_instant']:
+                environment.stop_vm(case[1])
+            result = environment.run_case(*case, timeout=args.timeout if args.timeout > 0 else None)
+            result.update({'scenario': vms, 'case': name})
+            results.append(result)
+            print(f'  {name}: {result["wall"]:.2f}s' + (f', failed: {result["error"]}' if result.get('error') else ''), file=sys.stderr, flush=True)
+    return results
+
+
+def _format_change(value, baseline):
+    if value is None or not baseline:
+        return ''
+    return f' ({(value - baseline) * 100 / baseline:+.0f}%)'
+
+
+def format_results(results: [dict], baseline: [dict] = None) -> str:
+    """
+    :param baseline: results of an earlier run, the change relative to it is added to each value
+    """
+    baseline = dict([((x['scenario'], x['case']), x) for x in baseline or []])
+    rows = []
+    for result in results:
+        base = baseline.get((result['scenario'], result['case']), {})
+        rows.append({
+            'VMs': result['scenario'],
+            'Case': result['case'],
+            'Wall': f'{result["wall"]:.2f}s' + _format_change(result['wall'], base.get('wall')),
+            'Subprocesses': f'{result.get("subprocesses", "")}' + _format_change(result.get('subprocesses'), base.get('subprocesses')),
+            'Commands': f'{result.get("commands", "")}' + _format_change(result.get('commands'), base.get('commands')),
+            'API requests': f'{result.get("api_requests", "")}' + _format_change(result.get('api_requests'), base.get('api_requests')),
+            'Peak RSS': (sizeof_fmt(result['peak_rss']) if result.get('peak_rss') else '') + _format_change(result.get('peak_rss'), base.get('peak_rss')),
+            'Error': result.get('error') or ''
+        })
+    if not any([x['Error'] for x in rows]):
+        for row in rows:
+            del row['Error']
+    return tabulate(rows, headers='keys', colalign=['right', 'left'] + ['right'] * 5 + (['left'] if rows and 'Error' in rows[0] else []))
+
+
+def main(argv: [str] = None):
+    parser = argparse.ArgumentParser(prog='python3 -m bench.run', description='Benchmark backup runs and restore point operations against a fake proxmox / ceph cluster')
+    parser.add_argument('--vms', type=int, nargs='+', default=[10, 100, 1000], help='scenarios by number of vm\'s, default: 10 100 1000')
+    parser.add_argument('--disks', type=int, default=1, help='disks per vm, default: 1')
+    parser.add_argument('--nodes', type=int, default=3, help='proxmox nodes, default: 3')
+    parser.add_argument('--disk-size', default='1G', help='size of each disk, default: 1G')
+    parser.add_argument('--disk-data', default='256K', help='data written to each disk, default: 256K')
+    parser.add_argument('--api-latency', type=float, default=0.005, help='seconds each proxmox api request takes, default: 0.005')
+    parser.add_argument('--engine', choices=['pipeline', 'shell'], help='override "transfer_engine"')
+    parser.add_argument('--concurrency', type=int, help='override "backup_concurrency"')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='override a setting of config/global.example.ini, repeatable')
+    parser.add_argument('--output', metavar='FILE', help='write the results as json, for --compare of a later run')
+    parser.add_argument('--compare', metavar='FILE', help='show the change relative to the results of an earlier run (--output)')
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds after which a case is killed and reported as failed, 0 = none, default: 3600')
+    parser.add_argument('--keep', action='store_true', help='keep the working directories (fake clusters, config, bench.log)')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+
+    started = datetime.now()
+    results = []
+    for vms in args.vms:
+        results += run_scenario(vms, args)
+
+    print(format_results(results, baseline))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'started': str(started),
+                'python': platform.python_version(),
+                'arguments': vars(args),
+                'results': results
+            }, file, indent=2)
+    return 1 if any([x.get('error') for x in results]) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,24 +1,37 @@
 import configparser
 import random
+import shlex
 import time
-import traceback
-from .ceph import Ceph, Image
+from .ceph import Ceph, Image, create_backend_from_config, get_command_timeout_from_config
 from .helper import *
 from .helper import Log as log
-from .proxmox import Proxmox, Disk, VM, Storage
-from .filesystem import mount_rbd_metadata_image, unmount_rbd_metadata_image
+from .proxmox import Proxmox, Disk, VM, Storage, VmFilter
+from .metadata import VmMetadata, get_metadata_image_name
+from .catalog import Catalog, get_catalog
+from . import metrics, tracing
+from .ssh import SshSessionPool, get_session_pool
+from .scheduler import Scheduler, JobError, JobResult, log_summary, JOB_FAILED, JOB_SKIPPED, JOB_SUCCEEDED
+from .transfer import run_transfer, TransferStats
+from .transfer.bandwidth import BandwidthGovernor, get_bandwidth_governor, parse_bandwidth_schedule
+from .transfer.chunked import ChunkedCopy, CHECKPOINT_SNAPSHOT_KEY, CHECKPOINT_CHUNK_SIZE_KEY
+from .transfer.compression import Codec, parse_codec, parse_codecs, read_sample, select_codec
+from .transfer.pipeline import ProgressLog
 
 
 class Backup:
     _config: configparser.ConfigParser
     _ceph: Ceph
     _servers: [str]
-    _remote_connection_command: str
+    _ssh: SshSessionPool
     _proxmox: Proxmox
     _storages_to_ignore: [str]
     _vms_to_ignore: [str]
+    _failed_vms: [(VM, Exception)]
     _snapshot_name_prefix: str
     _wait_for_snapshot_tries: int
+    _metadata: VmMetadata
+    _catalog: Catalog
+    _governor: BandwidthGovernor
 
     def __init__(self, servers: [str], config: configparser.ConfigParser):
         if is_list_empty(servers):
@@ -27,12 +40,16 @@ class Backup:
             raise ArgumentError('config must not be None')
         self._servers = servers
         self._config = config
-        self._ceph = Ceph()
+        self._ceph = Ceph(create_backend_from_config(config), get_command_timeout_from_config(config))
         self._proxmox = None
         self._backup_rbd_pool = self._config['global']['ceph_backup_pool']
-        self._remote_connection_command = f'ssh {config["global"]["proxmox_ssh_user"]}@{servers[0]} -T -o Compression=no -x'
+        self._metadata = VmMetadata(self._ceph, self._backup_rbd_pool, config)
+        self._ssh = get_session_pool(config)
+        self._catalog = get_catalog(config)
+        self._governor = get_bandwidth_governor(config)
         self._storages_to_ignore = []
         self._vms_to_ignore = []
+        self._failed_vms = []
         if 'ignore_storages' in config['global']:
             for item in config['global']['ignore_storages'].replace(' ', '').split(','):
                 self._storages_to_ignore.append(item)
@@ -42,13 +59,26 @@ class Backup:
         self._snapshot_name_prefix = ''
         self._wait_for_snapshot_tries = int(config['global']['wait_for_snapshot_tries'])
 
-    def init_proxmox(self):
+    def get_remote_connection_command(self):
+        return self._ssh.get_command(self._servers[0])
+
+    def init_proxmox(self, vm_filter: VmFilter = None):
+        """
+        :param vm_filter: only discover vm's matching this filter
+        """
         if self._proxmox:
             return
-        self._proxmox = Proxmox(self._servers, username=self._config['global']['user'], password=self._config['global']['password'], verify_ssl=self._config['global'].getboolean('verify_ssl'))
+        with tracing.span('discovery'):
+            self._init_proxmox(vm_filter)
+
+    def _init_proxmox(self, vm_filter: VmFilter = None):
+        self._proxmox = Proxmox(self._servers, username=self._config['global']['user'], password=self._config['global']['password'], verify_ssl=self._config['global'].getboolean('verify_ssl'),
+                                pool_size=max(10, self._config['global'].getint('backup_concurrency', fallback=1)), api_concurrency=self._config['global'].getint('proxmox_api_concurrency', fallback=8))
+        self._proxmox.set_vm_filter(vm_filter)
         self._proxmox.update_nodes()
         self._proxmox.update_storages(self._storages_to_ignore)
         self._proxmox.update_vms(self._vms_to_ignore)
+        self._failed_vms = self._proxmox.get_failed_vms()
 
     def set_snapshot_name_prefix(self, snapshot_name_prefix: str):
         self._snapshot_name_prefix = snapshot_name_prefix
@@ -70,86 +100,65 @@ class Backup:
     def remove_vm_snapshot(self, vm: VM, snapshot_name: str):
         try:
             self._proxmox.init_vm_config(vm)
-            self._proxmox.remove_vm_snapshot(vm, snapshot_name)
-            tries = self._wait_for_snapshot_tries
-            tries_attempted = tries
-            while tries > 0:
-                log.debug(f'wait for snapshot removal completion of {vm} -> {snapshot_name}. {tries} tries left of {tries_attempted}')
-                time.sleep(1)
-                tries -= 1
-                if not self._proxmox.is_snapshot_existing(vm, snapshot_name):
-                    log.debug('snapshot removal complete')
-                    break
+            self._proxmox.remove_vm_snapshot(vm, snapshot_name, wait=True, tries=self._wait_for_snapshot_tries)
         except Exception as error:
             log.error(f'{error}')
 
     def update_metadata(self, vm: VM, snapshot_name: str):
+        """
+        :return: the image-meta set on the metadata image
+        """
+        with metrics.METADATA_UPDATE.time():
+            return self._update_metadata(vm, snapshot_name)
+
+    def _update_metadata(self, vm: VM, snapshot_name: str):
         self._proxmox.init_vm_config(vm)
-        rbd_image_vm_metadata_name = vm.uuid + '_vm_metadata'
-        log.info(f'save current config into vm metadata image of vm {vm.uuid} (id={vm.id}, name={vm.name})')
-        is_vm_metadata_existing = self._ceph.is_rbd_image_existing(self._backup_rbd_pool, rbd_image_vm_metadata_name)
+        rbd_image_vm_metadata_name = get_metadata_image_name(vm.uuid)
+        self._metadata.write(vm)
+
+        vm_meta = {
+            'vm.id': str(vm.id),
+            'vm.uuid': str(vm.uuid),
+            'vm.name': str(vm.name),
+            'vm.running': str(vm.running),
+            'last_updated': str(datetime.now())
+        }
+        self._ceph.set_rbd_image_meta_batch(self._backup_rbd_pool, {rbd_image_vm_metadata_name: vm_meta})
+        self._ceph.create_rbd_snapshot(self._backup_rbd_pool, rbd_image_vm_metadata_name, new_snapshot_name=snapshot_name)
+        return vm_meta
 
-        # create or update vm metadata image
-        # in case of an error we try to unmount and unmap the vm metadata image
+    def _record_backup(self, vm: VM, snapshot_name: str, vm_meta: {str: str}):
+        images = [get_metadata_image_name(vm.uuid)] + [f'{vm.uuid}-{x.pool}-{x.name}' for x in map(rbd_image_from_proxmox_disk, vm.get_rbd_disks())]
+        snapshots = {}
+        for image in images:
+            snapshot = self._ceph.get_rbd_snapshot(self._backup_rbd_pool, image, snapshot_name)
+            snapshots[image] = snapshot if snapshot else {'name': snapshot_name}
+        # the backup itself succeeded, an outdated catalog can be fixed with "catalog resync"
         try:
-            if is_vm_metadata_existing:
-                # map vm metadata image
-                mapped_image_path = self._ceph.map_rbd_image(self._backup_rbd_pool, rbd_image_vm_metadata_name)
-                # mount vm metadata image
-                mount_rbd_metadata_image(rbd_image_vm_metadata_name, mapped_image_path)
-            else:
-                # create vm metadata image
-                log.info('metadata image for vm not existing; creating...')
-                self._ceph.create_rbd_image(self._backup_rbd_pool, rbd_image_vm_metadata_name, self._config['global']['vm_metadata_image_size'])
-                is_vm_metadata_existing = self._ceph.is_rbd_image_existing(self._backup_rbd_pool, rbd_image_vm_metadata_name)
-                if not is_vm_metadata_existing:
-                    raise RuntimeError(f'ceph metadata image for vm is not existing right after creation, this may be a transient error: {rbd_image_vm_metadata_name}')
-                if 'ceph_backup_disable_rbd_image_features_for_metadata' in self._config['global'] and len(self._config['global']['ceph_backup_disable_rbd_image_features_for_metadata']) > 0:
-                    # disable metadata image features (if needed)
-                    exec_raw(f'rbd feature disable {rbd_image_vm_metadata_name} {" ".join(self._config["global"]["ceph_backup_disable_rbd_image_features_for_metadata"].replace(" ", "").split(","))}')
-                # map metadata image
-                mapped_image_path = self._ceph.map_rbd_image(self._backup_rbd_pool, rbd_image_vm_metadata_name)
-                # format metadata image
-                exec_raw(f'/usr/sbin/mkfs.ext4 -L {rbd_image_vm_metadata_name[0:16]} {mapped_image_path}')
-                # mount metadata image
-                mount_rbd_metadata_image(rbd_image_vm_metadata_name, mapped_image_path)
-
-            # save current config into metadata image
-            log.debug(f'save current config into metadata image -> /tmp/{rbd_image_vm_metadata_name}/{vm.id}.conf')
-            with open(f'/tmp/{rbd_image_vm_metadata_name}/{vm.id}.conf', 'w') as config_file:
-                print(vm.get_config(), file=config_file)
-
-            unmount_rbd_metadata_image(rbd_image_vm_metadata_name)
-            self._ceph.unmap_rbd_image(self._backup_rbd_pool, rbd_image_vm_metadata_name)
-        except Exception as e:
-            # noinspection PyBroadException
-            try:
-                unmount_rbd_metadata_image(rbd_image_vm_metadata_name)
-            except Exception:
-                pass
-            # noinspection PyBroadException
-            try:
-                self._ceph.unmap_rbd_image(self._backup_rbd_pool, rbd_image_vm_metadata_name)
-            except Exception:
-                pass
-            raise e
-
-        self._ceph.set_rbd_image_meta(self._backup_rbd_pool, rbd_image_vm_metadata_name, 'vm.id', str(vm.id))
-        self._ceph.set_rbd_image_meta(self._backup_rbd_pool, rbd_image_vm_metadata_name, 'vm.uuid', str(vm.uuid))
-        self._ceph.set_rbd_image_meta(self._backup_rbd_pool, rbd_image_vm_metadata_name, 'vm.name', str(vm.name))
-        self._ceph.set_rbd_image_meta(self._backup_rbd_pool, rbd_image_vm_metadata_name, 'vm.running', str(vm.running))
-        self._ceph.set_rbd_image_meta(self._backup_rbd_pool, rbd_image_vm_metadata_name, 'last_updated', str(datetime.now()))
-        self._ceph.create_rbd_snapshot(self._backup_rbd_pool, rbd_image_vm_metadata_name, new_snapshot_name=snapshot_name)
+            self._catalog.record_backup(self._backup_rbd_pool, vm_meta, snapshots)
+        except Exception as error:
+            log.warn(f'could not record backup of {vm} in catalog: {error}')
 
-    def update_vm_ignore_disks(self, vm: VM):
-        self._proxmox.init_vm_config(vm)
+    def _record_transfer(self, vm: VM, image: str, snapshot_name: str, mode: str, started: float, stats: TransferStats = None, error: Exception = None):
+        stats = stats if stats else TransferStats()
+        try:
+            self._catalog.record_transfer(vm.uuid, image, snapshot_name, mode, 'failed' if error else 'succeeded', started, time.time(),
+                                          stats.received if stats.received is not None else stats.written, str(error) if error else None, stats.codec, stats.get_ratio())
+        except Exception as catalog_error:
+            log.warn(f'could not record transfer of {vm} -> {image} in catalog: {catalog_error}')
+
+    def _get_vm_disks_to_ignore(self, vm: VM) -> [str]:
         disks_to_ignore = []
         for section in self._config:
             if section == vm.uuid and 'ignore_disks' in self._config[section] and self._config[section]['ignore_disks']:
                 for disk in self._config[section]['ignore_disks'].replace(' ', '').split(','):
                     disk = disk.split('/')
                     disks_to_ignore.append(str(Disk(disk[1], Storage(disk[0]))))
-        vm.update_rbd_disks(self._proxmox.get_storages(), disks_to_ignore)
+        return disks_to_ignore
+
+    def update_vm_ignore_disks(self, vm: VM):
+        self._proxmox.init_vm_config(vm)
+        vm.update_rbd_disks(self._proxmox.get_storages(), self._get_vm_disks_to_ignore(vm))
 
     def get_vm_backup_snapshot(self, vm: VM, snapshot_name_prefix: str, allow_using_any_existing_snapshot: bool = False):
         snapshot_name_prefix = snapshot_name_prefix if snapshot_name_prefix else self.get_snapshot_name_prefix()
@@ -180,22 +189,19 @@ class Backup:
     def wait_for_rbd_image_snapshot_completion(self, vm: VM, image: Image, snapshot_name: str, snapshot_name_prefix: str = None):
         self._proxmox.init_vm_config(vm)
         snapshot_name_prefix = snapshot_name_prefix if snapshot_name_prefix else self.get_snapshot_name_prefix()
-        tries = self._wait_for_snapshot_tries
-        tries_attempted = tries
-        succeed = False
-        while not succeed and tries > 0:
-            log.debug(f'wait for snapshot creation completion of {vm} -> {image}@{snapshot_name}. {tries} tries left of {tries_attempted}')
-            time.sleep(1)
-            tries -= 1
-            results = self._ceph.get_rbd_snapshots_by_prefix(image.pool, image.name, snapshot_name_prefix, self._remote_connection_command)
-            for snap in results:
-                if 'name' in snap and snap['name'] == snapshot_name:
-                    log.debug(f'snapshot of {vm} -> {image}@{snapshot_name} found')
-                    succeed = True
-                    break
-        if not succeed:
-            raise RuntimeError(f'waiting for ceph rbd snapshot creation completion of {vm} -> {image} tined out after {tries_attempted} tries')
-        return succeed
+
+        def is_snapshot_existing():
+            log.debug(f'wait for snapshot creation completion of {vm} -> {image}@{snapshot_name}')
+            results = self._ceph.get_rbd_snapshots_by_prefix(image.pool, image.name, snapshot_name_prefix, self.get_remote_connection_command())
+            return snapshot_name in map(lambda x: x['name'], results)
+
+        # the proxmox snapshot task has already completed at this point, so the rbd snapshot is usually there right away
+        with metrics.SNAPSHOT_WAIT.time():
+            found = wait_for(is_snapshot_existing, self._wait_for_snapshot_tries)
+        if not found:
+            raise RuntimeError(f'waiting for ceph rbd snapshot creation completion of {vm} -> {image} tined out after {self._wait_for_snapshot_tries} seconds')
+        log.debug(f'snapshot of {vm} -> {image}@{snapshot_name} found')
+        return True
 
     def is_image_snapshot_existing(self, vm: VM, image: Image, snapshot_name: str, snapshot_name_prefix: str = None):
         self._proxmox.init_vm_config(vm)
@@ -217,77 +223,341 @@ class Backup:
     def backup_vm_disk(self, vm: VM,  disk: Disk, snapshot_name: str, is_backup_mode_incremental: bool, existing_backup_snapshot: str = None):
         self._proxmox.init_vm_config(vm)
         image = rbd_image_from_proxmox_disk(disk)
-        self.wait_for_rbd_image_snapshot_completion(vm, image, snapshot_name, self.get_snapshot_name_prefix())
-        compression_command_pack = ' | lz4 -z --fast=12 --sparse'
-        compression_command_unpack = '| lz4 -d'
-        pv_name_network = 'compressed-network'
+        with tracing.span('snapshot_wait', disk=str(image)):
+            self.wait_for_rbd_image_snapshot_completion(vm, image, snapshot_name, self.get_snapshot_name_prefix())
+        started = time.time()
+        mode = 'incremental' if is_backup_mode_incremental else 'initial'
+        try:
+            with tracing.span('transfer', disk=str(image), mode=mode):
+                stats = self._transfer_vm_disk(vm, image, snapshot_name, is_backup_mode_incremental, existing_backup_snapshot)
+        except Exception as error:
+            metrics.DISK_ERRORS.inc(vm_uuid=vm.uuid, disk=str(image))
+            self._record_transfer(vm, str(image), snapshot_name, mode, started, error=error)
+            raise
+        metrics.DISK_DURATION.set(time.time() - started, vm_uuid=vm.uuid, disk=str(image), mode=mode)
+        if stats.received is not None or stats.written is not None:
+            metrics.DISK_BYTES.inc(stats.received if stats.received is not None else stats.written, vm_uuid=vm.uuid, disk=str(image))
+        metrics.DISK_COMPRESSION_RATIO.set(stats.get_ratio() if stats.codec and stats.get_ratio() else 1.0, vm_uuid=vm.uuid, disk=str(image))
+        self._record_transfer(vm, str(image), snapshot_name, mode, started, stats)
+        with tracing.span('verify', disk=str(image)):
+            return self.is_image_snapshot_existing(vm, image, snapshot_name)
+
+    def _get_chunked_copy(self, vm: VM, image: Image, snapshot_name: str, image_size: int, streams: int, codec: Codec or None, chunk_size: int = None):
+        features = self._config['global'].get('initial_copy_image_features', 'exclusive-lock, object-map, fast-diff')
+        return ChunkedCopy(self._ceph, self.get_remote_connection_command(), image, snapshot_name, self._backup_rbd_pool, f'{vm.uuid}-{image.pool}-{image.name}', image_size,
+                           streams=streams,
+                           chunk_size=chunk_size if chunk_size else parse_size(self._config['global'].get('initial_copy_chunk_size', '4G')),
+                           codec=codec,
+                           features=[x for x in features.replace(' ', '').split(',') if x],
+                           engine=self._get_transfer_engine(),
+                           pipe_size=self._get_transfer_pipe_size(),
+                           governor=self._governor,
+                           resumable=self._config['global'].getboolean('initial_copy_resumable', fallback=False))
+
+    def _resume_initial_copy(self, vm: VM, image: Image) -> str or None:
+        """
+        Completes the resumable initial copy of a disk which failed in an earlier run, if its source snapshot still
+        exists. Otherwise the incomplete backup image is removed.
+
+        :return: the snapshot the backup image has been completed with, None if there was nothing to resume
+        """
+        name = f'{vm.uuid}-{image.pool}-{image.name}'
+        if not self._ceph.is_rbd_image_existing(self._backup_rbd_pool, name):
+            return None
+        meta = self._ceph.list_rbd_image_meta(self._backup_rbd_pool, name) or {}
+        snapshot_name = meta.get(CHECKPOINT_SNAPSHOT_KEY)
+        if not snapshot_name:
+            return None
+        if snapshot_name not in self._ceph.get_rbd_snapshot_names(image.pool, image.name, self.get_remote_connection_command()):
+            log.warn(f'source snapshot {image}@{snapshot_name} of the incomplete backup image {self._backup_rbd_pool}/{name} does not exist anymore, remove the image')
+            self._ceph.remove_rbd_image(self._backup_rbd_pool, name)
+            return None
+
+        started = time.time()
+        try:
+            codec, _ = self._get_transport_codec(vm, image, snapshot_name, False)
+            image_size = exec_parse_json(f'{self.get_remote_connection_command()} rbd info {image}@{snapshot_name} --format json')['size']
+            stats = self._get_chunked_copy(vm, image, snapshot_name, image_size, max(1, self._config['global'].getint('initial_copy_streams', fallback=1)), codec,
+                                           chunk_size=int(meta[CHECKPOINT_CHUNK_SIZE_KEY])).run()
+            self._ceph.create_rbd_snapshot(self._backup_rbd_pool, name, new_snapshot_name=snapshot_name)
+        except Exception as error:
+            self._record_transfer(vm, str(image), snapshot_name, 'resume', started, error=error)
+            raise
+        self._record_transfer(vm, str(image), snapshot_name, 'resume', started, stats)
+        log.info(f'initial backup of {vm} -> {image}@{snapshot_name} resumed and complete')
+        return snapshot_name
+
+    def _get_transfer_engine(self):
+        engine = self._config['global'].get('transfer_engine', 'shell')
+        if engine == 'shell' and self._governor.is_limited():
+            log.warn('transfer_bandwidth_limit is ignored by the shell transfer engine')
+        return engine
+
+    def set_bandwidth_limit(self, value: str):
+        """
+        Replaces the bandwidth limit of all transfers, including running ones.
+
+        :param value: see transfer_bandwidth_limit
+        """
+        self._governor.set_schedule(parse_bandwidth_schedule(value))
+        log.info(f'transfer bandwidth limit set to "{value}"')
+
+    def _get_transfer_pipe_size(self):
+        return parse_size(self._config['global'].get('transfer_pipe_size', '1M'))
+
+    def _run_transfer_pipeline(self, name: str, remote_command: str, codec: Codec or None, consumer: [str], size: int = None):
+        """
+        Runs remote_command on the proxmox node and feeds its output into consumer, see Pipeline.
+
+        :param remote_command: without compression, it is appended for codec
+        :param size: expected bytes passed to the consumer, for progress / eta
+        """
+        stages = [('export', shlex.split(self.get_remote_connection_command()) + [remote_command + (f' | {codec.get_compress_command()}' if codec else '')])]
+        if codec:
+            stages.append(('decompress', codec.get_decompress_argv()))
+        stages.append(('import', consumer))
+        pipeline = run_transfer(name, stages, 'pipeline', self._get_transfer_pipe_size(), ProgressLog(name, size), self._governor)
+        log.info(f'{name}: {pipeline.get_summary()}')
+        stats = TransferStats(str(codec) if codec else None)
+        stats.add(pipeline)
+        return stats
+
+    def _get_transport_codec(self, vm: VM, image: Image, snapshot_name: str, is_backup_mode_incremental: bool) -> (Codec or None, {str: str}):
+        """
+        With transport_compression = adaptive, a sample of the disk is compressed with each candidate codec and the
+        fastest one is chosen, see select_codec. The choice is remembered in the image-meta of the backup image and
+        reused until transport_compression_resample_age has passed.
+
+        :return: (codec, None for no compression; image-meta to set on the backup image after the transfer)
+        """
+        mode = 'incremental' if is_backup_mode_incremental else 'initial'
+        if self._config['global'][f'enable_transport_compression_{mode}'].lower() != 'true':
+            return None, {}
+        setting = self._config['global'].get('transport_compression', 'lz4:-12')
+        if setting.strip().lower() != 'adaptive':
+            return parse_codec(setting), {}
+
+        target = f'{vm.uuid}-{image.pool}-{image.name}'
+        if is_backup_mode_incremental:
+            meta = self._ceph.list_rbd_image_meta(self._backup_rbd_pool, target) or {}
+            sampled = meta.get('transport_compression_sampled')
+            if sampled and time.time() - float(sampled) < convert_to_seconds(self._config['global'].get('transport_compression_resample_age', '30d')):
+                log.debug(f'transport compression of {vm} -> {image}: {meta.get("transport_compression")} (remembered)')
+                return parse_codec(meta.get('transport_compression', 'none')), {}
+
+        timeout = get_command_timeout_from_config(self._config)
+        try:
+            sample = read_sample(self.get_remote_connection_command(), image.pool, image.name, snapshot_name,
+                                 parse_size(self._config['global'].get('transport_compression_sample_size', '64M')), timeout=timeout)
+            codec, results = select_codec(sample, parse_codecs(self._config['global'].get('transport_compression_candidates', 'lz4:-12, zstd:1, zstd:3')),
+                                          parse_size(self._config['global'].get('transport_bandwidth', '110M')), timeout=timeout)
+        except Exception as error:
+            log.warn(f'could not sample {vm} -> {image} for transport compression, using lz4:-12: {error}')
+            return parse_codec('lz4:-12'), {}
+        ratios = ', '.join([f'{name} {x["ratio"]:.2f}' for name, x in results.items()])
+        log.info(f'transport compression of {vm} -> {image}: {codec if codec else "none"} (ratio {ratios}; {sample.get_idle_cpus():.1f} idle cpus)')
+        return codec, {'transport_compression': str(codec) if codec else 'none', 'transport_compression_sampled': str(int(time.time()))}
+
+    def _transfer_vm_disk(self, vm: VM, image: Image, snapshot_name: str, is_backup_mode_incremental: bool, existing_backup_snapshot: str = None):
+        """
+        :return: TransferStats
+        """
+        image_size = None
+        target = f'{self._backup_rbd_pool}/{vm.uuid}-{image.pool}-{image.name}'
+        if self._config['global'].getboolean('initial_copy_resumable', fallback=False):
+            resumed = self._resume_initial_copy(vm, image)
+            if resumed:
+                # continue with an incremental backup based on the completed copy
+                is_backup_mode_incremental, existing_backup_snapshot = True, resumed
+        if is_backup_mode_incremental and not self._ceph.is_rbd_image_existing(self._backup_rbd_pool, f'{vm.uuid}-{image.pool}-{image.name}'):
+            log.warn(f'backup image of {vm} -> {image} does not exist, starting with a full copy')
+            is_backup_mode_incremental = False
+        codec, codec_meta = self._get_transport_codec(vm, image, snapshot_name, is_backup_mode_incremental)
+        stats = TransferStats(str(codec) if codec else None)
+        compression_command_pack = f' | {codec.get_compress_command()}' if codec else ''
+        compression_command_unpack = f'| {" ".join(codec.get_decompress_argv())}' if codec else ''
+        pv_name_network = 'compressed-network' if codec else 'network'
 
         if is_backup_mode_incremental:
-            if self._config['global']['enable_transport_compression_incremental'].lower() != 'true':
-                compression_command_pack = ''
-                compression_command_unpack = ''
-                pv_name_network = 'network'
             log.info(f'incremental backup, starting for {vm} -> {image}')
-            exec_raw(f'/bin/bash -c set -o pipefail; {self._remote_connection_command} "rbd export-diff --no-progress --from-snap {existing_backup_snapshot} {image}@{snapshot_name} -{compression_command_pack}" | pv --rate --bytes --timer -c -N {pv_name_network} {compression_command_unpack} | pv --rate --bytes --timer -c -N import-diff | rbd import-diff --no-progress - {self._backup_rbd_pool}/{vm.uuid}-{image.pool}-{image.name}')
+            if self._get_transfer_engine() == 'pipeline':
+                stats = self._run_transfer_pipeline(f'incremental backup of {vm} -> {image}',
+                                                    f'rbd export-diff --no-progress --from-snap {existing_backup_snapshot} {image}@{snapshot_name} -',
+                                                    codec, ['rbd', 'import-diff', '--no-progress', '-', target])
+            else:
+                exec_raw(f'/bin/bash -c set -o pipefail; {self.get_remote_connection_command()} "rbd export-diff --no-progress --from-snap {existing_backup_snapshot} {image}@{snapshot_name} -{compression_command_pack}" | pv --rate --bytes --timer -c -N {pv_name_network} {compression_command_unpack} | pv --rate --bytes --timer -c -N import-diff | rbd import-diff --no-progress - {self._backup_rbd_pool}/{vm.uuid}-{image.pool}-{image.name}', inherit_stderr=True)
+            self._ceph.invalidate_rbd_inventory(self._backup_rbd_pool, f'{vm.uuid}-{image.pool}-{image.name}')
             log.info(f'incremental backup of {vm} -> {image} complete')
         else:
-            if self._config['global']['enable_transport_compression_initial'].lower() != 'true':
-                compression_command_pack = ''
-                compression_command_unpack = ''
-                pv_name_network = 'network'
             log.info(f'initial backup, starting full copy of {vm} -> {image}')
-            image_size = exec_parse_json(f'{self._remote_connection_command} rbd info {image} --format json')['size']
-            exec_raw(f'/bin/bash -c set -o pipefail; {self._remote_connection_command} "rbd export --no-progress {image}@{snapshot_name} -{compression_command_pack}" | pv --rate --bytes --timer -c -N {pv_name_network} {compression_command_unpack} | pv --rate --bytes --progress --timer --eta --size {image_size} -c -N import | rbd import --no-progress - {self._backup_rbd_pool}/{vm.uuid}-{image.pool}-{image.name}')
-            self._ceph.create_rbd_snapshot(self._backup_rbd_pool, f'{vm.uuid}-{image.pool}-{image.name}', new_snapshot_name=snapshot_name)
+            image_size = exec_parse_json(f'{self.get_remote_connection_command()} rbd info {image} --format json')['size']
+            streams = self._config['global'].getint('initial_copy_streams', fallback=1)
+            # import-diff creates the snapshot of the export-diff stream on the backup image
+            snapshot_created = False
+            if streams > 1 or self._config['global'].getboolean('initial_copy_resumable', fallback=False):
+                stats = self._get_chunked_copy(vm, image, snapshot_name, image_size, max(1, streams), codec).run()
+            elif self._config['global'].getboolean('initial_copy_sparse', fallback=False):
+                # export-diff without a start snapshot only reads the allocated extents of the image
+                self._ceph.create_rbd_image(self._backup_rbd_pool, f'{vm.uuid}-{image.pool}-{image.name}', f'{image_size}B')
+                try:
+                    if self._get_transfer_engine() == 'pipeline':
+                        stats = self._run_transfer_pipeline(f'initial backup of {vm} -> {image}', f'rbd export-diff --no-progress {image}@{snapshot_name} -',
+                                                            codec, ['rbd', 'import-diff', '--no-progress', '-', target])
+                    else:
+                        exec_raw(f'/bin/bash -c set -o pipefail; {self.get_remote_connection_command()} "rbd export-diff --no-progress {image}@{snapshot_name} -{compression_command_pack}" | pv --rate --bytes --timer -c -N {pv_name_network} {compression_command_unpack} | pv --rate --bytes --timer -c -N import-diff | rbd import-diff --no-progress - {self._backup_rbd_pool}/{vm.uuid}-{image.pool}-{image.name}', inherit_stderr=True)
+                except Exception:
+                    # an incomplete image would block the next (initial) backup of this disk
+                    log.warn(f'remove incomplete image {target}')
+                    self._ceph.remove_rbd_image(self._backup_rbd_pool, f'{vm.uuid}-{image.pool}-{image.name}')
+                    raise
+                snapshot_created = True
+            elif self._get_transfer_engine() == 'pipeline':
+                stats = self._run_transfer_pipeline(f'initial backup of {vm} -> {image}', f'rbd export --no-progress {image}@{snapshot_name} -',
+                                                    codec, ['rbd', 'import', '--no-progress', '-', target], image_size)
+            else:
+                stats.written = image_size
+                exec_raw(f'/bin/bash -c set -o pipefail; {self.get_remote_connection_command()} "rbd export --no-progress {image}@{snapshot_name} -{compression_command_pack}" | pv --rate --bytes --timer -c -N {pv_name_network} {compression_command_unpack} | pv --rate --bytes --progress --timer --eta --size {image_size} -c -N import | rbd import --no-progress - {self._backup_rbd_pool}/{vm.uuid}-{image.pool}-{image.name}', inherit_stderr=True)
+            self._ceph.invalidate_rbd_inventory(self._backup_rbd_pool, f'{vm.uuid}-{image.pool}-{image.name}')
+            if not snapshot_created:
+                self._ceph.create_rbd_snapshot(self._backup_rbd_pool, f'{vm.uuid}-{image.pool}-{image.name}', new_snapshot_name=snapshot_name)
             log.info(f'initial backup of {vm} -> {image} complete')
 
-        return self.is_image_snapshot_existing(vm, image, snapshot_name)
+        if codec_meta:
+            self._ceph.set_rbd_image_meta_batch(self._backup_rbd_pool, {f'{vm.uuid}-{image.pool}-{image.name}': codec_meta})
+        if stats.codec and stats.get_ratio():
+            log.info(f'transport compression of {vm} -> {image}: {stats.codec}, ratio {stats.get_ratio():.2f}')
+        return stats
+
+    def backup_vm(self, vm: VM, prefix: str, allow_using_any_existing_snapshot: bool = False):
+        """
+        :return: False if the backup of this vm was skipped
+        """
+        log.info(f'backup starting for {vm}')
+        snapshot_name = prefix + ''.join([random.choice('0123456789abcdef') for _ in range(16)])
+        with tracing.span('ignore_disks'):
+            self.update_vm_ignore_disks(vm)
+
+        with tracing.span('guest_agent_check'):
+            if not self._proxmox.is_feature_available('snapshot', vm):
+                log.warn(f'The snapshot feature is currently not available for {vm}.')
+                return False
+
+            if vm.running and vm.agent:
+                if not self._proxmox.is_guest_agent_running(vm):
+                    log.warn(f'Guest Agent Tools are not running, this is required if "QEMU Guest Agent" is set to "Enabled" in Proxmox')
+                    return False
+
+                if not self._proxmox.is_guest_agent_command_supported(vm, 'guest-fsfreeze-freeze'):
+                    log.warn(f'Guest Agent Tools do not support command "guest-fsfreeze-freeze", which is required if "QEMU Guest Agent" is set to "Enabled" in Proxmox')
+                    return False
+
+        with tracing.span('metadata_update'):
+            vm_meta = self.update_metadata(vm, snapshot_name)
+
+        existing_backup_snapshot_count, existing_backup_snapshot, existing_snapshot_matches_prefix = self.get_vm_backup_snapshot(vm, prefix, allow_using_any_existing_snapshot)
+        is_backup_mode_incremental = None
+        if existing_backup_snapshot_count == 0:
+            is_backup_mode_incremental = False
+        if existing_backup_snapshot_count >= 1:
+            is_backup_mode_incremental = True
+
+        with tracing.span('snapshot_create'):
+            self._proxmox.create_vm_snapshot(vm, snapshot_name, self._wait_for_snapshot_tries)
+
+        # the proxmox snapshot must only be removed, if every disk has been transferred successfully
+        disk_scheduler = Scheduler(self._config['global'].getint('backup_disk_concurrency', fallback=1))
+        def backup_disk(disk: Disk):
+            try:
+                return self.backup_vm_disk(vm, disk, snapshot_name, is_backup_mode_incremental, existing_backup_snapshot)
+            except Exception as error:
+                raise JobError(f'backup of {vm} -> {disk} failed: {error}') from error
+        results = disk_scheduler.run(vm.get_rbd_disks(), backup_disk, stop_on_error=True)
+        for result in results:
+            if result.status == JOB_FAILED:
+                # logged by the disk scheduler already
+                raise JobError(str(result.error), reported=True) from result.error
+        self._record_backup(vm, snapshot_name, vm_meta)
+        if is_backup_mode_incremental and existing_snapshot_matches_prefix:
+            with tracing.span('snapshot_remove'):
+                self._proxmox.remove_vm_snapshot(vm, existing_backup_snapshot)
+        log.info(f'backup of {vm} complete')
+        return True
+
+    def _get_vm_scheduling_groups(self, vm: VM):
+        """
+        Called for every vm before the first backup starts, so it only uses the config loaded by the discovery (for
+        every candidate, see Proxmox.update_vms). A vm whose pools can not be determined counts against the pool
+        "unknown", so it is limited per pool as well.
+        """
+        try:
+            if not vm.get_config():
+                raise RuntimeError('its config was not loaded by the discovery')
+            vm.update_rbd_disks(self._proxmox.get_storages(), self._get_vm_disks_to_ignore(vm))
+            pools = sorted(set(map(lambda x: x.storage.pool, vm.get_rbd_disks())))
+        except Exception as error:
+            log.warn(f'could not determine the ceph pools of {vm}, limit it as pool "unknown": {error}')
+            pools = ['unknown']
+        return {
+            'node': [str(vm.node)],
+            'pool': pools
+        }
+
+    def write_metrics(self):
+        """
+        Writes the metrics to metrics_textfile (for the node-exporter textfile collector), if set.
+        """
+        path = self._config['global'].get('metrics_textfile', '')
+        if not path:
+            return
+        try:
+            metrics.REGISTRY.write_textfile(path)
+        except Exception as error:
+            log.warn(f'could not write metrics to {path}: {error}')
+
+    def _backup_vm_measured(self, vm: VM, prefix: str, allow_using_any_existing_snapshot: bool = False):
+        started = time.time()
+        try:
+            with tracing.span('backup_vm', vm=str(vm)):
+                result = self.backup_vm(vm, prefix, allow_using_any_existing_snapshot)
+            if result is not False:
+                metrics.VM_LAST_SUCCESS.set_to_current_time(vm_uuid=vm.uuid, vm_name=vm.name)
+            return result
+        except Exception:
+            metrics.VM_ERRORS.inc(vm_uuid=vm.uuid, vm_name=vm.name)
+            raise
+        finally:
+            metrics.VM_DURATION.set(time.time() - started, vm_uuid=vm.uuid, vm_name=vm.name)
+            # after each vm, so a long run shows progress
+            self.write_metrics()
 
     def run_backup(self, vms: [VM] = None, snapshot_name_prefix: str = None, allow_using_any_existing_snapshot: bool = False):
+        started = time.time()
         tmp_vms = vms if not is_list_empty(vms) else self._proxmox.get_vms()
         prefix = snapshot_name_prefix if snapshot_name_prefix else self.get_snapshot_name_prefix()
         error_occurred = False
         most_recent_exception = None
 
-        for vm in tmp_vms:
-            try:
-                log.info(f'backup starting for {vm}')
-                snapshot_name = prefix + ''.join([random.choice('0123456789abcdef') for _ in range(16)])
-                self.update_vm_ignore_disks(vm)
-
-                if not self._proxmox.is_feature_available('snapshot', vm):
-                    log.warn(f'The snapshot feature is currently not available for {vm}.')
-                    continue
-
-                if vm.running and vm.agent:
-                    if not self._proxmox.is_guest_agent_running(vm):
-                        log.warn(f'Guest Agent Tools are not running, this is required if "QEMU Guest Agent" is set to "Enabled" in Proxmox')
-                        continue
-
-                    if not self._proxmox.is_guest_agent_command_supported(vm, 'guest-fsfreeze-freeze'):
-                        log.warn(f'Guest Agent Tools do not support command "guest-fsfreeze-freeze", which is required if "QEMU Guest Agent" is set to "Enabled" in Proxmox')
-                        continue
-
-                self.update_metadata(vm, snapshot_name)
-
-                existing_backup_snapshot_count, existing_backup_snapshot, existing_snapshot_matches_prefix = self.get_vm_backup_snapshot(vm, prefix, allow_using_any_existing_snapshot)
-                is_backup_mode_incremental = None
-                if existing_backup_snapshot_count == 0:
-                    is_backup_mode_incremental = False
-                if existing_backup_snapshot_count >= 1:
-                    is_backup_mode_incremental = True
-
-                self._proxmox.create_vm_snapshot(vm, snapshot_name, self._wait_for_snapshot_tries)
-
-                for disk in vm.get_rbd_disks():
-                    self.backup_vm_disk(vm, disk, snapshot_name, is_backup_mode_incremental, existing_backup_snapshot)
-                if is_backup_mode_incremental and existing_snapshot_matches_prefix:
-                    self._proxmox.remove_vm_snapshot(vm, existing_backup_snapshot)
-            except Exception as e:
+        scheduler = Scheduler(self._config['global'].getint('backup_concurrency', fallback=1), {
+            'node': self._config['global'].getint('backup_concurrency_per_node', fallback=0),
+            'pool': self._config['global'].getint('backup_concurrency_per_pool', fallback=0)
+        })
+        with tracing.span('run_backup', vms=len(tmp_vms)):
+            results = scheduler.run(tmp_vms, lambda vm: self._backup_vm_measured(vm, prefix, allow_using_any_existing_snapshot), self._get_vm_scheduling_groups)
+        # vm's the discovery could not get the config of are not backed up, they fail the run like a failed backup
+        for vm, error in self.get_failed_vms():
+            metrics.VM_ERRORS.inc(vm_uuid=vm.uuid, vm_name=vm.name)
+            results.append(JobResult(vm, JOB_FAILED, datetime.now(), datetime.now(), RuntimeError(f'could not get the config of {vm}: {error}')))
+        log_summary('backup', results)
+        metrics.RUN_DURATION.set(time.time() - started)
+        metrics.RUN_LAST_TIMESTAMP.set_to_current_time()
+        for status in [JOB_SUCCEEDED, JOB_SKIPPED, JOB_FAILED]:
+            metrics.RUN_VMS.set(len([x for x in results if x.status == status]), status=status)
+        self.write_metrics()
+
+        for result in results:
+            if result.status == JOB_FAILED:
                 error_occurred = True
-                most_recent_exception = e
-                log.error(f'unexpected exception (probably a bug): {e}')
-                log.error(traceback.format_exc())
+                most_recent_exception = result.error
 
         if error_occurred:
             log.error('one or more errors occurred, raising most recent exception')
@@ -305,26 +575,29 @@ class Backup:
             }
         ]
         """
-        tmp_vms = []
-        images = self._ceph.get_rbd_images(self._backup_rbd_pool)
-        for image in images:
-            if not re.match(r'^' + REGEX_GUID + '_vm_metadata$', image):
-                continue
-            image_metas = self._ceph.list_rbd_image_meta(self._backup_rbd_pool, image)
-            if not image_metas:
-                log.warn(f'backup image {self._backup_rbd_pool}/{image} does not have any metadata')
-                continue
-            tmp_vms.append(image_metas)
-        tmp_vms = sorted(tmp_vms, key=lambda x: x['vm.id'])
-        return tmp_vms
+        if not self._catalog.is_synced(self._backup_rbd_pool):
+            self._catalog.resync(self._ceph, self._backup_rbd_pool)
+        return self._catalog.get_vms(self._backup_rbd_pool)
+
+    def resync_catalog(self, full: bool = False):
+        return self._catalog.resync(self._ceph, self._backup_rbd_pool, full)
 
     def get_vms_proxmox(self, from_cache=True) -> [VM]:
+        """
+        :return: the vm's whose config could be loaded, see get_failed_vms for the others
+        """
         vms = self._proxmox.get_vms()
         if not from_cache or not vms or len(vms) == 0:
             self._proxmox.update_vms(self._vms_to_ignore)
-        for vm in self._proxmox.get_vms():
-            self._proxmox.init_vm_config(vm, from_cache=from_cache)
-        return self._proxmox.get_vms()
+        loaded, failed = self._proxmox.init_vm_configs(self._proxmox.get_vms(), from_cache=from_cache)
+        self._failed_vms = self._proxmox.get_failed_vms() + failed
+        return loaded
+
+    def get_failed_vms(self) -> [(VM, Exception)]:
+        """
+        :return: [(vm, error)] of the vm's the discovery (or the last get_vms_proxmox) could not get the config of
+        """
+        return self._failed_vms
 
     def get_vm(self, uuid: str, from_cache=True) -> VM or None:
         vms = self.get_vms_proxmox(from_cache)
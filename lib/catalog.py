@@ -0,0 +1,303 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from .helper import REGEX_GUID
+from .helper import Log as log
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+_SCHEMA_VERSION = 2
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS vms (
+    uuid TEXT PRIMARY KEY,
+    id TEXT,
+    name TEXT,
+    running TEXT,
+    last_updated TEXT
+);
+CREATE TABLE IF NOT EXISTS images (
+    pool TEXT NOT NULL,
+    name TEXT NOT NULL,
+    vm_uuid TEXT,
+    size INTEGER,
+    PRIMARY KEY (pool, name)
+);
+CREATE INDEX IF NOT EXISTS images_vm_uuid ON images (vm_uuid);
+CREATE TABLE IF NOT EXISTS snapshots (
+    pool TEXT NOT NULL,
+    image TEXT NOT NULL,
+    name TEXT NOT NULL,
+    snap_id INTEGER,
+    size INTEGER,
+    timestamp TEXT,
+    time REAL,
+    PRIMARY KEY (pool, image, name)
+);
+CREATE TABLE IF NOT EXISTS transfers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    vm_uuid TEXT NOT NULL,
+    image TEXT NOT NULL,
+    snapshot TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started REAL,
+    finished REAL,
+    bytes INTEGER,
+    error TEXT,
+    codec TEXT,
+    ratio REAL
+);
+CREATE INDEX IF NOT EXISTS transfers_vm_uuid ON transfers (vm_uuid);
+CREATE TABLE IF NOT EXISTS synced_pools (
+    pool TEXT PRIMARY KEY,
+    synced REAL
+);
+-- a restore point is a snapshot of the metadata image of a vm
+CREATE VIEW IF NOT EXISTS restore_points AS
+    SELECT pool, substr(image, 1, length(image) - length('_vm_metadata')) AS vm_uuid, name, timestamp, time
+    FROM snapshots WHERE image LIKE '%\\_vm\\_metadata' ESCAPE '\\';
+'''
+
+
+# statements upgrading a catalog created with an older schema version to the version
+_MIGRATIONS = {
+    2: ['ALTER TABLE transfers ADD COLUMN codec TEXT',
+        'ALTER TABLE transfers ADD COLUMN ratio REAL']
+}
+
+
+def parse_snapshot_time(timestamp: str):
+    """
+    :param timestamp: as reported by rbd, i.e. "Sat Feb 29 00:50:17 2020"
+    :return: unix time, None if it can not be parsed
+    """
+    if not timestamp:
+        return None
+    try:
+        return datetime.strptime(timestamp, '%a %b %d %H:%M:%S %Y').timestamp()
+    except ValueError:
+        return None
+
+
+def get_vm_uuid_of_image(image: str):
+    """
+    :return: the uuid of the vm a backup image belongs to, None for foreign images
+    """
+    match = re.match(r'^(' + REGEX_GUID + r')(-|_vm_metadata$)', image)
+    return match.group(1) if match else None
+
+
+class Catalog:
+    """
+    Local SQLite catalog of the backup pool: vm's, images, restore points (snapshots) and transfer statistics.
+
+    It is updated by backup runs and the remove commands, so the listing commands do not have to query the pool.
+    Changes made to the pool by other means are picked up by resync. All methods are thread safe.
+    """
+    path: str
+    _connection: sqlite3.Connection
+    _lock: threading.RLock
+
+    def __init__(self, path: str):
+        self.path = path
+        if path != ':memory:' and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.RLock()
+        # transactions are handled explicitly, see _transaction
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        if path != ':memory:':
+            self._connection.execute('PRAGMA journal_mode=WAL')
+        version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+        # a new catalog (version 0) gets the current schema right away
+        if version:
+            for upgrade in range(version + 1, _SCHEMA_VERSION + 1):
+                for statement in _MIGRATIONS.get(upgrade, []):
+                    self._connection.execute(statement)
+        self._connection.executescript(_SCHEMA)
+        self._connection.execute(f'PRAGMA user_version={_SCHEMA_VERSION}')
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            cursor = self._connection.cursor()
+            try:
+                cursor.execute('BEGIN')
+                yield cursor
+                cursor.execute('COMMIT')
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            finally:
+                cursor.close()
+
+    def _query(self, sql: str, parameters=()):
+        with self._lock:
+            return [dict(x) for x in self._connection.execute(sql, parameters).fetchall()]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def is_synced(self, pool: str):
+        return len(self._query('SELECT pool FROM synced_pools WHERE pool = ?', (pool,))) > 0
+
+    @staticmethod
+    def _put_vm(cursor, meta: {str: str}):
+        cursor.execute('INSERT OR REPLACE INTO vms (uuid, id, name, running, last_updated) VALUES (?, ?, ?, ?, ?)',
+                       (meta['vm.uuid'], meta.get('vm.id'), meta.get('vm.name'), meta.get('vm.running'), meta.get('last_updated')))
+
+    @staticmethod
+    def _put_image(cursor, pool: str, image: str, size: int = None):
+        cursor.execute('INSERT INTO images (pool, name, vm_uuid, size) VALUES (?, ?, ?, ?) '
+                       'ON CONFLICT (pool, name) DO UPDATE SET size = coalesce(excluded.size, images.size)',
+                       (pool, image, get_vm_uuid_of_image(image), size))
+
+    @staticmethod
+    def _put_snapshot(cursor, pool: str, image: str, snapshot: dict):
+        cursor.execute('INSERT OR REPLACE INTO snapshots (pool, image, name, snap_id, size, timestamp, time) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (pool, image, snapshot['name'], snapshot.get('id'), snapshot.get('size'), snapshot.get('timestamp'), parse_snapshot_time(snapshot.get('timestamp'))))
+
+    def record_backup(self, pool: str, vm_meta: {str: str}, snapshots: {str: dict}):
+        """
+        Records a completed backup of a vm in a single transaction.
+
+        :param vm_meta: image-meta of the metadata image of the vm ("vm.id", "vm.uuid", "vm.name", ...)
+        :param snapshots: {image: snapshot}, the created restore point of every image of the vm
+        """
+        with self._transaction() as cursor:
+            self._put_vm(cursor, vm_meta)
+            for image, snapshot in snapshots.items():
+                self._put_image(cursor, pool, image, snapshot.get('size'))
+                self._put_snapshot(cursor, pool, image, snapshot)
+
+    def record_transfer(self, vm_uuid: str, image: str, snapshot: str, mode: str, status: str, started: float, finished: float, size: int = None, error: str = None,
+                        codec: str = None, ratio: float = None):
+        """
+        :param mode: initial or incremental
+        :param status: succeeded or failed
+        :param size: transferred bytes, if known
+        :param codec: transport compression, i.e. zstd:3
+        :param ratio: compression ratio achieved, if known
+        """
+        with self._transaction() as cursor:
+            cursor.execute('INSERT INTO transfers (vm_uuid, image, snapshot, mode, status, started, finished, bytes, error, codec, ratio) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (vm_uuid, image, snapshot, mode, status, started, finished, size, error, codec, ratio))
+
+    def remove_snapshot(self, pool: str, image: str, snapshot: str):
+        with self._transaction() as cursor:
+            cursor.execute('DELETE FROM snapshots WHERE pool = ? AND image = ? AND name = ?', (pool, image, snapshot))
+
+    def remove_snapshots(self, pool: str, image: str):
+        with self._transaction() as cursor:
+            cursor.execute('DELETE FROM snapshots WHERE pool = ? AND image = ?', (pool, image))
+
+    def remove_image(self, pool: str, image: str):
+        with self._transaction() as cursor:
+            cursor.execute('DELETE FROM snapshots WHERE pool = ? AND image = ?', (pool, image))
+            cursor.execute('DELETE FROM images WHERE pool = ? AND name = ?', (pool, image))
+            vm_uuid = get_vm_uuid_of_image(image)
+            if vm_uuid and not cursor.execute('SELECT 1 FROM images WHERE vm_uuid = ? LIMIT 1', (vm_uuid,)).fetchone():
+                cursor.execute('DELETE FROM vms WHERE uuid = ?', (vm_uuid,))
+
+    def get_vms(self, pool: str):
+        """
+        :return: [{"vm.id": "100", "vm.name": "test", "vm.running": "True", "vm.uuid": "...", "last_updated": "..."}]
+        """
+        rows = self._query('SELECT vms.* FROM vms JOIN images ON images.pool = ? AND images.name = vms.uuid || \'_vm_metadata\' ORDER BY vms.id', (pool,))
+        return [{'vm.id': x['id'], 'vm.name': x['name'], 'vm.running': x['running'], 'vm.uuid': x['uuid'], 'last_updated': x['last_updated']} for x in rows]
+
+    def get_restore_points(self, pool: str, vm_uuid: str):
+        """
+        :return: [{"name": "restore_point_name", "timestamp": "Sat Feb 29 00:50:17 2020"}], oldest first
+        """
+        return self._query('SELECT name, timestamp FROM restore_points WHERE pool = ? AND vm_uuid = ? ORDER BY time, name', (pool, vm_uuid))
+
+    def get_restore_point(self, pool: str, vm_uuid: str, restore_point: str):
+        """
+        :return: {"name": "restore_point_name", "timestamp": "...", "images": [image, ...]}, None if not existing
+        """
+        points = self._query('SELECT name, timestamp FROM restore_points WHERE pool = ? AND vm_uuid = ? AND name = ?', (pool, vm_uuid, restore_point))
+        if not points:
+            return None
+        images = self._query('SELECT snapshots.image FROM snapshots JOIN images ON images.pool = snapshots.pool AND images.name = snapshots.image '
+                             'WHERE snapshots.pool = ? AND images.vm_uuid = ? AND snapshots.name = ? ORDER BY snapshots.image', (pool, vm_uuid, restore_point))
+        return dict(points[0], images=[x['image'] for x in images])
+
+    def get_snapshots(self, pool: str, vm_uuid: str = None):
+        """
+        :return: [{"vm_uuid": "...", "image": "image_name", "name": "snapshot_name", "timestamp": "...", "time": unix_time}]
+        """
+        return self._query('SELECT images.vm_uuid, snapshots.image, snapshots.name, snapshots.timestamp, snapshots.time FROM snapshots '
+                           'JOIN images ON images.pool = snapshots.pool AND images.name = snapshots.image '
+                           'WHERE snapshots.pool = ? AND (? IS NULL OR images.vm_uuid = ?) ORDER BY snapshots.image, snapshots.time', (pool, vm_uuid, vm_uuid))
+
+    def get_transfers(self, vm_uuid: str, limit: int = 100):
+        return self._query('SELECT * FROM transfers WHERE vm_uuid = ? ORDER BY id DESC LIMIT ?', (vm_uuid, limit))
+
+    def resync(self, ceph, pool: str, full: bool = False):
+        """
+        Brings the catalog in line with the pool. Only images whose snapshots changed since the last sync are read
+        in detail, unless full is set.
+
+        :param ceph: lib.ceph.Ceph
+        :return: {"added": n, "removed": n, "updated": n} images
+        """
+        log.info(f'resync catalog {self.path} with pool {pool}' + (' (full)' if full else ''))
+        inventory = ceph.get_rbd_inventory(pool)
+        inventory.reload()
+        images = [x for x in inventory.get_images() if get_vm_uuid_of_image(x)]
+
+        known = {}
+        if not full:
+            for row in self._query('SELECT image, name FROM snapshots WHERE pool = ?', (pool,)):
+                known.setdefault(row['image'], set()).add(row['name'])
+            for row in self._query('SELECT name FROM images WHERE pool = ?', (pool,)):
+                known.setdefault(row['name'], set())
+
+        stats = {'added': 0, 'removed': 0, 'updated': 0}
+        changed = [x for x in images if x not in known or set(inventory.get_snapshot_names(x)) != known[x]]
+        snapshots = {x: inventory.get_snapshots(x) for x in changed}
+        changed_metadata_images = [x for x in changed if x.endswith('_vm_metadata')]
+        metas = ceph.list_rbd_image_meta_batch(pool, changed_metadata_images)
+
+        with self._transaction() as cursor:
+            if full:
+                # vm's left without images are removed below
+                cursor.execute('DELETE FROM snapshots WHERE pool = ?', (pool,))
+                cursor.execute('DELETE FROM images WHERE pool = ?', (pool,))
+            for image in set(known.keys()) - set(images):
+                cursor.execute('DELETE FROM snapshots WHERE pool = ? AND image = ?', (pool, image))
+                cursor.execute('DELETE FROM images WHERE pool = ? AND name = ?', (pool, image))
+                stats['removed'] += 1
+            for image in changed:
+                stats['updated' if image in known else 'added'] += 1
+                cursor.execute('DELETE FROM snapshots WHERE pool = ? AND image = ?', (pool, image))
+                self._put_image(cursor, pool, image, snapshots[image][-1].get('size') if snapshots[image] else None)
+                for snapshot in snapshots[image]:
+                    self._put_snapshot(cursor, pool, image, snapshot)
+            for image, meta in metas.items():
+                if meta and 'vm.uuid' in meta:
+                    self._put_vm(cursor, meta)
+                else:
+                    log.warn(f'backup image {pool}/{image} does not have any metadata')
+            cursor.execute('DELETE FROM vms WHERE uuid NOT IN (SELECT vm_uuid FROM images WHERE vm_uuid IS NOT NULL)')
+            cursor.execute('INSERT OR REPLACE INTO synced_pools (pool, synced) VALUES (?, ?)', (pool, time.time()))
+        log.info(f'catalog resync of pool {pool} complete: {stats["added"]} added, {stats["updated"]} updated, {stats["removed"]} removed images')
+        return stats
+
+
+def get_catalog(config) -> Catalog:
+    """
+    :return: the catalog shared by everything using the same config within this process
+    """
+    path = config['global'].get('catalog_path', '/var/lib/proxmox-rbd-backup/catalog.sqlite')
+    with _catalogs_lock:
+        if path not in _catalogs:
+            _catalogs[path] = Catalog(path)
+        return _catalogs[path]
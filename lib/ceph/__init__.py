@@ -1,9 +1,11 @@
 from ..helper import *
 from ..helper import Log as log
+from .cli import CliBackend, get_argv
+from .inventory import Inventory
 import re
+import threading
 import time
 import random
-import subprocess
 
 
 class Image:
@@ -15,14 +17,106 @@ class Image:
         return f'{self.pool}/{self.name}'
 
 
+def create_backend(name: str = 'cli', conffile: str = '/etc/ceph/ceph.conf', client_name: str = 'client.admin', command_timeout: float = None):
+    """
+    :param name: cli, native, memory or auto (native if the rados / rbd python modules are installed, otherwise cli)
+    :param command_timeout: seconds after which commands of the cli backend are killed
+    """
+    from . import native
+    if name == 'auto':
+        name = 'native' if native.is_available() else 'cli'
+    if name == 'cli':
+        return CliBackend(timeout=command_timeout)
+    if name == 'native':
+        return native.NativeBackend(conffile, client_name)
+    if name == 'memory':
+        from .memory import MemoryBackend
+        return MemoryBackend()
+    raise ArgumentError(f'unknown ceph backend: {name}')
+
+
+def create_backend_from_config(config):
+    return create_backend(config['global'].get('ceph_backend', 'cli'),
+                          config['global'].get('ceph_conffile', '/etc/ceph/ceph.conf'),
+                          config['global'].get('ceph_client_name', 'client.admin'),
+                          get_command_timeout_from_config(config))
+
+
+def get_command_timeout_from_config(config):
+    """
+    :return: "ceph_command_timeout" in seconds, None if it is not set or 0
+    """
+    return config['global'].getfloat('ceph_command_timeout', fallback=0) or None
+
+
 class Ceph:
-    def __init__(self):
-        return
+    """
+    rbd image and snapshot operations on top of a exchangeable backend (see create_backend).
+
+    Operations with a command_inject (remote cluster) are always executed using the rbd cli through that command.
+    Queries about local pools are answered from a per pool inventory (see get_rbd_inventory), which is kept up to
+    date by the mutating methods of this class. Changes made outside of it (i.e. rbd import) require a call to
+    invalidate_rbd_inventory.
+    """
+    _backend: object
+    _remote_backends: {str: CliBackend}
+    _inventories: {str: Inventory}
+    _inventory_lock: threading.Lock
+    _command_timeout: float or None
+
+    def __init__(self, backend=None, command_timeout: float = None):
+        """
+        :param command_timeout: seconds after which commands on the remote cluster (command_inject) and ceph commands
+                                are killed
+        """
+        self._backend = backend if backend else CliBackend(timeout=command_timeout)
+        self._command_timeout = command_timeout
+        self._remote_backends = {}
+        self._inventories = {}
+        self._inventory_lock = threading.Lock()
+
+    def _get_backend(self, command_inject: str = ''):
+        if not command_inject:
+            return self._backend
+        if command_inject not in self._remote_backends:
+            self._remote_backends[command_inject] = CliBackend(command_inject, timeout=self._command_timeout)
+        return self._remote_backends[command_inject]
+
+    def get_rbd_inventory(self, pool: str) -> Inventory:
+        with self._inventory_lock:
+            if pool not in self._inventories:
+                self._inventories[pool] = Inventory(pool, self._backend)
+            return self._inventories[pool]
+
+    def _get_cached_rbd_inventory(self, pool: str, command_inject: str = ''):
+        if command_inject:
+            return None
+        with self._inventory_lock:
+            return self._inventories.get(pool)
+
+    def invalidate_rbd_inventory(self, pool: str, image: str = None):
+        """
+        :param image: only re-read this image on next access, instead of the whole pool
+        """
+        with self._inventory_lock:
+            if pool not in self._inventories:
+                return
+            if image:
+                self._inventories[pool].invalidate(image)
+            else:
+                del self._inventories[pool]
 
     def get_rbd_images(self, pool: str, command_inject: str = ''):
-        return exec_parse_json(f'{command_inject + " " if command_inject else "" }rbd -p {pool} ls --format json')
+        if not command_inject:
+            return self.get_rbd_inventory(pool).get_images()
+        return self._get_backend(command_inject).list_images(pool)
+
+    def get_rbd_images_by_prefix(self, pool: str, prefix: str, command_inject: str = ''):
+        return [x for x in self.get_rbd_images(pool, command_inject) if x.startswith(prefix)]
 
     def is_rbd_image_existing(self, pool: str, image: str, command_inject: str = ''):
+        if not command_inject:
+            return self.get_rbd_inventory(pool).is_image_existing(image)
         return image in self.get_rbd_images(pool, command_inject)
 
     def get_rbd_snapshots(self, pool: str, image: str, command_inject: str = ''):
@@ -35,9 +129,16 @@ class Ceph:
             "timestamp": "Sat Feb 29 00:50:17 2020"
         }]
         """
+        if not command_inject:
+            return self.get_rbd_inventory(pool).get_snapshots(image)
         if not self.is_rbd_image_existing(pool, image, command_inject=command_inject):
             return []
-        return exec_parse_json(f'{command_inject + " " if command_inject else "" }rbd -p {pool} snap ls --format json {image}')
+        return self._get_backend(command_inject).list_snapshots(pool, image)
+
+    def get_rbd_snapshot_names(self, pool: str, image: str, command_inject: str = ''):
+        if not command_inject:
+            return self.get_rbd_inventory(pool).get_snapshot_names(image)
+        return [x['name'] for x in self.get_rbd_snapshots(pool, image, command_inject=command_inject)]
 
     def get_rbd_snapshot(self, pool: str, image: str, name: str, command_inject: str = ''):
         """
@@ -69,88 +170,208 @@ class Ceph:
             name = snapshot_prefix + ''.join([random.choice('0123456789abcdef') for _ in range(16)])
         else:
             name = new_snapshot_name
-        log.message('exec command "' + command_inject + 'rbd -p ' + pool + ' snap create ' + image + '@' + name + '"', LOGLEVEL_DEBUG)
-        if command_inject != '':
-            code = subprocess.call(command_inject.strip().split(' ') + ['rbd', '-p', pool, 'snap', 'create', image + '@' + name])
-        else:
-            code = subprocess.call(['rbd', '-p', pool, 'snap', 'create', image + '@' + name])
-        if code != 0:
-            raise RuntimeError('error creating ceph snapshot code: ' + str(code))
+        self._get_backend(command_inject).create_snapshot(pool, image, name)
+        if not command_inject:
+            self.invalidate_rbd_inventory(pool, image)
         log.message('ceph snapshot created ' + name, LOGLEVEL_DEBUG)
         return name
 
-    def create_rbd_image(self, pool: str, image: str, size: str = '1', command_inject: str = ''):
+    def create_rbd_image(self, pool: str, image: str, size: str = '1', command_inject: str = '', features: [str] = None):
         """
         :param size: size-in-M/G/T. Examples: 1, 100M, 20G, 4T
+        :param features: rbd image features, i.e. ['layering'], the cluster defaults if not set
         """
         log.message('creating ceph rbd image ' + command_inject + pool + '/' + image, LOGLEVEL_INFO)
-        exec_raw(f'{command_inject + " " if command_inject else "" }' + 'rbd create ' + pool + '/' + image + ' -s ' + size)
+        self._get_backend(command_inject).create_image(pool, image, size, features)
+        inventory = self._get_cached_rbd_inventory(pool, command_inject)
+        if inventory:
+            inventory.add_image(image)
 
     def remove_rbd_snapshot(self, pool: str, image: str, snapshot: str, command_inject: str = ''):
-        exec_raw(f'{command_inject + " " if command_inject else "" }' + 'rbd -p ' + pool + ' snap rm ' + image + '@' + snapshot)
+        self._get_backend(command_inject).remove_snapshot(pool, image, snapshot)
+        inventory = self._get_cached_rbd_inventory(pool, command_inject)
+        if inventory:
+            inventory.remove_snapshot(image, snapshot)
 
     def remove_rbd_snapshot_all(self, pool: str, image: str, command_inject: str = ''):
-        exec_raw(f'{command_inject + " " if command_inject else "" }' + 'rbd -p ' + pool + ' snap purge ' + pool + '/' + image)
+        self._get_backend(command_inject).purge_snapshots(pool, image)
+        inventory = self._get_cached_rbd_inventory(pool, command_inject)
+        if inventory:
+            inventory.remove_snapshots(image)
+
+    def protect_rbd_snapshot(self, pool: str, image: str, snapshot: str, command_inject: str = ''):
+        """protected snapshots can not be removed, until they are unprotected"""
+        log.message(f'protect ceph snapshot {command_inject}{pool}/{image}@{snapshot}', LOGLEVEL_DEBUG)
+        self._get_backend(command_inject).protect_snapshot(pool, image, snapshot)
+        if not command_inject:
+            self.invalidate_rbd_inventory(pool, image)
+
+    def unprotect_rbd_snapshot(self, pool: str, image: str, snapshot: str, command_inject: str = ''):
+        log.message(f'unprotect ceph snapshot {command_inject}{pool}/{image}@{snapshot}', LOGLEVEL_DEBUG)
+        self._get_backend(command_inject).unprotect_snapshot(pool, image, snapshot)
+        if not command_inject:
+            self.invalidate_rbd_inventory(pool, image)
+
+    def enable_rbd_image_features(self, pool: str, image: str, features: [str], command_inject: str = ''):
+        """
+        :param features: i.e. ['exclusive-lock', 'object-map', 'fast-diff'], the object map is rebuilt if enabled
+        """
+        log.message(f'enable features {", ".join(features)} of ceph rbd image {command_inject}{pool}/{image}', LOGLEVEL_DEBUG)
+        self._get_backend(command_inject).enable_image_features(pool, image, features)
 
     def get_rbd_image_info(self, pool: str, image: str, command_inject: str = ''):
-        return exec_parse_json(f'{command_inject + " " if command_inject else "" }' + 'rbd -p ' + pool + ' --format json info ' + image)
+        return self._get_backend(command_inject).get_image_info(pool, image)
+
+    def get_rbd_image_du(self, pool: str, image: str, command_inject: str = ''):
+        """
+        :return: {snapshot_name: used bytes}, None for the image head
+        """
+        return self._get_backend(command_inject).get_image_du(pool, image)
+
+    def read_rbd_image(self, pool: str, image: str, length: int, offset: int = 0, snapshot: str = None, command_inject: str = '') -> bytes:
+        """reads length bytes at offset of an image or of one of its snapshots, without mapping it"""
+        return self._get_backend(command_inject).read_image(pool, image, length, offset, snapshot)
+
+    def write_rbd_image(self, pool: str, image: str, data: bytes, offset: int = 0, command_inject: str = ''):
+        """writes data at offset into an image, without mapping it"""
+        self._get_backend(command_inject).write_image(pool, image, data, offset)
+
+    def _exec(self, command_inject: str, *args: str) -> str:
+        return exec_argv(get_argv(command_inject, *args), timeout=self._command_timeout)
 
     def set_scrubbing(self, enable: bool, command_inject: str = ''):
         action_name = 'enable' if enable else 'disable'
         action = 'set' if enable else 'unset'
         log.message(action_name + ' ceph scrubbing', LOGLEVEL_INFO)
-        exec_raw(f'{command_inject + " " if command_inject else "" }' + 'ceph osd ' + action + ' nodeep-scrub')
-        exec_raw(f'{command_inject + " " if command_inject else "" }' + 'ceph osd ' + action + ' noscrub')
+        self._exec(command_inject, 'ceph', 'osd', action, 'nodeep-scrub')
+        self._exec(command_inject, 'ceph', 'osd', action, 'noscrub')
 
     def wait_for_cluster_healthy(self, command_inject: str = ''):
         log.message('waiting for ceph cluster to become healthy', LOGLEVEL_INFO)
-        while exec_raw(f'{command_inject + " " if command_inject else "" }' + 'ceph health detail').startswith('HEALTH_ERR'):
+        while self._exec(command_inject, 'ceph', 'health', 'detail').startswith('HEALTH_ERR'):
             time.sleep(10)
             log.message('waiting for ceph cluster to become healthy', LOGLEVEL_DEBUG)
 
     def wait_for_scrubbing_completion(self, command_inject: str = ''):
         log.message('waiting for ceph cluster to complete scrubbing', LOGLEVEL_INFO)
         pattern = re.compile("scrubbing")
-        while pattern.search(exec_raw(f'{command_inject + " " if command_inject else "" }' + 'ceph status')):
+        while pattern.search(self._exec(command_inject, 'ceph', 'status')):
             time.sleep(10)
             log.message('waiting for ceph cluster to complete scrubbing', LOGLEVEL_DEBUG)
 
-    def map_rbd_image(self, pool: str, image: str, command_inject: str = ''):
-        log.message('mapping ceph image ' + pool + '/' + image, LOGLEVEL_DEBUG)
-        exec_raw(f'{command_inject + " " if command_inject else "" }' + 'rbd -p ' + pool + ' device map ' + image)
+    def map_rbd_image(self, pool: str, image: str, command_inject: str = '', snapshot: str = None):
+        """
+        :param snapshot: map this snapshot of the image (read-only) instead of the image itself
+        """
+        spec = f'{image}@{snapshot}' if snapshot else image
+        log.message('mapping ceph image ' + pool + '/' + spec, LOGLEVEL_DEBUG)
+        self._exec(command_inject, 'rbd', '-p', pool, 'device', 'map', *(['--read-only'] if snapshot else []), spec)
         mapped_path = ''
         mapped_images_info = self.get_rbd_image_mapped_info()
         for mapped_image in mapped_images_info:
-            if mapped_image['name'] == image:
+            if mapped_image['name'] == image and mapped_image.get('snap', '-') == (snapshot if snapshot else '-'):
                 mapped_path = mapped_image['device']
                 break
         if mapped_path == '':
-            raise RuntimeError(f'could not find mapped block-device of image {image}')
+            raise RuntimeError(f'could not find mapped block-device of image {spec}')
         del mapped_images_info
         return mapped_path
 
-    def unmap_rbd_image(self, pool: str, image: str, command_inject: str = ''):
-        log.message('unmapping ceph image ' + pool + '/' + image, LOGLEVEL_DEBUG)
-        return exec_raw(f'{command_inject + " " if command_inject else "" }' + 'rbd -p ' + pool + ' device unmap ' + image)
+    def unmap_rbd_image(self, pool: str, image: str, command_inject: str = '', snapshot: str = None):
+        spec = f'{image}@{snapshot}' if snapshot else image
+        log.message('unmapping ceph image ' + pool + '/' + spec, LOGLEVEL_DEBUG)
+        return self._exec(command_inject, 'rbd', '-p', pool, 'device', 'unmap', spec)
 
     def get_rbd_image_mapped_info(self, command_inject: str = ''):
         log.message('get info about mapped rbd images' + (' locally' if command_inject == '' else ' on remote: ' + command_inject.split('@')[1]), LOGLEVEL_DEBUG)
-        return exec_parse_json(f'{command_inject + " " if command_inject else "" }' + 'rbd device list --format json')
+        return exec_argv_json(get_argv(command_inject, 'rbd', 'device', 'list', '--format', 'json'), timeout=self._command_timeout)
 
     def list_rbd_image_meta(self, pool: str, image: str, command_inject: str = ''):
-        result = exec_raw(f'{command_inject + " " if command_inject else "" }rbd image-meta list {pool}/{image} --format json')
-        if result and len(result) > 2:
-            return parse_json(result)
+        result = self._get_backend(command_inject).list_image_meta(pool, image)
+        if result:
+            return result
         return None
 
     def get_rbd_image_meta(self, pool: str, image: str, key: str, command_inject: str = ''):
-        return exec_raw(f'{command_inject + " " if command_inject else "" }' + f'rbd image-meta get {pool}/{image} "{key}"')
+        return self._get_backend(command_inject).get_image_meta(pool, image, key)
 
     def set_rbd_image_meta(self, pool: str, image: str, key: str, value: str, command_inject: str = ''):
-        return exec_raw(f'{command_inject + " " if command_inject else "" }' + f'rbd image-meta set {pool}/{image} "{key}" "{value}"')
+        return self._get_backend(command_inject).set_image_meta(pool, image, key, value)
+
+    def list_rbd_image_meta_batch(self, pool: str, images: [str], command_inject: str = ''):
+        """
+        Gets all image-meta of many images at once.
+
+        :return: {image: {key: value}}, images without image-meta have an empty dict
+        """
+        if not images:
+            return {}
+        log.message(f'get image-meta of {len(images)} images in pool {pool}', LOGLEVEL_DEBUG)
+        return self._get_backend(command_inject).list_image_meta_batch(pool, images)
+
+    def set_rbd_image_meta_batch(self, pool: str, metas: {str: {str: str}}, command_inject: str = ''):
+        """
+        Sets many image-meta keys of many images at once.
+
+        :param metas: {image: {key: value}}
+        """
+        if not metas:
+            return
+        self._get_backend(command_inject).set_image_meta_batch(pool, metas)
 
     def remove_rbd_image_meta(self, pool: str, image: str, key: str, command_inject: str = ''):
-        return exec_raw(f'{command_inject + " " if command_inject else "" }' + f'rbd image-meta remove {pool}/{image} "{key}"')
+        return self._get_backend(command_inject).remove_image_meta(pool, image, key)
 
     def remove_rbd_image(self, pool: str, image: str, command_inject: str = ''):
-        return exec_raw(f'{command_inject + " " if command_inject else "" }' + f'rbd rm {pool}/{image}')
+        result = self._get_backend(command_inject).remove_image(pool, image)
+        inventory = self._get_cached_rbd_inventory(pool, command_inject)
+        if inventory:
+            inventory.remove_image(image)
+        return result
+
+    def get_rbd_image_status(self, pool: str, image: str, command_inject: str = ''):
+        """
+        :return: {"migration": {"state": "prepared", ...}, ...} like "rbd status", migration only if there is one
+        """
+        return self._get_backend(command_inject).get_image_status(pool, image)
+
+    def prepare_rbd_migration_import(self, pool: str, image: str, source_spec: dict, command_inject: str = ''):
+        """
+        Creates image as target of a live migration from source_spec, i.e. a snapshot of an image of another cluster.
+        Clients can use the image right away, reads of data not migrated yet are served from the source.
+
+        :param source_spec: {"type": "native", "cluster_name": ..., "pool_name": ..., "image_name": ..., "snap_name": ...}
+        """
+        log.message(f'prepare migration of {source_spec.get("pool_name")}/{source_spec.get("image_name")} to ceph rbd image {command_inject}{pool}/{image}', LOGLEVEL_INFO)
+        self._get_backend(command_inject).prepare_migration_import(pool, image, source_spec)
+        inventory = self._get_cached_rbd_inventory(pool, command_inject)
+        if inventory:
+            inventory.invalidate(image)
+
+    def execute_rbd_migration(self, pool: str, image: str, command_inject: str = ''):
+        """copies the data not migrated yet, takes as long as copying the whole image"""
+        log.message(f'execute migration of ceph rbd image {command_inject}{pool}/{image}', LOGLEVEL_INFO)
+        self._get_backend(command_inject).execute_migration(pool, image)
+
+    def abort_rbd_migration(self, pool: str, image: str, command_inject: str = ''):
+        """removes the target image of a migration, which has not been committed yet"""
+        log.message(f'abort migration of ceph rbd image {command_inject}{pool}/{image}', LOGLEVEL_INFO)
+        self._get_backend(command_inject).abort_migration(pool, image)
+        inventory = self._get_cached_rbd_inventory(pool, command_inject)
+        if inventory:
+            inventory.remove_image(image)
+
+    def commit_rbd_migration(self, pool: str, image: str, command_inject: str = ''):
+        """detaches the image from the source of the executed migration"""
+        log.message(f'commit migration of ceph rbd image {command_inject}{pool}/{image}', LOGLEVEL_INFO)
+        self._get_backend(command_inject).commit_migration(pool, image)
+        if not command_inject:
+            self.invalidate_rbd_inventory(pool, image)
+
+    def rename_rbd_image(self, pool: str, image: str, new_name: str, command_inject: str = ''):
+        log.message(f'rename ceph rbd image {command_inject}{pool}/{image} to {new_name}', LOGLEVEL_DEBUG)
+        self._get_backend(command_inject).rename_image(pool, image, new_name)
+        inventory = self._get_cached_rbd_inventory(pool, command_inject)
+        if inventory:
+            inventory.remove_image(image)
+            inventory.invalidate(new_name)
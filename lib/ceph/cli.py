@@ -0,0 +1,177 @@
+import json
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+from ..helper import *
+from ..helper import Log as log
+from . import diff
+
+
+def get_argv(command_inject: str, *args: str) -> [str]:
+    """
+    :param command_inject: i.e. "ssh root@host", the remote shell parses the arguments again, they are quoted for it
+    :return: argv running the command args, through command_inject if set
+    """
+    if not command_inject:
+        return list(args)
+    return command_inject.strip().split(' ') + [shlex.quote(x) for x in args]
+
+
+class CliBackend:
+    """
+    Ceph backend using the rbd command line tool, every call spawns a process.
+
+    If command_inject is set (i.e. "ssh root@host"), the commands are executed on a remote system.
+
+    The batch methods run up to concurrency rbd processes at the same time. Commands running longer than timeout
+    seconds are killed (see exec_argv).
+    """
+    _command_inject: str
+    _concurrency: int
+    _timeout: float or None
+
+    def __init__(self, command_inject: str = '', concurrency: int = 16, timeout: float = None):
+        self._command_inject = command_inject
+        self._concurrency = concurrency
+        self._timeout = timeout
+
+    def _argv(self, *args: str):
+        return get_argv(self._command_inject, *args)
+
+    def _exec(self, *args: str, input: bytes = None) -> str:
+        return exec_argv(self._argv(*args), input=input, timeout=self._timeout)
+
+    def _exec_json(self, *args: str, empty=None):
+        return exec_argv_json(self._argv(*args), timeout=self._timeout, empty=empty)
+
+    def list_images(self, pool: str):
+        return self._exec_json('rbd', '-p', pool, 'ls', '--format', 'json')
+
+    def list_images_long(self, pool: str):
+        """
+        :return: {image_name: [snapshot, ...]}, the snapshots do not contain a timestamp
+        """
+        images = {}
+        for entry in self._exec_json('rbd', '-p', pool, 'ls', '-l', '--format', 'json'):
+            snapshots = images.setdefault(entry['image'], [])
+            if 'snapshot' in entry:
+                snapshots.append({
+                    'id': entry.get('snapshot_id'),
+                    'name': entry['snapshot'],
+                    'size': entry.get('size'),
+                    'protected': entry.get('protected', 'false')
+                })
+        return images
+
+    def list_snapshots(self, pool: str, image: str):
+        return self._exec_json('rbd', '-p', pool, 'snap', 'ls', '--format', 'json', image)
+
+    def create_snapshot(self, pool: str, image: str, name: str):
+        self._exec('rbd', '-p', pool, 'snap', 'create', image + '@' + name)
+
+    def remove_snapshot(self, pool: str, image: str, name: str):
+        self._exec('rbd', '-p', pool, 'snap', 'rm', image + '@' + name)
+
+    def purge_snapshots(self, pool: str, image: str):
+        self._exec('rbd', '-p', pool, 'snap', 'purge', f'{pool}/{image}')
+
+    def protect_snapshot(self, pool: str, image: str, name: str):
+        self._exec('rbd', 'snap', 'protect', f'{pool}/{image}@{name}')
+
+    def unprotect_snapshot(self, pool: str, image: str, name: str):
+        self._exec('rbd', 'snap', 'unprotect', f'{pool}/{image}@{name}')
+
+    def create_image(self, pool: str, image: str, size: str, features: [str] = None):
+        self._exec('rbd', 'create', f'{pool}/{image}', '-s', str(size), *[x for feature in features or [] for x in ['--image-feature', feature]])
+
+    def enable_image_features(self, pool: str, image: str, features: [str]):
+        self._exec('rbd', 'feature', 'enable', f'{pool}/{image}', *features)
+        if 'object-map' in features:
+            self._exec('rbd', 'object-map', 'rebuild', '--no-progress', f'{pool}/{image}')
+
+    def remove_image(self, pool: str, image: str):
+        return self._exec('rbd', 'rm', f'{pool}/{image}')
+
+    def rename_image(self, pool: str, image: str, new_name: str):
+        self._exec('rbd', 'rename', f'{pool}/{image}', f'{pool}/{new_name}')
+
+    def get_image_status(self, pool: str, image: str):
+        return self._exec_json('rbd', 'status', '--format', 'json', f'{pool}/{image}')
+
+    def prepare_migration_import(self, pool: str, image: str, source_spec: dict):
+        self._exec('rbd', 'migration', 'prepare', '--import-only', '--source-spec', json.dumps(source_spec), f'{pool}/{image}')
+
+    def execute_migration(self, pool: str, image: str):
+        # copies the whole image, this is not bounded by the command timeout; its warnings go to the terminal
+        exec_argv(self._argv('rbd', 'migration', 'execute', '--no-progress', f'{pool}/{image}'), inherit_stderr=True)
+
+    def abort_migration(self, pool: str, image: str):
+        self._exec('rbd', 'migration', 'abort', '--no-progress', f'{pool}/{image}')
+
+    def commit_migration(self, pool: str, image: str):
+        self._exec('rbd', 'migration', 'commit', '--no-progress', f'{pool}/{image}')
+
+    def get_image_info(self, pool: str, image: str):
+        return self._exec_json('rbd', '-p', pool, '--format', 'json', 'info', image)
+
+    def get_image_du(self, pool: str, image: str):
+        """
+        :return: {snapshot_name: used bytes}, None for the image head
+        """
+        result = self._exec_json('rbd', 'du', '--format', 'json', f'{pool}/{image}')
+        return dict([(x.get('snapshot'), x['used_size']) for x in result.get('images', [])])
+
+    def list_image_meta(self, pool: str, image: str):
+        # older rbd versions do not output anything for images without metadata
+        return self._exec_json('rbd', 'image-meta', 'list', f'{pool}/{image}', '--format', 'json', empty={})
+
+    def get_image_meta(self, pool: str, image: str, key: str):
+        return self._exec('rbd', 'image-meta', 'get', f'{pool}/{image}', key)
+
+    def set_image_meta(self, pool: str, image: str, key: str, value: str):
+        return self._exec('rbd', 'image-meta', 'set', f'{pool}/{image}', key, value)
+
+    def _exec_script(self, commands: [str]):
+        """executes the commands one after another using a single shell (and a single ssh connection if remote)"""
+        script = ' && '.join(commands)
+        return exec_argv(self._command_inject.strip().split(' ') + [script] if self._command_inject else ['/bin/sh', '-c', script], timeout=self._timeout)
+
+    def _map_images(self, func, images: [str]):
+        if len(images) <= 1:
+            return [func(image) for image in images]
+        with ThreadPoolExecutor(max_workers=min(self._concurrency, len(images)), thread_name_prefix='rbd-cli') as executor:
+            return list(executor.map(func, images))
+
+    def list_image_meta_batch(self, pool: str, images: [str]):
+        """
+        :return: {image: {key: value}}
+        """
+        return dict(zip(images, self._map_images(lambda image: self.list_image_meta(pool, image), images)))
+
+    def set_image_meta_batch(self, pool: str, metas: {str: {str: str}}):
+        """
+        :param metas: {image: {key: value}}
+        """
+        def set_image(image: str):
+            self._exec_script([f'rbd image-meta set {shlex.quote(f"{pool}/{image}")} {shlex.quote(key)} {shlex.quote(value)}' for key, value in metas[image].items()])
+        self._map_images(set_image, [image for image in metas if metas[image]])
+
+    def remove_image_meta(self, pool: str, image: str, key: str):
+        return self._exec('rbd', 'image-meta', 'remove', f'{pool}/{image}', key)
+
+    def read_image(self, pool: str, image: str, length: int, offset: int = 0, snapshot: str = None) -> bytes:
+        spec = f'{pool}/{image}' + (f'@{snapshot}' if snapshot else '')
+        log.debug(f'read {length} bytes at offset {offset} of {spec}')
+        data = bytearray()
+        with Process(self._argv('rbd', 'export', '--no-progress', spec, '-'), timeout=self._timeout) as process:
+            for chunk in process.read():
+                data += chunk
+                # the rest of the image is not needed, the process is killed when leaving the block
+                if len(data) >= offset + length:
+                    return bytes(data[offset:offset + length])
+            process.wait()
+        return bytes(data[offset:offset + length])
+
+    def write_image(self, pool: str, image: str, data: bytes, offset: int = 0):
+        log.debug(f'write {len(data)} bytes at offset {offset} of {pool}/{image}')
+        stream = diff.encode_header() + diff.encode_write(offset, data) + diff.encode_end()
+        self._exec('rbd', 'import-diff', '--no-progress', '-', f'{pool}/{image}', input=stream)
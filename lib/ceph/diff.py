@@ -0,0 +1,35 @@
+import struct
+
+# rbd diff v1 stream format, as written by "rbd export-diff" and read by "rbd import-diff"
+DIFF_HEADER = b'rbd diff v1\n'
+DIFF_FROM_SNAP = b'f'
+DIFF_TO_SNAP = b't'
+DIFF_IMAGE_SIZE = b's'
+DIFF_WRITE = b'w'
+DIFF_ZERO = b'z'
+DIFF_END = b'e'
+
+
+def encode_header() -> bytes:
+    return DIFF_HEADER
+
+
+def encode_image_size(size: int) -> bytes:
+    return DIFF_IMAGE_SIZE + struct.pack('<Q', size)
+
+
+def encode_write(offset: int, data: bytes) -> bytes:
+    return encode_write_header(offset, len(data)) + data
+
+
+def encode_write_header(offset: int, length: int) -> bytes:
+    """the record header of a write, length bytes of data have to follow"""
+    return DIFF_WRITE + struct.pack('<QQ', offset, length)
+
+
+def encode_zero(offset: int, length: int) -> bytes:
+    return DIFF_ZERO + struct.pack('<QQ', offset, length)
+
+
+def encode_end() -> bytes:
+    return DIFF_END
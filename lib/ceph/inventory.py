@@ -0,0 +1,137 @@
+import threading
+from ..helper import Log as log
+
+
+class Inventory:
+    """
+    All images of a pool and their snapshots, fetched in one bulk listing.
+
+    Snapshot records from the bulk listing may lack details (i.e. the timestamp with the rbd cli), these are fetched
+    once per image when requested. Images marked as stale are re-read on their next access.
+
+    The lock only guards the cached entries, images are re-read without holding it, so workers asking about other
+    images do not wait for that command. A re-read entry is only swapped in, if the image has not been changed (see
+    _versions) meanwhile.
+    """
+    pool: str
+    _backend: object
+    _images: {str: [dict]}
+    _detailed: {str}
+    _stale: {str}
+    _versions: {str: int}
+    _epoch: int
+    _lock: threading.RLock
+
+    def __init__(self, pool: str, backend):
+        self.pool = pool
+        self._backend = backend
+        self._lock = threading.RLock()
+        self._images = {}
+        self._detailed = set()
+        self._stale = set()
+        self._versions = {}
+        self._epoch = 0
+        self.reload()
+
+    def reload(self):
+        log.debug(f'load image and snapshot inventory of pool {self.pool}')
+        images = self._backend.list_images_long(self.pool)
+        with self._lock:
+            self._images = images
+            self._detailed = set()
+            self._stale = set()
+            self._versions = {}
+            self._epoch += 1
+            for image, snapshots in self._images.items():
+                if all(map(lambda x: 'timestamp' in x, snapshots)):
+                    self._detailed.add(image)
+
+    def _changed(self, image: str):
+        """call with the lock held, on every change of the entry of image"""
+        self._versions[image] = self._versions.get(image, 0) + 1
+
+    def _refresh(self, image: str, detailed: bool = False):
+        """
+        re-reads the snapshots of image if it is stale, or if detailed is set and its entry lacks details
+        """
+        while True:
+            with self._lock:
+                if image not in self._stale and not (detailed and image in self._images and image not in self._detailed):
+                    return
+                version = (self._epoch, self._versions.get(image, 0))
+            try:
+                snapshots = self._backend.list_snapshots(self.pool, image)
+            except Exception as error:
+                log.debug(f'image {self.pool}/{image} seems to be gone: {error}')
+                snapshots = None
+            with self._lock:
+                if version != (self._epoch, self._versions.get(image, 0)):
+                    # changed while reading, read again
+                    continue
+                self._stale.discard(image)
+                if snapshots is None:
+                    self._images.pop(image, None)
+                    self._detailed.discard(image)
+                else:
+                    self._images[image] = snapshots
+                    self._detailed.add(image)
+                return
+
+    def invalidate(self, image: str):
+        with self._lock:
+            self._changed(image)
+            self._stale.add(image)
+            if image not in self._images:
+                self._images[image] = []
+
+    def get_images(self):
+        with self._lock:
+            stale = list(self._stale)
+        for image in stale:
+            self._refresh(image)
+        with self._lock:
+            return list(self._images.keys())
+
+    def get_images_by_prefix(self, prefix: str):
+        return [x for x in self.get_images() if x.startswith(prefix)]
+
+    def is_image_existing(self, image: str):
+        self._refresh(image)
+        with self._lock:
+            return image in self._images
+
+    def get_snapshot_names(self, image: str):
+        self._refresh(image)
+        with self._lock:
+            return [x['name'] for x in self._images.get(image, [])]
+
+    def get_snapshots(self, image: str):
+        self._refresh(image, detailed=True)
+        with self._lock:
+            return [dict(x) for x in self._images.get(image, [])]
+
+    def add_image(self, image: str):
+        with self._lock:
+            self._changed(image)
+            self._images[image] = []
+            self._detailed.add(image)
+            self._stale.discard(image)
+
+    def remove_image(self, image: str):
+        with self._lock:
+            self._changed(image)
+            self._images.pop(image, None)
+            self._detailed.discard(image)
+            self._stale.discard(image)
+
+    def remove_snapshot(self, image: str, name: str):
+        with self._lock:
+            if image in self._images:
+                self._changed(image)
+                self._images[image] = [x for x in self._images[image] if x['name'] != name]
+
+    def remove_snapshots(self, image: str):
+        with self._lock:
+            if image in self._images:
+                self._changed(image)
+                self._images[image] = []
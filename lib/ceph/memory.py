@@ -0,0 +1,188 @@
+import threading
+from datetime import datetime
+from ..helper import parse_size
+
+
+class MemoryBackend:
+    """
+    In-memory ceph backend, holds pools, images, snapshots and image-meta in dicts.
+
+    Behaves like the other backends (including raising on missing images / snapshots), but does not need a cluster.
+    Meant for testing and benchmarking the code built on top of Ceph.
+    """
+    _pools: {str: {str: dict}}
+    _next_id: int
+    _lock: threading.RLock
+
+    def __init__(self, pools: [str] = None):
+        self._pools = {}
+        self._next_id = 1
+        self._lock = threading.RLock()
+        for pool in pools if pools else []:
+            self._pools[pool] = {}
+
+    def _get_pool(self, pool: str):
+        # pools are created on first use
+        return self._pools.setdefault(pool, {})
+
+    def _get_image(self, pool: str, image: str):
+        images = self._get_pool(pool)
+        if image not in images:
+            raise RuntimeError(f'image {pool}/{image} does not exist')
+        return images[image]
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id - 1
+
+    def list_images(self, pool: str):
+        with self._lock:
+            return list(self._get_pool(pool).keys())
+
+    def list_images_long(self, pool: str):
+        """
+        :return: {image_name: [snapshot, ...]}
+        """
+        with self._lock:
+            return {name: [dict(x) for x in image['snapshots']] for name, image in self._get_pool(pool).items()}
+
+    def list_snapshots(self, pool: str, image: str):
+        with self._lock:
+            return [dict(x) for x in self._get_image(pool, image)['snapshots']]
+
+    def create_snapshot(self, pool: str, image: str, name: str):
+        with self._lock:
+            rbd_image = self._get_image(pool, image)
+            if name in map(lambda x: x['name'], rbd_image['snapshots']):
+                raise RuntimeError(f'snapshot {pool}/{image}@{name} already exists')
+            rbd_image['snapshot_data'][name] = bytes(rbd_image['data'])
+            rbd_image['snapshots'].append({
+                'id': self._new_id(),
+                'name': name,
+                'size': rbd_image['size'],
+                'protected': 'false',
+                'timestamp': datetime.now().ctime()
+            })
+
+    def remove_snapshot(self, pool: str, image: str, name: str):
+        with self._lock:
+            rbd_image = self._get_image(pool, image)
+            if [x for x in rbd_image['snapshots'] if x['name'] == name and x['protected'] == 'true']:
+                raise RuntimeError(f'snapshot {pool}/{image}@{name} is protected')
+            snapshots = [x for x in rbd_image['snapshots'] if x['name'] != name]
+            if len(snapshots) == len(rbd_image['snapshots']):
+                raise RuntimeError(f'snapshot {pool}/{image}@{name} does not exist')
+            rbd_image['snapshots'] = snapshots
+            rbd_image['snapshot_data'].pop(name, None)
+
+    def purge_snapshots(self, pool: str, image: str):
+        with self._lock:
+            if [x for x in self._get_image(pool, image)['snapshots'] if x['protected'] == 'true']:
+                raise RuntimeError(f'image {pool}/{image} has protected snapshots')
+            self._get_image(pool, image)['snapshots'] = []
+            self._get_image(pool, image)['snapshot_data'] = {}
+
+    def _set_snapshot_protected(self, pool: str, image: str, name: str, protected: bool):
+        with self._lock:
+            snapshots = [x for x in self._get_image(pool, image)['snapshots'] if x['name'] == name]
+            if not snapshots:
+                raise RuntimeError(f'snapshot {pool}/{image}@{name} does not exist')
+            snapshots[0]['protected'] = 'true' if protected else 'false'
+
+    def protect_snapshot(self, pool: str, image: str, name: str):
+        self._set_snapshot_protected(pool, image, name, True)
+
+    def unprotect_snapshot(self, pool: str, image: str, name: str):
+        self._set_snapshot_protected(pool, image, name, False)
+
+    def create_image(self, pool: str, image: str, size: str, features: [str] = None):
+        with self._lock:
+            images = self._get_pool(pool)
+            if image in images:
+                raise RuntimeError(f'image {pool}/{image} already exists')
+            images[image] = {'id': self._new_id(), 'size': parse_size(size), 'snapshots': [], 'snapshot_data': {}, 'meta': {}, 'data': bytearray(),
+                             'features': set(features) if features else {'layering', 'exclusive-lock', 'object-map', 'fast-diff', 'deep-flatten'}}
+
+    def enable_image_features(self, pool: str, image: str, features: [str]):
+        with self._lock:
+            self._get_image(pool, image)['features'].update(features)
+
+    def remove_image(self, pool: str, image: str):
+        with self._lock:
+            rbd_image = self._get_image(pool, image)
+            if rbd_image['snapshots']:
+                raise RuntimeError(f'image {pool}/{image} has snapshots')
+            del self._get_pool(pool)[image]
+
+    def rename_image(self, pool: str, image: str, new_name: str):
+        with self._lock:
+            images = self._get_pool(pool)
+            if new_name in images:
+                raise RuntimeError(f'image {pool}/{new_name} already exists')
+            images[new_name] = self._get_image(pool, image)
+            del images[image]
+
+    def get_image_info(self, pool: str, image: str):
+        with self._lock:
+            rbd_image = self._get_image(pool, image)
+            return {
+                'name': image,
+                'id': str(rbd_image['id']),
+                'size': rbd_image['size'],
+                'snapshot_count': len(rbd_image['snapshots']),
+                'format': 2
+            }
+
+    def get_image_du(self, pool: str, image: str):
+        with self._lock:
+            rbd_image = self._get_image(pool, image)
+            result = dict([(name, len(data)) for name, data in rbd_image['snapshot_data'].items()])
+            result[None] = len(rbd_image['data'])
+            return result
+
+    def list_image_meta(self, pool: str, image: str):
+        with self._lock:
+            return dict(self._get_image(pool, image)['meta'])
+
+    def list_image_meta_batch(self, pool: str, images: [str]):
+        with self._lock:
+            return {image: dict(self._get_image(pool, image)['meta']) for image in images}
+
+    def set_image_meta_batch(self, pool: str, metas: {str: {str: str}}):
+        with self._lock:
+            for image, meta in metas.items():
+                self._get_image(pool, image)['meta'].update(meta)
+
+    def get_image_meta(self, pool: str, image: str, key: str):
+        with self._lock:
+            meta = self._get_image(pool, image)['meta']
+            if key not in meta:
+                raise RuntimeError(f'image {pool}/{image} has no metadata key {key}')
+            return meta[key]
+
+    def set_image_meta(self, pool: str, image: str, key: str, value: str):
+        with self._lock:
+            self._get_image(pool, image)['meta'][key] = value
+
+    def remove_image_meta(self, pool: str, image: str, key: str):
+        with self._lock:
+            self._get_image(pool, image)['meta'].pop(key, None)
+
+    def read_image(self, pool: str, image: str, length: int, offset: int = 0, snapshot: str = None) -> bytes:
+        with self._lock:
+            rbd_image = self._get_image(pool, image)
+            if snapshot and snapshot not in rbd_image['snapshot_data']:
+                raise RuntimeError(f'snapshot {pool}/{image}@{snapshot} does not exist')
+            data = rbd_image['snapshot_data'][snapshot] if snapshot else rbd_image['data']
+            # data is only stored up to the last written byte, the rest of the image reads as zeros
+            length = max(0, min(length, rbd_image['size'] - offset))
+            return bytes(data[offset:offset + length]).ljust(length, b'\0')
+
+    def write_image(self, pool: str, image: str, data: bytes, offset: int = 0):
+        with self._lock:
+            rbd_image = self._get_image(pool, image)
+            if offset + len(data) > rbd_image['size']:
+                raise RuntimeError(f'write beyond the end of image {pool}/{image}')
+            if len(rbd_image['data']) < offset:
+                rbd_image['data'].extend(bytes(offset - len(rbd_image['data'])))
+            rbd_image['data'][offset:offset + len(data)] = data
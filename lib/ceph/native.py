@@ -0,0 +1,239 @@
+import json
+import threading
+from ..helper import Log as log
+from ..helper import parse_size
+
+try:
+    import rados
+    import rbd
+except ImportError:
+    rados = None
+    rbd = None
+
+
+def is_available() -> bool:
+    return rados is not None and rbd is not None
+
+
+def get_migration_state_name(state: int) -> str:
+    """
+    :return: the name the rbd cli uses for a migration state, i.e. "prepared"
+    """
+    for name in ['prepared', 'executing', 'executed', 'committing', 'aborting', 'error', 'preparing', 'unknown']:
+        if getattr(rbd, 'RBD_IMAGE_MIGRATION_STATE_' + name.upper(), None) == state:
+            return name
+    return 'unknown'
+
+
+def get_feature_mask(features: [str]) -> int:
+    """
+    :param features: rbd cli feature names, i.e. ['layering', 'exclusive-lock']
+    """
+    mask = 0
+    for feature in features:
+        mask |= getattr(rbd, 'RBD_FEATURE_' + feature.strip().upper().replace('-', '_'))
+    return mask
+
+
+class NativeBackend:
+    """
+    Ceph backend using the librados / librbd python bindings.
+
+    Keeps one cluster connection for the lifetime of the backend and one io context per pool, instead of spawning a
+    process and connecting to the cluster for every call.
+    """
+    _conffile: str
+    _client_name: str
+    _cluster: object
+    _ioctxs: {str: object}
+    _lock: threading.Lock
+
+    def __init__(self, conffile: str = '/etc/ceph/ceph.conf', client_name: str = 'client.admin'):
+        if not is_available():
+            raise ImportError('the native ceph backend requires the python modules "rados" and "rbd" (i.e. python3-rados, python3-rbd)')
+        self._conffile = conffile
+        self._client_name = client_name
+        self._cluster = None
+        self._ioctxs = {}
+        self._lock = threading.Lock()
+
+    def _get_ioctx(self, pool: str):
+        with self._lock:
+            if self._cluster is None:
+                log.debug(f'connect to ceph cluster using {self._conffile} as {self._client_name}')
+                cluster = rados.Rados(conffile=self._conffile, name=self._client_name)
+                cluster.connect()
+                self._cluster = cluster
+            if pool not in self._ioctxs:
+                self._ioctxs[pool] = self._cluster.open_ioctx(pool)
+            return self._ioctxs[pool]
+
+    def _open_image(self, pool: str, image: str, snapshot: str = None, read_only: bool = False):
+        return rbd.Image(self._get_ioctx(pool), image, snapshot=snapshot, read_only=read_only)
+
+    def close(self):
+        with self._lock:
+            for ioctx in self._ioctxs.values():
+                ioctx.close()
+            self._ioctxs = {}
+            if self._cluster is not None:
+                self._cluster.shutdown()
+                self._cluster = None
+
+    def list_images(self, pool: str):
+        return rbd.RBD().list(self._get_ioctx(pool))
+
+    def list_images_long(self, pool: str):
+        """
+        :return: {image_name: [snapshot, ...]}
+        """
+        images = {}
+        for image in self.list_images(pool):
+            images[image] = self.list_snapshots(pool, image)
+        return images
+
+    def list_snapshots(self, pool: str, image: str):
+        snapshots = []
+        with self._open_image(pool, image, read_only=True) as rbd_image:
+            for snapshot in rbd_image.list_snaps():
+                snapshots.append({
+                    'id': snapshot['id'],
+                    'name': snapshot['name'],
+                    'size': snapshot['size'],
+                    # the rbd cli reports these as strings, too
+                    'protected': 'true' if rbd_image.is_protected_snap(snapshot['name']) else 'false',
+                    'timestamp': rbd_image.get_snap_timestamp(snapshot['id']).ctime()
+                })
+        return snapshots
+
+    def create_snapshot(self, pool: str, image: str, name: str):
+        with self._open_image(pool, image) as rbd_image:
+            rbd_image.create_snap(name)
+
+    def remove_snapshot(self, pool: str, image: str, name: str):
+        with self._open_image(pool, image) as rbd_image:
+            rbd_image.remove_snap(name)
+
+    def purge_snapshots(self, pool: str, image: str):
+        with self._open_image(pool, image) as rbd_image:
+            for snapshot in list(rbd_image.list_snaps()):
+                rbd_image.remove_snap(snapshot['name'])
+
+    def create_image(self, pool: str, image: str, size: str, features: [str] = None):
+        rbd.RBD().create(self._get_ioctx(pool), image, parse_size(size), old_format=False, features=get_feature_mask(features) if features else None)
+
+    def enable_image_features(self, pool: str, image: str, features: [str]):
+        with self._open_image(pool, image) as rbd_image:
+            rbd_image.update_features(get_feature_mask(features), True)
+            if 'object-map' in features:
+                rbd_image.rebuild_object_map()
+
+    def remove_image(self, pool: str, image: str):
+        rbd.RBD().remove(self._get_ioctx(pool), image)
+
+    def rename_image(self, pool: str, image: str, new_name: str):
+        rbd.RBD().rename(self._get_ioctx(pool), image, new_name)
+
+    def protect_snapshot(self, pool: str, image: str, name: str):
+        with self._open_image(pool, image) as rbd_image:
+            rbd_image.protect_snap(name)
+
+    def unprotect_snapshot(self, pool: str, image: str, name: str):
+        with self._open_image(pool, image) as rbd_image:
+            rbd_image.unprotect_snap(name)
+
+    def get_image_status(self, pool: str, image: str):
+        """
+        :return: like "rbd status": {"migration": {"state": "prepared", ...}}, without migration if there is none
+        """
+        try:
+            migration = rbd.RBD().migration_status(self._get_ioctx(pool), image)
+        except rbd.InvalidArgument:
+            return {}
+        return {'migration': dict(migration, state=get_migration_state_name(migration['state']))}
+
+    def prepare_migration_import(self, pool: str, image: str, source_spec: dict):
+        rbd.RBD().migration_prepare_import(json.dumps(source_spec), self._get_ioctx(pool), image)
+
+    def execute_migration(self, pool: str, image: str):
+        rbd.RBD().migration_execute(self._get_ioctx(pool), image)
+
+    def abort_migration(self, pool: str, image: str):
+        rbd.RBD().migration_abort(self._get_ioctx(pool), image)
+
+    def commit_migration(self, pool: str, image: str):
+        rbd.RBD().migration_commit(self._get_ioctx(pool), image)
+
+    def get_image_info(self, pool: str, image: str):
+        with self._open_image(pool, image, read_only=True) as rbd_image:
+            stat = rbd_image.stat()
+            return {
+                'name': image,
+                'id': rbd_image.id(),
+                'size': stat['size'],
+                'objects': stat['num_objs'],
+                'order': stat['order'],
+                'object_size': stat['obj_size'],
+                'snapshot_count': len(list(rbd_image.list_snaps())),
+                'block_name_prefix': stat['block_name_prefix'],
+                'format': 2
+            }
+
+    def get_image_du(self, pool: str, image: str):
+        """
+        :return: {snapshot_name: used bytes}, None for the image head; the data changed since the previous snapshot
+        """
+        result = {}
+        previous = None
+        with self._open_image(pool, image, read_only=True) as rbd_image:
+            snapshots = [x['name'] for x in rbd_image.list_snaps()]
+        for snapshot in snapshots + [None]:
+            used = [0]
+
+            def add_extent(offset, length, exists):
+                if exists:
+                    used[0] += length
+            with self._open_image(pool, image, snapshot=snapshot, read_only=True) as rbd_image:
+                rbd_image.diff_iterate(0, rbd_image.size(), previous, add_extent)
+            result[snapshot] = used[0]
+            previous = snapshot
+        return result
+
+    def list_image_meta(self, pool: str, image: str):
+        with self._open_image(pool, image, read_only=True) as rbd_image:
+            return dict(rbd_image.metadata_list())
+
+    def list_image_meta_batch(self, pool: str, images: [str]):
+        """
+        :return: {image: {key: value}}
+        """
+        return {image: self.list_image_meta(pool, image) for image in images}
+
+    def set_image_meta_batch(self, pool: str, metas: {str: {str: str}}):
+        """
+        :param metas: {image: {key: value}}
+        """
+        for image, meta in metas.items():
+            with self._open_image(pool, image) as rbd_image:
+                for key, value in meta.items():
+                    rbd_image.metadata_set(key, value)
+
+    def get_image_meta(self, pool: str, image: str, key: str):
+        with self._open_image(pool, image, read_only=True) as rbd_image:
+            return rbd_image.metadata_get(key)
+
+    def set_image_meta(self, pool: str, image: str, key: str, value: str):
+        with self._open_image(pool, image) as rbd_image:
+            rbd_image.metadata_set(key, value)
+
+    def remove_image_meta(self, pool: str, image: str, key: str):
+        with self._open_image(pool, image) as rbd_image:
+            rbd_image.metadata_remove(key)
+
+    def read_image(self, pool: str, image: str, length: int, offset: int = 0, snapshot: str = None) -> bytes:
+        with self._open_image(pool, image, snapshot=snapshot, read_only=True) as rbd_image:
+            return rbd_image.read(offset, length)
+
+    def write_image(self, pool: str, image: str, data: bytes, offset: int = 0):
+        with self._open_image(pool, image) as rbd_image:
+            rbd_image.write(data, offset)
@@ -2,10 +2,14 @@ from .helper import Log as log
 from .helper import exec_raw
 
 
-def mount_rbd_metadata_image(image: str, mapped_device_path: str):
+def mount_rbd_metadata_image(image: str, mapped_device_path: str, read_only: bool = False):
+    """
+    :param image: name of the mount point below /tmp
+    :param read_only: mount without replaying the journal, required for snapshots
+    """
     log.debug(f'mount vm metadata filesystem: {image}')
     exec_raw(f'mkdir -p /tmp/{image}')
-    exec_raw(f'mount {mapped_device_path} /tmp/{image}')
+    exec_raw(f'mount {"-o ro,noload " if read_only else ""}{mapped_device_path} /tmp/{image}')
 
 
 def unmount_rbd_metadata_image(image_name: str):
@@ -2,10 +2,15 @@ import subprocess
 import json
 import sys
 import re
+import threading
+import time
 from datetime import datetime, timedelta
+from .log import LOGLEVEL_DEBUG, LOGLEVEL_INFO, LOGLEVEL_WARN, LOGLEVEL_ERR, Log, map_loglevel, map_loglevel_str
+from .process import CommandError, CommandTimeout, CommandCancelled, Process, JsonStream, iter_json, parse_json_stream, exec_argv, exec_argv_bytes, exec_argv_json, exec_raw, exec_parse_json
 
 REGEX_GUID = r'[0-9a-fA-F]{8}(-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}'
 _seconds_per_unit = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'M': 2629746, 'y': 31556952}
+_size_units = {'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4, 'P': 1024 ** 5}
 
 
 class Time:
@@ -50,87 +55,6 @@ def unique_list(list: []):
     return tmp_list
 
 
-LOGLEVEL_DEBUG = 0
-LOGLEVEL_INFO = 1
-LOGLEVEL_WARN = 2
-LOGLEVEL_ERR = 3
-
-
-def map_loglevel_str(level: int):
-    if level == LOGLEVEL_DEBUG:
-        return 'DEBUG'
-    if level == LOGLEVEL_INFO:
-        return ' INFO'
-    if level == LOGLEVEL_WARN:
-        return ' WARN'
-    if level == LOGLEVEL_ERR:
-        return 'ERROR'
-    return 'UNKNOWN'
-
-
-def map_loglevel(level: str):
-    level = level.upper()
-    if level == 'DEBUG':
-        return LOGLEVEL_DEBUG
-    if level == 'INFO':
-        return LOGLEVEL_INFO
-    if level == 'WARN':
-        return LOGLEVEL_WARN
-    if level == 'ERROR':
-        return LOGLEVEL_ERR
-    return 'UNKNOWN'
-
-
-class Log:
-    _LOGLEVEL = LOGLEVEL_INFO
-    _log_buffer = ""
-
-    @staticmethod
-    def set_loglevel(level: int):
-        if level not in range(0, 3):
-            raise NotImplementedError(f'log level is out of range')
-        Log._LOGLEVEL = level
-
-    @staticmethod
-    def get_loglevel():
-        return Log._LOGLEVEL
-
-    @staticmethod
-    def print_std_err(message: str) -> None:
-        print(message, file=sys.stderr, flush=True)
-
-    @staticmethod
-    def message(message: str, level: int) -> None:
-        message = f'[{datetime.now()}] {map_loglevel_str(level)}: {message}'
-        Log._log_buffer += message + '\n'
-        if Log.get_loglevel() > level:
-            return
-        if level == LOGLEVEL_ERR:
-            Log.print_std_err(message)
-        else:
-            print(message, flush=True)
-
-    @staticmethod
-    def get_log_buffer():
-        return Log._log_buffer
-
-    @staticmethod
-    def debug(message: str):
-        Log.message(message, LOGLEVEL_DEBUG)
-
-    @staticmethod
-    def info(message: str):
-        Log.message(message, LOGLEVEL_INFO)
-
-    @staticmethod
-    def warn(message: str):
-        Log.message(message, LOGLEVEL_WARN)
-
-    @staticmethod
-    def error(message: str):
-        Log.message(message, LOGLEVEL_ERR)
-
-
 def sizeof_fmt(num: float, suffix: str = 'B') -> str:
     for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
         if abs(num) < 1024.0:
@@ -139,21 +63,37 @@ def sizeof_fmt(num: float, suffix: str = 'B') -> str:
     return "%.1f %s%s" % (num, 'Yi', suffix)
 
 
-def exec_raw(command: str) -> str:
-    Log.debug(f'exec command \'{command}\'')
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-    process.wait()
-    if process.returncode != 0:
-        raise RuntimeError(f'command failed with code: {process.returncode}')
-    return str(process.stdout.read().decode("utf-8")).strip("\n")
+def parse_size(size: str) -> int:
+    """
+    :param size: size-in-M/G/T like the rbd cli expects it. Examples: 1, 100M, 20G, 4T
+    :return: size in bytes
+    """
+    size = str(size).strip().upper()
+    if size.endswith('IB'):
+        size = size[:-2]
+    if size[-1] in _size_units:
+        return int(float(size[:-1]) * _size_units[size[-1]])
+    return int(size) * _size_units['M']
 
 
 def parse_json(json_str: str):
-    return json.loads(json_str, encoding='UTF-8')
-
-
-def exec_parse_json(command: str):
-    return json.loads(exec_raw(command), encoding='UTF-8')
+    return json.loads(json_str)
+
+
+def wait_for(condition, timeout: float, min_interval: float = 0.1, max_interval: float = 2.0) -> bool:
+    """
+    Calls condition until it returns True or timeout seconds passed. The first call happens right away, the interval
+    between calls grows from min_interval up to max_interval.
+    """
+    deadline = time.monotonic() + timeout
+    interval = min_interval
+    while True:
+        if condition():
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(min(interval, max(0.0, deadline - time.monotonic())))
+        interval = min(interval * 1.5, max_interval)
 
 
 def rbd_image_from_proxmox_disk(disk):
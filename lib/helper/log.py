@@ -0,0 +1,239 @@
+"""
+Logging of this project: lines on stdout / stderr, a bounded ring buffer of recent lines for the post-mortem dump of
+main.py and optionally JSON lines in a file, written by a background thread.
+
+Each output has its own level; a message below all of them is dropped before its timestamp or text is formatted.
+Arguments are formatted lazily, printf-style: log.debug('output: %s', response.content). Safe to use from concurrent
+workers.
+"""
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+from collections import deque
+from datetime import datetime
+from .. import tracing
+
+LOGLEVEL_DEBUG = 0
+LOGLEVEL_INFO = 1
+LOGLEVEL_WARN = 2
+LOGLEVEL_ERR = 3
+
+# longer lines are cut in the ring buffer, i.e. api responses in debug output
+BUFFER_LINE_LENGTH = 4096
+# records queued for the log file, further ones are dropped until the writer catches up
+FILE_QUEUE_SIZE = 10000
+# seconds close waits for the writer to write the pending records
+FILE_CLOSE_TIMEOUT = 5
+
+
+def map_loglevel_str(level: int):
+    if level == LOGLEVEL_DEBUG:
+        return 'DEBUG'
+    if level == LOGLEVEL_INFO:
+        return ' INFO'
+    if level == LOGLEVEL_WARN:
+        return ' WARN'
+    if level == LOGLEVEL_ERR:
+        return 'ERROR'
+    return 'UNKNOWN'
+
+
+def map_loglevel(level: str):
+    level = level.upper()
+    if level == 'DEBUG':
+        return LOGLEVEL_DEBUG
+    if level == 'INFO':
+        return LOGLEVEL_INFO
+    if level == 'WARN':
+        return LOGLEVEL_WARN
+    if level == 'ERROR':
+        return LOGLEVEL_ERR
+    return 'UNKNOWN'
+
+
+class JsonLinesWriter:
+    """
+    Appends log records to path as JSON lines, in a background thread. Loggers never wait for it: records are dropped
+    while FILE_QUEUE_SIZE are pending, and after a write error the file output is disabled.
+    """
+    path: str
+    level: int
+    dropped: int
+    failed: bool
+    _queue: queue.Queue
+    _thread: threading.Thread
+
+    def __init__(self, path: str, level: int):
+        self.path = path
+        self.level = level
+        self.dropped = 0
+        self.failed = False
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._queue = queue.Queue(FILE_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, record: dict):
+        if self.failed:
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            if self.failed:
+                continue
+            try:
+                if self.dropped:
+                    self._file.write(json.dumps({'time': record.get('time'), 'level': 'warn', 'thread': self._thread.name, 'span': None,
+                                                 'message': f'{self.dropped} log records dropped, the log file could not keep up'}) + '\n')
+                    self.dropped = 0
+                self._file.write(json.dumps(record, default=str) + '\n')
+                if self._queue.empty():
+                    self._file.flush()
+            except (OSError, ValueError) as error:
+                # i.e. disk full: keep logging to the other outputs, the remaining records are discarded
+                self.failed = True
+                print(f'writing log file {self.path} failed, file logging disabled: {error}', file=sys.stderr, flush=True)
+        try:
+            self._file.close()
+        except OSError:
+            pass
+
+    def close(self):
+        """writes the pending records, up to FILE_CLOSE_TIMEOUT seconds, and closes the file"""
+        try:
+            self._queue.put(None, timeout=FILE_CLOSE_TIMEOUT)
+        except queue.Full:
+            print(f'log file {self.path} not closed, the writer did not catch up in time', file=sys.stderr, flush=True)
+            return
+        self._thread.join(FILE_CLOSE_TIMEOUT)
+
+
+class Log:
+    _LOGLEVEL = LOGLEVEL_INFO
+    _buffer_level = LOGLEVEL_DEBUG
+    _buffer = deque(maxlen=10000)
+    _dropped = 0
+    _file: JsonLinesWriter or None = None
+    # lowest level of all outputs, messages below it are dropped right away
+    _threshold = LOGLEVEL_DEBUG
+    _lock = threading.RLock()
+
+    @staticmethod
+    def _update_threshold():
+        levels = [Log._LOGLEVEL, Log._buffer_level] + ([Log._file.level] if Log._file else [])
+        Log._threshold = min(levels)
+
+    @staticmethod
+    def set_loglevel(level: int):
+        if level not in range(0, 4):
+            raise NotImplementedError(f'log level is out of range')
+        with Log._lock:
+            Log._LOGLEVEL = level
+            Log._update_threshold()
+
+    @staticmethod
+    def get_loglevel():
+        return Log._LOGLEVEL
+
+    @staticmethod
+    def set_buffer(lines: int, level: int = LOGLEVEL_DEBUG):
+        """
+        :param lines: lines kept for get_log_buffer, the oldest are dropped; 0 = none
+        :param level: lowest level kept
+        """
+        with Log._lock:
+            Log._buffer = deque(Log._buffer, maxlen=max(0, lines))
+            Log._buffer_level = level
+            Log._update_threshold()
+
+    @staticmethod
+    def open_file(path: str, level: int = LOGLEVEL_DEBUG):
+        """
+        Writes messages of level and above to path as JSON lines:
+        {"time": "...", "level": "info", "thread": "...", "span": "...", "message": "..."}, span if tracing is enabled.
+        """
+        with Log._lock:
+            Log.close()
+            Log._file = JsonLinesWriter(path, level)
+            Log._update_threshold()
+
+    @staticmethod
+    def close():
+        with Log._lock:
+            if Log._file:
+                Log._file.close()
+                Log._file = None
+                Log._update_threshold()
+
+    @staticmethod
+    def print_std_err(message: str) -> None:
+        print(message, file=sys.stderr, flush=True)
+
+    @staticmethod
+    def message(message: str, level: int, *args) -> None:
+        if level < Log._threshold:
+            return
+        if args:
+            message = message % args
+        now = datetime.now()
+        line = f'[{now}] {map_loglevel_str(level)}: {message}'
+        with Log._lock:
+            if level >= Log._buffer_level and Log._buffer.maxlen:
+                if len(Log._buffer) == Log._buffer.maxlen:
+                    Log._dropped += 1
+                Log._buffer.append(line if len(line) <= BUFFER_LINE_LENGTH else line[:BUFFER_LINE_LENGTH] + ' [...]')
+            if Log._file and level >= Log._file.level:
+                span = tracing.TRACER.get_current_span()
+                Log._file.write({
+                    'time': now.isoformat(),
+                    'level': map_loglevel_str(level).strip().lower(),
+                    'thread': threading.current_thread().name,
+                    'span': span.name if span else None,
+                    'message': message
+                })
+            if level < Log._LOGLEVEL:
+                return
+            if level == LOGLEVEL_ERR:
+                Log.print_std_err(line)
+            else:
+                print(line, flush=True)
+
+    @staticmethod
+    def get_log_buffer():
+        with Log._lock:
+            lines = list(Log._buffer)
+            if Log._dropped:
+                lines.insert(0, f'[... {Log._dropped} earlier lines dropped, see "log_buffer_lines"]')
+            return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def debug(message: str, *args):
+        Log.message(message, LOGLEVEL_DEBUG, *args)
+
+    @staticmethod
+    def info(message: str, *args):
+        Log.message(message, LOGLEVEL_INFO, *args)
+
+    @staticmethod
+    def warn(message: str, *args):
+        Log.message(message, LOGLEVEL_WARN, *args)
+
+    @staticmethod
+    def error(message: str, *args):
+        Log.message(message, LOGLEVEL_ERR, *args)
+
+
+atexit.register(Log.close)
@@ -0,0 +1,391 @@
+"""
+Running external commands: argv lists without a shell (exec_argv, exec_argv_bytes, exec_argv_json) and, for the callers building shell
+command lines, exec_raw / exec_parse_json.
+
+stdout is read while the command runs and stderr is drained by a thread, so neither pipe can fill up and block the
+command; the last lines of stderr end up in the raised CommandError. Commands reporting their progress on stderr (i.e.
+pv in the shell transfer pipelines) inherit it instead. json output is parsed while it is read (see
+JsonStream), the whole output is never held as text.
+"""
+import codecs
+import json
+import os
+import shlex
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from ..metrics import COMMAND_DURATION, COMMAND_ERRORS
+from .. import tracing
+from .log import Log
+
+CHUNK_SIZE = 65536
+# lines of stderr kept for the error message
+STDERR_LINES = 20
+# how often a running command checks for cancellation
+CANCEL_INTERVAL = 0.1
+
+
+class CommandError(RuntimeError):
+    command: str
+    returncode: int or None
+    stderr: str
+
+    def __init__(self, message: str, command: str, returncode: int or None, stderr: str = ''):
+        super().__init__(message + (f': {stderr}' if stderr else ''))
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class CommandTimeout(CommandError):
+    pass
+
+
+class CommandCancelled(CommandError):
+    pass
+
+
+def _get_program(command: str):
+    """
+    :return: name of the program a shell command starts with, i.e. "rbd" for "/usr/bin/rbd ls"
+    """
+    parts = command.split(maxsplit=1)
+    return parts[0].rsplit('/', 1)[-1] if parts else ''
+
+
+class Process:
+    """
+    A running command, as context manager; leaving it kills the command if it is still running.
+
+        with Process(['rbd', 'export', 'rbd/image', '-']) as process:
+            for chunk in process.read():
+                ...
+            process.wait()
+
+    With a timeout or a cancel event the command runs in its own process group, killing it kills the programs it
+    started as well (i.e. those of a shell pipeline).
+    """
+    argv: [str] or str
+    command: str
+    program: str
+    _input: bytes or None
+    _timeout: float or None
+    _cancel: threading.Event or None
+    _process: subprocess.Popen or None
+    _stderr: deque
+    _threads: [threading.Thread]
+    _finished: threading.Event
+    _stopped: str or None
+    _inherit_stderr: bool
+
+    def __init__(self, argv: [str] or str, input: bytes = None, timeout: float = None, cancel: threading.Event = None, shell: bool = False,
+                 inherit_stderr: bool = False):
+        """
+        :param argv: program and arguments, or a shell command line if shell is set
+        :param input: written to stdin, otherwise stdin is empty
+        :param timeout: seconds after which the command is killed and CommandTimeout raised
+        :param cancel: once set, the command is killed and CommandCancelled raised
+        :param inherit_stderr: the command writes to the stderr of this process, CommandError does not contain it then
+        """
+        self.argv = argv
+        self.command = argv if shell else shlex.join(argv)
+        self.program = _get_program(argv) if shell else os.path.basename(argv[0])
+        self._shell = shell
+        self._input = input
+        self._timeout = timeout
+        self._cancel = cancel
+        self._process = None
+        self._stderr = deque(maxlen=STDERR_LINES)
+        self._threads = []
+        self._finished = threading.Event()
+        self._stopped = None
+        self._inherit_stderr = inherit_stderr
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._process and self._process.poll() is None:
+            self._kill()
+        self._finish()
+
+    def _start_thread(self, target, name: str):
+        thread = threading.Thread(target=target, name=f'{self.program}-{name}', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def start(self):
+        Log.debug('exec command \'%s\'', self.command)
+        own_group = bool(self._timeout or self._cancel)
+        self._process = subprocess.Popen(self.argv, shell=self._shell, stdin=subprocess.PIPE if self._input is not None else subprocess.DEVNULL,
+                                         stdout=subprocess.PIPE, stderr=None if self._inherit_stderr else subprocess.PIPE, start_new_session=own_group)
+        if not self._inherit_stderr:
+            self._start_thread(self._read_stderr, 'stderr')
+        if self._input is not None:
+            self._start_thread(self._write_stdin, 'stdin')
+        if own_group:
+            threading.Thread(target=self._watch, name=f'{self.program}-watch', daemon=True).start()
+
+    def _read_stderr(self):
+        for line in iter(self._process.stderr.readline, b''):
+            line = line.decode('utf-8', errors='replace').rstrip()
+            self._stderr.append(line)
+            Log.debug('%s [stderr]: %s', self.program, line)
+
+    def _write_stdin(self):
+        try:
+            self._process.stdin.write(self._input)
+            self._process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            # the command exited early, its exit code tells what happened
+            pass
+
+    def _watch(self):
+        deadline = time.monotonic() + self._timeout if self._timeout else None
+        while True:
+            interval = CANCEL_INTERVAL if self._cancel else deadline - time.monotonic()
+            if self._finished.wait(max(0.0, interval)):
+                return
+            if self._cancel and self._cancel.is_set():
+                self._stopped = 'cancelled'
+            elif deadline and time.monotonic() >= deadline:
+                self._stopped = f'timed out after {self._timeout} seconds'
+            if self._stopped:
+                self._kill()
+                return
+
+    def _kill(self):
+        try:
+            if self._timeout or self._cancel:
+                os.killpg(self._process.pid, signal.SIGKILL)
+            else:
+                self._process.kill()
+        except ProcessLookupError:
+            pass
+
+    def _finish(self):
+        if self._finished.is_set():
+            return
+        self._process.wait()
+        for thread in self._threads:
+            thread.join()
+        self._process.stdout.close()
+        if self._process.stderr:
+            self._process.stderr.close()
+        self._finished.set()
+
+    def read(self):
+        """
+        :return: iterator over the chunks of stdout, as they arrive
+        """
+        while True:
+            chunk = self._process.stdout.read1(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def get_stderr(self) -> str:
+        return '\n'.join(self._stderr)
+
+    def wait(self) -> int:
+        """
+        Waits for the command to exit, unread output is discarded.
+
+        :raises CommandError: if it exited with an error, CommandTimeout / CommandCancelled if it was killed
+        """
+        if not self._finished.is_set():
+            for _ in self.read():
+                pass
+        self._finish()
+        if self._stopped:
+            error = CommandCancelled if self._stopped == 'cancelled' else CommandTimeout
+            raise error(f'command {self._stopped}', self.command, self._process.returncode, self.get_stderr())
+        if self._process.returncode != 0:
+            raise CommandError(f'command failed with code: {self._process.returncode}', self.command, self._process.returncode, self.get_stderr())
+        return self._process.returncode
+
+
+class JsonStream:
+    """
+    Incremental json parser, fed with chunks of utf-8 bytes. The items of a top level array are returned as soon as
+    they are complete, any other document as a whole by close.
+    """
+    is_array: bool or None
+    _decoder: json.JSONDecoder
+    _buffer: str
+    _state: str
+    _first: bool
+
+    def __init__(self):
+        self.is_array = None
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        # item (next array item or end), separator (after an item) or end
+        self._state = 'item'
+        self._first = True
+
+    def is_empty(self) -> bool:
+        return self.is_array is None
+
+    def feed(self, data: bytes, final: bool = False) -> list:
+        """
+        :return: the array items completed by data
+        """
+        self._buffer += self._text.decode(data, final)
+        if self.is_array is None:
+            stripped = self._buffer.lstrip()
+            if not stripped:
+                self._buffer = ''
+                return []
+            self.is_array = stripped[0] == '['
+            self._buffer = stripped[1:] if self.is_array else stripped
+        if not self.is_array:
+            return []
+        items = []
+        buffer, position = self._buffer, 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n':
+                position += 1
+            if position >= len(buffer):
+                break
+            if self._state == 'item':
+                if self._first and buffer[position] == ']':
+                    self._state = 'end'
+                    position += 1
+                    continue
+                try:
+                    item, end = self._decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break
+                # a number may continue in the next chunk (i.e. "12" of "12.5"), the item is complete once a separator follows
+                if not final and (end == len(buffer) or buffer[end] not in ' \t\r\n,]'):
+                    break
+                items.append(item)
+                position = end
+                self._state = 'separator'
+                self._first = False
+            elif self._state == 'separator':
+                if buffer[position] not in ',]':
+                    raise json.JSONDecodeError('expected "," or "]"', buffer, position)
+                self._state = 'item' if buffer[position] == ',' else 'end'
+                position += 1
+            else:
+                raise json.JSONDecodeError('extra data', buffer, position)
+        self._buffer = buffer[position:]
+        return items
+
+    def close(self) -> list:
+        """
+        :return: the remaining array items, or [document] if it is not an array
+        :raises json.JSONDecodeError: if the input was not json, or empty
+        """
+        items = self.feed(b'', final=True)
+        if self.is_array is None:
+            raise json.JSONDecodeError('no json output', '', 0)
+        if not self.is_array:
+            return [json.loads(self._buffer)]
+        if self._state != 'end':
+            raise json.JSONDecodeError('unexpected end of json input', self._buffer, len(self._buffer))
+        return items
+
+
+def iter_json(chunks):
+    """
+    :return: iterator over the items of the json array in chunks of utf-8 bytes, parsed while they arrive
+    """
+    stream = JsonStream()
+    for chunk in chunks:
+        yield from stream.feed(chunk)
+    yield from stream.close()
+
+
+def parse_json_stream(chunks, empty=None):
+    """
+    :param empty: returned for empty input, instead of raising json.JSONDecodeError
+    :return: the json document in chunks of utf-8 bytes, parsed while they arrive
+    """
+    stream = JsonStream()
+    items = []
+    for chunk in chunks:
+        items += stream.feed(chunk)
+    if stream.is_empty() and empty is not None:
+        return empty
+    items += stream.close()
+    return items if stream.is_array else items[0]
+
+
+def _run(argv: [str] or str, consume, input: bytes = None, timeout: float = None, cancel: threading.Event = None, shell: bool = False,
+         inherit_stderr: bool = False):
+    """
+    :param consume: called with the iterator over the stdout chunks, its result is returned once the command succeeded
+    """
+    process = Process(argv, input, timeout, cancel, shell, inherit_stderr)
+    with COMMAND_DURATION.time(program=process.program), tracing.span('exec', program=process.program, command=process.command):
+        try:
+            with process:
+                try:
+                    result = consume(process.read())
+                except ValueError:
+                    # i.e. no json output, because the command failed
+                    process.wait()
+                    raise
+                process.wait()
+        except CommandError:
+            COMMAND_ERRORS.inc(program=process.program)
+            raise
+    return result
+
+
+def _join_output(chunks) -> str:
+    return b''.join(chunks).decode('utf-8').strip('\n')
+
+
+def exec_argv(argv: [str], input: bytes = None, timeout: float = None, cancel: threading.Event = None, inherit_stderr: bool = False) -> str:
+    """
+    Runs a program without a shell.
+
+    :param inherit_stderr: see Process
+    :return: its stdout, without leading / trailing newlines
+    :raises CommandError: see Process.wait
+    """
+    return _run(argv, _join_output, input, timeout, cancel, inherit_stderr=inherit_stderr)
+
+
+def exec_argv_bytes(argv: [str], input: bytes = None, timeout: float = None, cancel: threading.Event = None) -> bytes:
+    """
+    Runs a program without a shell, for binary output.
+
+    :return: its stdout, as is
+    :raises CommandError: see Process.wait
+    """
+    return _run(argv, b''.join, input, timeout, cancel)
+
+
+def exec_argv_json(argv: [str], timeout: float = None, cancel: threading.Event = None, empty=None):
+    """
+    Runs a program without a shell and parses its json output while reading it.
+
+    :param empty: returned if the program does not output anything, instead of raising json.JSONDecodeError
+    """
+    return _run(argv, lambda chunks: parse_json_stream(chunks, empty), timeout=timeout, cancel=cancel)
+
+
+def exec_raw(command: str, timeout: float = None, cancel: threading.Event = None, inherit_stderr: bool = False) -> str:
+    """
+    Runs a shell command line, prefer exec_argv.
+
+    :param inherit_stderr: see Process
+    :return: its stdout, without leading / trailing newlines
+    """
+    return _run(command, _join_output, timeout=timeout, cancel=cancel, shell=True, inherit_stderr=inherit_stderr)
+
+
+def exec_parse_json(command: str, timeout: float = None, cancel: threading.Event = None):
+    """Runs a shell command line and parses its json output, prefer exec_argv_json."""
+    return _run(command, parse_json_stream, timeout=timeout, cancel=cancel, shell=True)
@@ -0,0 +1,182 @@
+import configparser
+import glob
+import json
+import os
+import struct
+from .ceph import Ceph
+from .helper import *
+from .helper import Log as log
+from .proxmox import VM
+from .filesystem import mount_rbd_metadata_image, unmount_rbd_metadata_image
+
+METADATA_STORAGE_FILESYSTEM = 'filesystem'
+METADATA_STORAGE_RAW = 'raw'
+
+# raw format: magic, format version, payload length, followed by the payload (utf-8 json)
+_RAW_MAGIC = b'PRBDMETA'
+_RAW_VERSION = 1
+_raw_header = struct.Struct('<8sII')
+
+
+def get_metadata_image_name(vm_uuid: str):
+    return vm_uuid + '_vm_metadata'
+
+
+def encode_raw_metadata(vm: VM) -> bytes:
+    payload = json.dumps({
+        'vm.id': str(vm.id),
+        'vm.uuid': vm.uuid,
+        'vm.name': vm.name,
+        'config_file': f'{vm.id}.conf',
+        'config': vm.get_config()
+    }).encode('utf-8')
+    return _raw_header.pack(_RAW_MAGIC, _RAW_VERSION, len(payload)) + payload
+
+
+def decode_raw_metadata_header(data: bytes):
+    """
+    :return: payload length, None if data does not start with raw metadata
+    """
+    if len(data) < _raw_header.size:
+        return None
+    magic, version, length = _raw_header.unpack(data[:_raw_header.size])
+    if magic != _RAW_MAGIC:
+        return None
+    if version != _RAW_VERSION:
+        raise RuntimeError(f'unsupported vm metadata format version: {version}')
+    return length
+
+
+class VmMetadata:
+    """
+    Stores the config of a vm in its metadata image in the backup pool. The image is snapshotted together with the
+    disk images, so each restore point contains the vm config of that time.
+
+    Storage modes (config "vm_metadata_storage"):
+    - filesystem: the config is a file on an ext4 filesystem, requires mapping and mounting the image
+    - raw: the config is written directly into the image data (see encode_raw_metadata), without mapping it
+
+    Reading detects the format of each snapshot, so restore points created with either mode can be read.
+    """
+    _ceph: Ceph
+    _pool: str
+    _config: configparser.ConfigParser
+    _storage: str
+
+    def __init__(self, ceph: Ceph, pool: str, config: configparser.ConfigParser):
+        self._ceph = ceph
+        self._pool = pool
+        self._config = config
+        self._storage = config['global'].get('vm_metadata_storage', METADATA_STORAGE_FILESYSTEM)
+        if self._storage not in [METADATA_STORAGE_FILESYSTEM, METADATA_STORAGE_RAW]:
+            raise ArgumentError(f'unknown vm_metadata_storage: {self._storage}')
+
+    def _is_raw(self, image: str, snapshot: str = None):
+        return decode_raw_metadata_header(self._ceph.read_rbd_image(self._pool, image, _raw_header.size, snapshot=snapshot)) is not None
+
+    def _create_image(self, image: str):
+        log.info('metadata image for vm not existing; creating...')
+        self._ceph.create_rbd_image(self._pool, image, self._config['global']['vm_metadata_image_size'])
+        if not self._ceph.is_rbd_image_existing(self._pool, image):
+            raise RuntimeError(f'ceph metadata image for vm is not existing right after creation, this may be a transient error: {image}')
+
+    def write(self, vm: VM):
+        image = get_metadata_image_name(vm.uuid)
+        log.info(f'save current config into vm metadata image of vm {vm.uuid} (id={vm.id}, name={vm.name})')
+        if self._storage == METADATA_STORAGE_RAW:
+            self._write_raw(vm, image)
+        else:
+            self._write_filesystem(vm, image)
+
+    def _write_raw(self, vm: VM, image: str):
+        if not self._ceph.is_rbd_image_existing(self._pool, image):
+            self._create_image(image)
+        data = encode_raw_metadata(vm)
+        log.debug(f'save current config into metadata image -> {self._pool}/{image} ({len(data)} bytes)')
+        self._ceph.write_rbd_image(self._pool, image, data)
+
+    def _write_filesystem(self, vm: VM, image: str):
+        is_vm_metadata_existing = self._ceph.is_rbd_image_existing(self._pool, image)
+
+        # create or update vm metadata image
+        # in case of an error we try to unmount and unmap the vm metadata image
+        try:
+            if not is_vm_metadata_existing:
+                # create vm metadata image
+                self._create_image(image)
+                if 'ceph_backup_disable_rbd_image_features_for_metadata' in self._config['global'] and len(self._config['global']['ceph_backup_disable_rbd_image_features_for_metadata']) > 0:
+                    # disable metadata image features (if needed)
+                    exec_raw(f'rbd feature disable {self._pool}/{image} {" ".join(self._config["global"]["ceph_backup_disable_rbd_image_features_for_metadata"].replace(" ", "").split(","))}')
+            # map metadata image
+            mapped_image_path = self._ceph.map_rbd_image(self._pool, image)
+            if not is_vm_metadata_existing:
+                # format metadata image
+                exec_raw(f'/usr/sbin/mkfs.ext4 -L {image[0:16]} {mapped_image_path}')
+            # mount metadata image
+            try:
+                mount_rbd_metadata_image(image, mapped_image_path)
+            except Exception:
+                # only then check for a raw metadata image (previously written with vm_metadata_storage = raw), it has
+                # to be formatted first
+                if not is_vm_metadata_existing or not self._is_raw(image):
+                    raise
+                log.info(f'vm metadata image {self._pool}/{image} has been written with vm_metadata_storage = raw, format it')
+                exec_raw(f'/usr/sbin/mkfs.ext4 -L {image[0:16]} {mapped_image_path}')
+                mount_rbd_metadata_image(image, mapped_image_path)
+
+            # save current config into metadata image
+            log.debug(f'save current config into metadata image -> /tmp/{image}/{vm.id}.conf')
+            with open(f'/tmp/{image}/{vm.id}.conf', 'w') as config_file:
+                print(vm.get_config(), file=config_file)
+
+            unmount_rbd_metadata_image(image)
+            self._ceph.unmap_rbd_image(self._pool, image)
+        except Exception as e:
+            # noinspection PyBroadException
+            try:
+                unmount_rbd_metadata_image(image)
+            except Exception:
+                pass
+            # noinspection PyBroadException
+            try:
+                self._ceph.unmap_rbd_image(self._pool, image)
+            except Exception:
+                pass
+            raise e
+
+    def read(self, vm_uuid: str, snapshot: str):
+        """
+        :return: {
+            'vm.id': '100',
+            'config_file': '100.conf',
+            'config': 'vm config as in /etc/pve/qemu-server/100.conf'
+        }
+        """
+        image = get_metadata_image_name(vm_uuid)
+        header = self._ceph.read_rbd_image(self._pool, image, _raw_header.size, snapshot=snapshot)
+        length = decode_raw_metadata_header(header)
+        if length is not None:
+            return json.loads(self._ceph.read_rbd_image(self._pool, image, length, offset=_raw_header.size, snapshot=snapshot).decode('utf-8'))
+        return self._read_filesystem(image, snapshot)
+
+    def _read_filesystem(self, image: str, snapshot: str):
+        mount_point = f'{image}-{snapshot}'
+        mapped_image_path = self._ceph.map_rbd_image(self._pool, image, snapshot=snapshot)
+        try:
+            mount_rbd_metadata_image(mount_point, mapped_image_path, read_only=True)
+            try:
+                config_files = glob.glob(f'/tmp/{mount_point}/*.conf')
+                if not config_files:
+                    raise RuntimeError(f'no vm config found in metadata image {self._pool}/{image}@{snapshot}')
+                with open(config_files[0], 'r') as config_file:
+                    config = config_file.read()
+                config_file_name = os.path.basename(config_files[0])
+                return {
+                    'vm.id': config_file_name[:-len('.conf')],
+                    'config_file': config_file_name,
+                    'config': config
+                }
+            finally:
+                unmount_rbd_metadata_image(mount_point)
+        finally:
+            self._ceph.unmap_rbd_image(self._pool, image, snapshot=snapshot)
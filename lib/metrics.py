@@ -0,0 +1,207 @@
+"""
+Prometheus metrics of backup runs, in the text exposition format, without the prometheus_client dependency.
+
+The metrics are written to a node-exporter textfile (metrics_textfile) and / or served over http (metrics_port).
+This module must not import other modules of this package, the helpers use it.
+"""
+import bisect
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'proxmox_rbd_backup_'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def _escape(value: str):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: (str,), values: (str,), extra: str = ''):
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + ([extra] if extra else [])
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value: float):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    name: str
+    help: str
+    label_names: (str,)
+    type = 'untyped'
+    _values: dict
+    _lock: threading.Lock
+
+    def __init__(self, name: str, help: str, label_names: (str,) = ()):
+        self.name = PREFIX + name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict):
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError(f'{self.name} requires the labels {self.label_names}, got {tuple(labels.keys())}')
+        return tuple([str(labels[x]) for x in self.label_names])
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def _render_samples(self) -> [str]:
+        with self._lock:
+            return [f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}' for key, value in sorted(self._values.items())]
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}'] + self._render_samples()
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_to_current_time(self, **labels):
+        self.set(time.time(), **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    buckets: (float,)
+
+    def __init__(self, name: str, help: str, label_names: (str,) = (), buckets: (float,) = DEFAULT_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def _render_samples(self) -> [str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    bucket = 'le="' + _format_value(bound) + '"'
+                    lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, bucket)} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}')
+                lines.append(f'{self.name}_count{_format_labels(self.label_names, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    _metrics: [Metric]
+    _lock: threading.Lock
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join([x.render() for x in metrics]) + '\n'
+
+    def write_textfile(self, path: str):
+        """
+        Writes all metrics to path, atomically (node-exporter must not read a partial file).
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        file, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+        try:
+            with os.fdopen(file, 'w') as output:
+                output.write(self.render())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def start_http_server(self, port: int, address: str = '') -> ThreadingHTTPServer:
+        """
+        Serves the metrics on http://address:port/metrics from a daemon thread.
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        return server
+
+
+REGISTRY = Registry()
+
+RUN_DURATION = REGISTRY.register(Gauge('run_duration_seconds', 'Duration of the last backup run'))
+RUN_LAST_TIMESTAMP = REGISTRY.register(Gauge('run_last_timestamp_seconds', 'End of the last backup run'))
+RUN_VMS = REGISTRY.register(Gauge('run_vms', 'Vms of the last backup run by result', ['status']))
+VM_DURATION = REGISTRY.register(Gauge('vm_duration_seconds', 'Duration of the last backup of a vm', ['vm_uuid', 'vm_name']))
+VM_LAST_SUCCESS = REGISTRY.register(Gauge('vm_last_success_timestamp_seconds', 'End of the last successful backup of a vm', ['vm_uuid', 'vm_name']))
+VM_ERRORS = REGISTRY.register(Counter('vm_errors_total', 'Failed vm backups', ['vm_uuid', 'vm_name']))
+DISK_DURATION = REGISTRY.register(Gauge('disk_duration_seconds', 'Duration of the last transfer of a disk', ['vm_uuid', 'disk', 'mode']))
+DISK_BYTES = REGISTRY.register(Counter('disk_transferred_bytes_total', 'Bytes received from the proxmox nodes (compressed, if compression is used)', ['vm_uuid', 'disk']))
+DISK_COMPRESSION_RATIO = REGISTRY.register(Gauge('disk_compression_ratio', 'Compression ratio of the last transfer of a disk', ['vm_uuid', 'disk']))
+DISK_ERRORS = REGISTRY.register(Counter('disk_errors_total', 'Failed disk transfers', ['vm_uuid', 'disk']))
+SNAPSHOT_WAIT = REGISTRY.register(Histogram('snapshot_wait_seconds', 'Time waited for the rbd snapshot of a proxmox snapshot to appear'))
+METADATA_UPDATE = REGISTRY.register(Histogram('metadata_update_seconds', 'Duration of writing the vm metadata'))
+API_LATENCY = REGISTRY.register(Histogram('proxmox_api_request_seconds', 'Latency of proxmox api requests', ['method']))
+API_ERRORS = REGISTRY.register(Counter('proxmox_api_errors_total', 'Failed proxmox api requests (no response or status >= 400)', ['method']))
+COMMAND_DURATION = REGISTRY.register(Histogram('command_duration_seconds', 'Duration of external commands (exec_raw) by program', ['program']))
+COMMAND_ERRORS = REGISTRY.register(Counter('command_errors_total', 'External commands (exec_raw) exiting with an error, by program', ['program']))
@@ -1,8 +1,37 @@
+import asyncio
 import re
 from ..helper import Cacheable
 from ..helper import Log as log
 from .core import ProxmoxAPI
-import time
+from .aio import AsyncProxmoxAPI
+from .tasks import TaskTracker
+
+# config keys maintained by proxmox itself, they can not be set via api
+READ_ONLY_CONFIG_KEYS = ['digest', 'lock', 'parent', 'snaptime', 'vmstate']
+
+
+def parse_vm_config(config: str) -> {str: str}:
+    """
+    Inverse of VM.set_config / VM.get_config.
+
+    :param config: vm config text, the "#" lines are the description
+    :return: {key: value}, without the snapshot sections
+    """
+    result = {}
+    description = []
+    for line in config.split('\n'):
+        if line.startswith('['):
+            break
+        if line.startswith('#'):
+            description.append(line[1:])
+            continue
+        if ':' not in line:
+            continue
+        key, value = line.split(':', 1)
+        result[key.strip()] = value.strip()
+    if description:
+        result['description'] = '\n'.join(description)
+    return result
 
 
 class Node(Cacheable):
@@ -163,25 +192,63 @@ class VM(Cacheable):
         return self._guest_agent_info
 
 
+class VmFilter:
+    """
+    Selects vm's by id, uuid or name (regex). A vm is selected if it matches any of the given criteria, or if no
+    criteria is given at all.
+    """
+    ids: [str]
+    uuids: [str]
+    name_match: str
+
+    def __init__(self, ids: [str] = None, uuids: [str] = None, name_match: str = None):
+        self.ids = [str(x) for x in ids if x] if ids else []
+        self.uuids = [x for x in uuids if x] if uuids else []
+        self.name_match = name_match
+
+    def is_empty(self):
+        return not self.ids and not self.uuids and not self.name_match
+
+    def requires_config(self):
+        """the uuid of a vm is only known after loading its config"""
+        return len(self.uuids) > 0
+
+    def matches_without_config(self, vm: VM):
+        return str(vm.id) in self.ids or bool(self.name_match and re.match(self.name_match, vm.name))
+
+    def matches(self, vm: VM):
+        return self.is_empty() or self.matches_without_config(vm) or vm.uuid in self.uuids
+
+
 class Proxmox:
     _vms: [VM]
+    _failed_vms: [(VM, Exception)]
     _storages: [Storage]
     _nodes: [Node]
+    _vm_filter: VmFilter
+    _api_concurrency: int
     verify_ssl: bool
     password: str
     user: str
     servers: [str]
     session: ProxmoxAPI
+    async_session: AsyncProxmoxAPI
+    tasks: TaskTracker
 
-    def __init__(self, servers, username, password, verify_ssl=True):
+    def __init__(self, servers, username, password, verify_ssl=True, pool_size=10, api_concurrency=8):
         self.servers = servers if servers else []
         self.user = username
         self.password = password
         self.verify_ssl = verify_ssl
-        self.session = ProxmoxAPI(self.servers[0], 'https', user=self.user, password=self.password, verify_ssl=self.verify_ssl)
+        self.session = ProxmoxAPI(self.servers[0], 'https', user=self.user, password=self.password, verify_ssl=self.verify_ssl, pool_size=max(pool_size, api_concurrency))
+        self._api_concurrency = max(1, api_concurrency)
+        self.async_session = AsyncProxmoxAPI(self.session, self._api_concurrency)
+        self.tasks = TaskTracker(self.session)
         self._nodes = []
         self._storages = []
         self._vms = []
+        self._failed_vms = []
+        self._vm_filter = VmFilter()
 
     def update_nodes(self):
         tmp_nodes = self.session.nodes.get()
@@ -209,27 +276,68 @@ class Proxmox:
     def get_storages(self):
         return self._storages
 
+    def set_vm_filter(self, vm_filter: VmFilter):
+        """only vm's matching this filter are returned by update_vms / get_vms"""
+        self._vm_filter = vm_filter if vm_filter else VmFilter()
+
     def update_vms(self, vms_to_ignore=None):
         if vms_to_ignore is None:
             vms_to_ignore = []
         self._vms = []
+        self._failed_vms = []
         log.info('get vm\'s...')
-        for node in self._nodes:
-            log.info(f'get vm\'s from node {node.id}')
-            tmp_vms = self.session.nodes(node.id).qemu.get()
-            for vm in tmp_vms:
-                tmp_vm = VM(vm['vmid'], name=vm['name'], node=node, status=vm['status'])
-                self.init_vm_config(tmp_vm)
-                log.debug(f'found vm: {tmp_vm}')
-
-                # check if this vm should be excluded according to config
-                if tmp_vm.uuid in vms_to_ignore:
-                    log.debug(f'ignore vm as requested by config ({tmp_vm})')
-                    continue
+        nodes = {node.id: node for node in self._nodes}
+        candidates = []
+        for resource in self.session.cluster.resources.get(type='vm'):
+            if resource.get('type') != 'qemu':
+                continue
+            node = nodes[resource['node']] if resource['node'] in nodes else Node(resource['node'])
+            tmp_vm = VM(resource['vmid'], name=resource.get('name', ''), node=node, status=resource['status'])
+            # skip loading the config of vm's, which are not selected anyway
+            if not self._vm_filter.is_empty() and not self._vm_filter.requires_config() and not self._vm_filter.matches_without_config(tmp_vm):
+                log.debug(f'skip vm, not selected: {tmp_vm}')
+                continue
+            candidates.append(tmp_vm)
 
-                self._vms.append(tmp_vm)
+        log.info(f'get config of {len(candidates)} vm\'s')
+        loaded, self._failed_vms = self.init_vm_configs(candidates)
+        for tmp_vm in loaded:
+            log.debug(f'found vm: {tmp_vm}')
+
+            # check if this vm should be excluded according to config
+            if tmp_vm.uuid in vms_to_ignore:
+                log.debug(f'ignore vm as requested by config ({tmp_vm})')
+                continue
+
+            if not self._vm_filter.matches(tmp_vm):
+                log.debug(f'skip vm, not selected: {tmp_vm}')
+                continue
+
+            self._vms.append(tmp_vm)
         self._vms = sorted(self._vms, key=lambda x: x.id)
 
+    async def init_vm_config_async(self, vm: VM, from_cache: bool = True):
+        if not vm.get_config() or not from_cache:
+            vm.set_config(await self.async_session.nodes(vm.node.id).qemu(vm.id).get('pending'))
+
+    def init_vm_configs(self, vms: [VM], from_cache: bool = True) -> ([VM], [(VM, Exception)]):
+        """
+        loads the config of multiple vm's, using up to api_concurrency parallel requests
+
+        :return: (the vm's whose config was loaded, [(vm, error)] of those failing)
+        """
+        async def init_all():
+            return await asyncio.gather(*[self.init_vm_config_async(vm, from_cache) for vm in vms], return_exceptions=True)
+        loaded = []
+        failed = []
+        for vm, result in zip(vms, asyncio.run(init_all())):
+            if isinstance(result, Exception):
+                log.error(f'could not get the config of {vm}: {result}')
+                failed.append((vm, result))
+                continue
+            loaded.append(vm)
+        return loaded, failed
+
     def init_vm_config(self, vm: VM, from_cache: bool = True):
         if not vm.get_config() or not from_cache:
             vm.set_config(self.session.nodes(vm.node.id).qemu(vm.id).get('pending'))
@@ -237,33 +345,66 @@ class Proxmox:
     def get_vms(self):
         return self._vms
 
+    def get_failed_vms(self) -> [(VM, Exception)]:
+        """
+        :return: [(vm, error)] of the vm's update_vms could not get the config of. Without it, vms_to_ignore and the
+                 vm filter (by uuid) can not be checked, they might have been selected.
+        """
+        return self._failed_vms
+
     def create_vm_snapshot(self, vm: VM, name: str, tries: int):
+        """
+        :param tries: seconds to wait for the snapshot task to complete
+        """
         self.init_vm_config(vm)
         log.info(f'create vm snapshot via proxmox api for {vm}')
         results = self.session.nodes(vm.node).qemu(vm.id).post('snapshot', snapname=name, vmstate=0, description='!!!DO NOT REMOVE!!! automated snapshot by proxmox-rbd-backup. !!!DO NOT REMOVE!!!')
-        if 'UPID' not in results:
+        if not results or 'UPID' not in results:
             raise RuntimeError(f'unexpected result while creating proxmox vm snapshot of {vm} result: {results}')
-        del results
-
-        tries_attempted = tries
-        succeed = False
-        while not succeed and tries > 0:
-            time.sleep(1)
-            tries -= 1
-            results = self.session.nodes(vm.node).qemu(vm.id).get('snapshot')
-            for vm_state in results:
-                if 'name' in vm_state and vm_state['name'] == name:
-                    succeed = True
-                    break
-        del tries, results, vm_state
-
-        if not succeed:
-            raise RuntimeError(f'proxmox vm snapshot creation of {vm} tined out after {tries_attempted} tries')
+
+        self.tasks.wait(self.tasks.track(results), timeout=tries)
         log.debug(f'snapshot creation for {vm} was successful')
 
-    def remove_vm_snapshot(self, vm: VM, name: str):
+    def update_vm_config(self, vm: VM, config: {str: str}, delete: [str] = None, tries: int = None):
+        """
+        :param config: {key: value} to set, see parse_vm_config
+        :param delete: keys to remove from the config
+        :param tries: seconds to wait for the update task to complete
+        """
+        log.info(f'update vm config via proxmox api for {vm}')
+        params = dict(config)
+        if delete:
+            params['delete'] = ','.join(delete)
+        results = self.session.nodes(vm.node).qemu(vm.id).post('config', **params)
+        if results and 'UPID' in results:
+            self.tasks.wait(self.tasks.track(results), timeout=tries)
+        self.init_vm_config(vm, from_cache=False)
+
+    def create_vm(self, node: Node, vm_id: int, config: {str: str}, tries: int = None) -> VM:
+        """
+        :param config: {key: value}, see parse_vm_config; disks refer to existing images
+        :param tries: seconds to wait for the creation task to complete
+        """
+        log.info(f'create vm {vm_id} on node {node} via proxmox api')
+        results = self.session.nodes(node).post('qemu', vmid=vm_id, **config)
+        if not results or 'UPID' not in results:
+            raise RuntimeError(f'unexpected result while creating proxmox vm {vm_id} result: {results}')
+        self.tasks.wait(self.tasks.track(results), timeout=tries)
+        vm = VM(vm_id, name=config.get('name', ''), node=node, status='stopped')
+        self.init_vm_config(vm)
+        self._vms = sorted(self._vms + [vm], key=lambda x: x.id)
+        return vm
+
+    def remove_vm_snapshot(self, vm: VM, name: str, wait: bool = False, tries: int = None, force: bool = False):
+        """
+        :param wait: wait up to tries seconds for the removal task to complete
+        :param force: remove the snapshot from the vm config, even if removing the disk snapshots fails
+        """
         if self.is_snapshot_existing(vm, name):
-            self.session.nodes(vm.node).qemu(vm.id).snapshot(name).delete()
+            results = self.session.nodes(vm.node).qemu(vm.id).snapshot(name).delete(**({'force': 1} if force else {}))
+            if wait and results and 'UPID' in results:
+                self.tasks.wait(self.tasks.track(results), timeout=tries)
+                log.debug(f'snapshot removal of {vm} -> {name} complete')
 
     def get_snapshots(self, vm: VM):
         snapshots = self.session.nodes(vm.node).qemu(vm.id).get('snapshot')
@@ -0,0 +1,73 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .core import ProxmoxResource, ProxmoxResourceBase, ProxmoxAPI
+from ..helper import Log as log
+
+
+class AsyncProxmoxResource(ProxmoxResource):
+    """
+    Same attribute chaining as ProxmoxResource, but get / post / put / delete are coroutines.
+
+    The http requests are executed on a thread pool sharing the keep-alive connection pool and the auth ticket of the
+    ProxmoxAPI this client was created from, so many requests can be in flight at the same time.
+    """
+
+    def _run(self, func, *args, **kwargs):
+        return asyncio.get_running_loop().run_in_executor(self._store["executor"], functools.partial(func, *args, **kwargs))
+
+    async def _request(self, method, data=None, params=None, retries_non_server_error=3, server_error_as_none=False):
+        resp, auth = await self._run(self._send, method, data=data, params=params)
+
+        if resp.status_code == 401:
+            await self._run(self._renew_auth, auth)
+            return await self._request(method, data=data, params=params, server_error_as_none=server_error_as_none)
+
+        if server_error_as_none and resp.status_code >= 500:
+            return None
+
+        if resp.status_code >= 500 and retries_non_server_error > 0:
+            log.warn(f'Received {resp.status_code}, retry {retries_non_server_error} times after waiting 10 seconds')
+            await asyncio.sleep(10)
+            return await self._request(method, data=data, params=params, retries_non_server_error=retries_non_server_error - 1, server_error_as_none=server_error_as_none)
+
+        return self._parse_response(resp)
+
+    async def get(self, *args, server_error_as_none=False, **params):
+        return await self(args)._request("GET", server_error_as_none=server_error_as_none, params=params)
+
+    async def post(self, *args, server_error_as_none=False, **data):
+        return await self(args)._request("POST", server_error_as_none=server_error_as_none, data=data)
+
+    async def put(self, *args, server_error_as_none=False, **data):
+        return await self(args)._request("PUT", server_error_as_none=server_error_as_none, data=data)
+
+    async def delete(self, *args, server_error_as_none=False, **params):
+        return await self(args)._request("DELETE", server_error_as_none=server_error_as_none, params=params)
+
+    async def create(self, *args, server_error_as_none=False, **data):
+        return await self.post(*args, server_error_as_none=server_error_as_none, **data)
+
+    async def set(self, *args, server_error_as_none=False, **data):
+        return await self.put(*args, server_error_as_none=server_error_as_none, **data)
+
+
+class AsyncProxmoxAPI(ProxmoxResourceBase):
+    """
+    Asyncio variant of ProxmoxAPI. Usage:
+
+        api = AsyncProxmoxAPI(ProxmoxAPI(host, user=user, password=password))
+        configs = await asyncio.gather(*[api.nodes(node).qemu(vm_id).get('pending') for vm_id in vm_ids])
+
+    At most concurrency requests are executed at the same time, further requests are queued.
+    """
+    _executor: ThreadPoolExecutor
+
+    def __init__(self, api: ProxmoxAPI, concurrency: int = 8):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='proxmox-api')
+        self._store = api._store.copy()
+        self._store["executor"] = self._executor
+        self._store["resource_class"] = AsyncProxmoxResource
+
+    def close(self):
+        self._executor.shutdown(wait=False)
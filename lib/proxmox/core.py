@@ -3,11 +3,14 @@ __copyright__ = '(c) Oleg Butovich 2013-2017'
 __licence__ = 'MIT'
 
 import posixpath
+import threading
 import time
 
 from requests.cookies import cookiejar_from_dict
 from .https import Backend, ProxmoxHTTPAuth
 from ..helper import Log as log
+from ..metrics import API_LATENCY, API_ERRORS
+from .. import tracing
 from http import client as httplib
 from urllib import parse as urlparse
 basestring = (bytes, str)
@@ -32,7 +35,7 @@ class ProxmoxResourceBase(object):
         kwargs = self._store.copy()
         kwargs['base_url'] = self.url_join(self._store["base_url"], item)
 
-        return ProxmoxResource(**kwargs)
+        return self._store.get("resource_class", ProxmoxResource)(**kwargs)
 
     def url_join(self, base, *args):
         scheme, netloc, path, query, fragment = urlparse.urlsplit(base)
@@ -42,7 +45,11 @@ class ProxmoxResourceBase(object):
 
 
 class ResourceException(Exception):
-    pass
+    status_code: int or None
+
+    def __init__(self, message, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
 
 
 class ProxmoxResource(ProxmoxResourceBase):
@@ -65,51 +72,78 @@ class ProxmoxResource(ProxmoxResourceBase):
 
         return self.__class__(**kwargs)
 
-    def _request(self, method, data=None, params=None, retries_non_server_error=3, server_error_as_none=False):
+    def _send(self, method, data=None, params=None):
+        """
+        :return: (response, auth used for the request)
+        """
         url = self._store["base_url"]
         if data:
-            log.debug(f'{method} {url} {data}')
+            log.debug('%s %s %s', method, url, data)
         else:
-            log.debug(f'{method} {url}')
-        resp = self._store["session"].request(method, url, data=data or None, params=params)
-        log.debug(f'Status code: {resp.status_code}, output: {resp.content}')
-
-        if resp.status_code == 401:
-            log.debug(f'Received 401, the current session may have expired. Retry renewing it.')
-            tmp_url = urlparse.urlparse(self._store["base_url"])
-            tmp_url = f'{tmp_url.scheme}://{tmp_url.netloc}/api2/json'
-            self._store['session'].auth = ProxmoxHTTPAuth(tmp_url,
-                                                          self._store['session'].auth.username,
-                                                          self._store['session'].auth.password,
-                                                          self._store['session'].auth.verify_ssl)
-            self._store['session'].cookies = cookiejar_from_dict({"PVEAuthCookie": self._store['session'].auth.pve_auth_cookie})
-            log.debug('Retry original request.')
-            return self._request(method, data=data, params=params, server_error_as_none=server_error_as_none)
-
-        if server_error_as_none and resp.status_code >= 500:
-            return None
-
-        if resp.status_code >= 500 and retries_non_server_error > 0:
-            log.warn(f'Received {resp.status_code}, retry {retries_non_server_error} times after waiting 10 seconds')
-            time.sleep(10)
-            return self._request(method, data=data, params=params, retries_non_server_error=retries_non_server_error - 1, server_error_as_none=server_error_as_none)
-
+            log.debug('%s %s', method, url)
+        auth = self._store["session"].auth
+        started = time.monotonic()
+        try:
+            with tracing.span('proxmox_api', method=method, url=url):
+                resp = self._store["session"].request(method, url, data=data or None, params=params)
+        except Exception:
+            API_ERRORS.inc(method=method)
+            raise
+        finally:
+            API_LATENCY.observe(time.monotonic() - started, method=method)
+        if resp.status_code >= 400:
+            API_ERRORS.inc(method=method)
+        log.debug('Status code: %s, output: %s', resp.status_code, resp.content)
+        return resp, auth
+
+    def _renew_auth(self, auth):
+        # the session is shared between worker threads, only the first one receiving a 401 renews it
+        with self._store["auth_lock"]:
+            if self._store['session'].auth is auth:
+                log.debug(f'Received 401, the current session may have expired. Retry renewing it.')
+                tmp_url = urlparse.urlparse(self._store["base_url"])
+                tmp_url = f'{tmp_url.scheme}://{tmp_url.netloc}/api2/json'
+                self._store['session'].auth = ProxmoxHTTPAuth(tmp_url,
+                                                              self._store['session'].auth.username,
+                                                              self._store['session'].auth.password,
+                                                              self._store['session'].auth.verify_ssl)
+                self._store['session'].cookies = cookiejar_from_dict({"PVEAuthCookie": self._store['session'].auth.pve_auth_cookie})
+        log.debug('Retry original request.')
+
+    def _parse_response(self, resp):
         if resp.status_code >= 400:
             if hasattr(resp, 'reason'):
                 raise ResourceException("{0} {1}: {2} - {3}".format(
                     resp.status_code,
                     httplib.responses.get(resp.status_code,
                                           ANYEVENT_HTTP_STATUS_CODES.get(resp.status_code)),
-                    resp.reason, resp.content))
+                    resp.reason, resp.content), resp.status_code)
             else:
                 raise ResourceException("{0} {1}: {2}".format(
                     resp.status_code,
                     httplib.responses.get(resp.status_code,
                                           ANYEVENT_HTTP_STATUS_CODES.get(resp.status_code)),
-                    resp.content))
+                    resp.content), resp.status_code)
         elif 200 <= resp.status_code <= 299:
             return self._store["serializer"].loads(resp)
 
+    def _request(self, method, data=None, params=None, retries_non_server_error=3, server_error_as_none=False):
+        resp, auth = self._send(method, data=data, params=params)
+
+        if resp.status_code == 401:
+            self._renew_auth(auth)
+            return self._request(method, data=data, params=params, server_error_as_none=server_error_as_none)
+
+        if server_error_as_none and resp.status_code >= 500:
+            return None
+
+        if resp.status_code >= 500 and retries_non_server_error > 0:
+            log.warn(f'Received {resp.status_code}, retry {retries_non_server_error} times after waiting 10 seconds')
+            time.sleep(10)
+            return self._request(method, data=data, params=params, retries_non_server_error=retries_non_server_error - 1, server_error_as_none=server_error_as_none)
+
+        return self._parse_response(resp)
+
     def get(self, *args, server_error_as_none=False, **params):
         return self(args)._request("GET", server_error_as_none=server_error_as_none, params=params)
 
@@ -140,6 +174,7 @@ class ProxmoxAPI(ProxmoxResourceBase):
             "base_url": self._backend.get_base_url(),
             "session": self._backend.get_session(),
             "serializer": self._backend.get_serializer(),
+            "auth_lock": threading.Lock(),
         }
 
     def get_tokens(self):
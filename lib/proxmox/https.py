@@ -9,6 +9,7 @@ try:
     import requests
     urllib3 = requests.packages.urllib3
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    from requests.adapters import HTTPAdapter
     from requests.auth import AuthBase
     from requests.cookies import cookiejar_from_dict
 except ImportError:
@@ -114,7 +115,7 @@ class ProxmoxHttpSession(requests.Session):
 
 class Backend(object):
     def __init__(self, host, user, password, port=8006, verify_ssl=True,
-                 mode='json', timeout=5, auth_token=None, csrf_token=None):
+                 mode='json', timeout=5, auth_token=None, csrf_token=None, pool_size=10):
         if ':' in host:
             host, host_port = host.split(':')
             port = host_port if host_port.isdigit() else port
@@ -128,10 +129,13 @@ class Backend(object):
         self.verify_ssl = verify_ssl
         self.mode = mode
         self.timeout = timeout
+        self.pool_size = pool_size
 
     def get_session(self):
         session = ProxmoxHttpSession()
         session.verify = self.verify_ssl
+        # one keep-alive connection per concurrent worker
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
         session.auth = self.auth
         session.cookies = cookiejar_from_dict({"PVEAuthCookie": self.auth.pve_auth_cookie})
         session.headers['Connection'] = 'keep-alive'
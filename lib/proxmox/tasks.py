@@ -0,0 +1,132 @@
+import threading
+import time
+from ..helper import Log as log
+from .core import ResourceException
+
+
+class TaskError(RuntimeError):
+    pass
+
+
+class Task:
+    node: str
+    upid: str
+    exitstatus: str or None
+    error: Exception or None
+    errors: int
+    _done: threading.Event
+
+    def __init__(self, upid: str):
+        self.upid = upid
+        # UPID:$node:$pid:$pstart:$starttime:$type:$id:$user:
+        self.node = upid.split(':')[1]
+        self.exitstatus = None
+        self.error = None
+        # consecutive failed status requests
+        self.errors = 0
+        self._done = threading.Event()
+
+    def __str__(self):
+        return self.upid
+
+    def is_done(self):
+        return self._done.is_set()
+
+    def is_successful(self):
+        return self.is_done() and self.exitstatus == 'OK'
+
+
+class TaskTracker:
+    """
+    Tracks the completion of proxmox tasks by their UPID, as returned by i.e. creating or removing a vm snapshot.
+
+    All pending tasks are polled by one shared background thread via nodes/{node}/tasks/{upid}/status. The poll
+    interval starts at min_interval and grows up to max_interval while nothing changes. A failing status request (i.e.
+    a connection reset) is retried with the next poll, the task only fails on a client error (4xx, i.e. an unknown
+    UPID) or after max_errors consecutive failures.
+    """
+    _session: object
+    _min_interval: float
+    _max_interval: float
+    _max_errors: int
+    _pending: [Task]
+    _condition: threading.Condition
+    _thread: threading.Thread or None
+
+    def __init__(self, session, min_interval: float = 0.1, max_interval: float = 2.0, max_errors: int = 30):
+        self._session = session
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._max_errors = max_errors
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def track(self, upid: str) -> Task:
+        task = Task(upid)
+        with self._condition:
+            self._pending.append(task)
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._poll, name='proxmox-tasks', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return task
+
+    def _poll_task(self, task: Task):
+        try:
+            status = self._session.nodes(task.node).tasks(task.upid).get('status')
+        except Exception as error:
+            task.errors += 1
+            if (isinstance(error, ResourceException) and error.status_code is not None and 400 <= error.status_code < 500) or task.errors >= self._max_errors:
+                task.error = error
+                return True
+            log.warn(f'could not get status of proxmox task {task} ({task.errors}. time), retry: {error}')
+            return False
+        task.errors = 0
+        if status['status'] != 'stopped':
+            return False
+        task.exitstatus = status.get('exitstatus', '')
+        return True
+
+    def _poll(self):
+        interval = self._min_interval
+        while True:
+            with self._condition:
+                if not self._pending:
+                    self._thread = None
+                    return
+                pending = list(self._pending)
+
+            changed = False
+            for task in pending:
+                if self._poll_task(task):
+                    log.debug(f'proxmox task {task} finished: {task.exitstatus if task.exitstatus is not None else task.error}')
+                    with self._condition:
+                        self._pending.remove(task)
+                    task._done.set()
+                    changed = True
+
+            with self._condition:
+                interval = self._min_interval if changed else min(interval * 1.5, self._max_interval)
+                # a newly tracked task wakes the poller up
+                if self._condition.wait(interval):
+                    interval = self._min_interval
+
+    def wait(self, task: Task, timeout: float = None) -> Task:
+        """
+        :raises TaskError: if the task did not finish successfully
+        :raises TimeoutError: if the task did not finish within timeout seconds
+        """
+        if not task._done.wait(timeout):
+            raise TimeoutError(f'proxmox task {task} did not finish within {timeout} seconds')
+        if task.error:
+            raise TaskError(f'could not get status of proxmox task {task}: {task.error}')
+        if task.exitstatus != 'OK':
+            raise TaskError(f'proxmox task {task} failed: {task.exitstatus}')
+        return task
+
+    def wait_all(self, tasks: [Task], timeout: float = None) -> [Task]:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for task in tasks:
+            self.wait(task, max(0.0, deadline - time.monotonic()) if deadline is not None else None)
+        return tasks
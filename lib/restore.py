@@ -0,0 +1,499 @@
+import configparser
+import re
+import shlex
+from .ceph import Ceph, Image, create_backend_from_config, get_command_timeout_from_config
+from .helper import *
+from .helper import Log as log
+from .proxmox import Proxmox, Node, VM, VmFilter, READ_ONLY_CONFIG_KEYS, parse_vm_config
+from .restore_point import RestorePoint
+from .scheduler import Scheduler, JobResult, log_summary, JOB_FAILED, JOB_SUCCEEDED
+from .ssh import SshSessionPool, get_session_pool
+from .transfer import run_transfer, TransferStats
+from .transfer.bandwidth import BandwidthGovernor, get_bandwidth_governor
+from .transfer.compression import Codec, parse_codec
+from .transfer.pipeline import ProgressLog
+
+# seconds between the progress messages of a restore
+PROGRESS_INTERVAL = 10
+# image-meta of the backup images of a pending instant restore: the restore point and the disk on the proxmox cluster
+INSTANT_RESTORE_POINT_KEY = 'instant_restore_point'
+INSTANT_RESTORE_TARGET_KEY = 'instant_restore_target'
+
+
+class DiskRestore:
+    """
+    Copy of one vm disk from its backup image back into the pool of the proxmox cluster.
+    """
+    image: Image
+    backup_image: str
+    size: int
+    estimate: int
+    stats: TransferStats or None
+
+    def __init__(self, image: Image, backup_image: str, size: int, estimate: int):
+        """
+        :param image: the disk on the proxmox cluster
+        :param estimate: expected bytes of the export-diff stream, for progress / eta
+        """
+        self.image = image
+        self.backup_image = backup_image
+        self.size = size
+        self.estimate = estimate
+        self.stats = None
+
+    def __str__(self):
+        return str(self.image)
+
+    def get_replaced_name(self):
+        """
+        :return: name the current disk is renamed to during an instant restore
+        """
+        return f'{self.image.name}.replaced'
+
+    def get_temporary_name(self):
+        """
+        :return: name of the image the disk is copied into, it replaces the disk once all disks of the vm are copied
+        """
+        return f'{self.image.name}.restore'
+
+
+class RestorePlan:
+    """
+    The vm and the disks a restore point is restored to, see Restore.plan.
+    """
+    vm_uuid: str
+    restore_point: str
+    timestamp: str
+    vm_id: int
+    vm: VM or None
+    node: Node
+    config: str
+    disks: [DiskRestore]
+    missing: [str]
+
+    def __init__(self, vm_uuid: str, restore_point: str, timestamp: str, vm_id: int, vm: VM or None, node: Node, config: str, disks: [DiskRestore], missing: [str]):
+        """
+        :param vm: None if the vm does not exist anymore
+        :param config: the vm config saved with the restore point
+        :param missing: disks of config without backup image, i.e. "ceph-vm:vm-100-disk-1"
+        """
+        self.vm_uuid = vm_uuid
+        self.restore_point = restore_point
+        self.timestamp = timestamp
+        self.vm_id = vm_id
+        self.vm = vm
+        self.node = node
+        self.config = config
+        self.disks = disks
+        self.missing = missing
+
+    def __str__(self):
+        return f'{self.vm if self.vm else f"vm {self.vm_id}"} from {self.restore_point} ({self.timestamp})'
+
+
+class Restore:
+    """
+    Restores a vm from a restore point: all disks are streamed from the backup pool into temporary images on the
+    proxmox cluster in parallel, then the disks of the vm are replaced and its config is recreated from the one saved
+    with the restore point. The vm is created, if it does not exist anymore.
+
+    An instant restore replaces the disks by live migrations (rbd migration) from the backup snapshots instead, the vm
+    can be started right away, while complete_instant_restore copies the data in the background.
+    """
+    _config: configparser.ConfigParser
+    _ceph: Ceph
+    _servers: [str]
+    _ssh: SshSessionPool
+    _proxmox: Proxmox
+    _restore_point: RestorePoint
+    _governor: BandwidthGovernor
+    _storages_to_ignore: [str]
+    _wait_for_snapshot_tries: int
+
+    def __init__(self, servers: [str], config: configparser.ConfigParser):
+        if is_list_empty(servers):
+            raise ArgumentError('servers must be a list with at least one non-empty element')
+        if config is None:
+            raise ArgumentError('config must not be None')
+        self._servers = servers
+        self._config = config
+        self._ceph = Ceph(create_backend_from_config(config), get_command_timeout_from_config(config))
+        self._proxmox = None
+        self._backup_rbd_pool = self._config['global']['ceph_backup_pool']
+        self._restore_point = RestorePoint(servers, config)
+        self._ssh = get_session_pool(config)
+        self._governor = get_bandwidth_governor(config)
+        self._storages_to_ignore = []
+        if 'ignore_storages' in config['global']:
+            for item in config['global']['ignore_storages'].replace(' ', '').split(','):
+                self._storages_to_ignore.append(item)
+        self._wait_for_snapshot_tries = int(config['global']['wait_for_snapshot_tries'])
+
+    def get_remote_connection_command(self):
+        return self._ssh.get_command(self._servers[0])
+
+    def init_proxmox(self, vm_filter: VmFilter = None):
+        if self._proxmox:
+            return
+        self._proxmox = Proxmox(self._servers, username=self._config['global']['user'], password=self._config['global']['password'], verify_ssl=self._config['global'].getboolean('verify_ssl'))
+        self._proxmox.set_vm_filter(vm_filter)
+        self._proxmox.update_nodes()
+        self._proxmox.update_storages(self._storages_to_ignore)
+        self._proxmox.update_vms()
+
+    def _get_target_vm(self, vm_uuid: str, vm_id: int) -> VM or None:
+        """
+        :return: the vm to restore, None if it does not exist anymore
+        """
+        for vm in self._proxmox.get_vms():
+            if vm.uuid == vm_uuid:
+                if vm.running:
+                    raise RuntimeError(f'{vm} is running, stop it before restoring it')
+                return vm
+        for vm in self._proxmox.get_vms():
+            if vm.id == vm_id:
+                raise RuntimeError(f'vm {vm_uuid} does not exist anymore and its id {vm_id} is used by {vm}')
+        return None
+
+    def _get_node(self, node_id: str = None) -> Node:
+        nodes = self._proxmox.get_nodes()
+        if not node_id:
+            return nodes[0]
+        for node in nodes:
+            if node.id == node_id:
+                return node
+        raise ArgumentError(f'proxmox node {node_id} not found, available: {", ".join([x.id for x in nodes])}')
+
+    def _get_transport_codec(self) -> Codec or None:
+        if not self._config['global'].getboolean('enable_transport_compression_initial', fallback=False):
+            return None
+        setting = self._config['global'].get('transport_compression', 'lz4:-12')
+        # the adaptive selection samples disks on the proxmox nodes, the data of a restore is read from the backup pool
+        return parse_codec('lz4:-12' if setting.strip().lower() == 'adaptive' else setting)
+
+    def _get_estimate(self, image: str, restore_point: str, size: int) -> int:
+        """
+        :return: bytes used by image up to restore_point, at most size
+        """
+        try:
+            used = self._ceph.get_rbd_image_du(self._backup_rbd_pool, image)
+        except Exception as error:
+            log.debug(f'could not get the used bytes of {self._backup_rbd_pool}/{image}: {error}')
+            return size
+        names = self._ceph.get_rbd_snapshot_names(self._backup_rbd_pool, image)
+        total = sum([used.get(x) or 0 for x in names[:names.index(restore_point) + 1]])
+        return min(size, total) if total else size
+
+    def _remove_image(self, pool: str, image: str):
+        remote = self.get_remote_connection_command()
+        self._ceph.remove_rbd_snapshot_all(pool, image, command_inject=remote)
+        self._ceph.remove_rbd_image(pool, image, command_inject=remote)
+
+    def _get_disks(self, vm_uuid: str, vm_id: int, restore_point: str, config: str, backup_images: [str]) -> ([DiskRestore], [str]):
+        """
+        :return: ([DiskRestore], [disks of config without backup image, i.e. "ceph-vm:vm-100-disk-1"])
+        """
+        vm = VM(vm_id, vm_uuid)
+        vm.update_rbd_disks(self._proxmox.get_storages(), config=config)
+        disks = []
+        missing = []
+        for disk in vm.get_rbd_disks():
+            image = rbd_image_from_proxmox_disk(disk)
+            backup_image = f'{vm_uuid}-{image.pool}-{image.name}'
+            if backup_image not in backup_images:
+                log.warn(f'disk {disk} of vm {vm_uuid} has no backup in restore point {restore_point}, it is not restored')
+                missing.append(str(disk))
+                continue
+            size = self._ceph.get_rbd_snapshot(self._backup_rbd_pool, backup_image, restore_point)['size']
+            disks.append(DiskRestore(image, backup_image, size, self._get_estimate(backup_image, restore_point, size)))
+        return disks, missing
+
+    def _copy_disk(self, disk: DiskRestore, restore_point: str, codec: Codec or None, progress: ProgressLog):
+        """
+        Copies the backup image into the temporary image of disk on the proxmox cluster. export-diff without a start
+        snapshot only carries the allocated extents, the temporary image stays sparse.
+        """
+        remote = self.get_remote_connection_command()
+        temporary = disk.get_temporary_name()
+        name = f'restore of {disk.backup_image}@{restore_point} -> {disk.image.pool}/{temporary}'
+        if self._ceph.is_rbd_image_existing(disk.image.pool, temporary, command_inject=remote):
+            log.warn(f'remove image {disk.image.pool}/{temporary} of an earlier restore')
+            self._remove_image(disk.image.pool, temporary)
+        self._ceph.create_rbd_image(disk.image.pool, temporary, f'{disk.size}B', command_inject=remote)
+        stages = [('export', ['rbd', 'export-diff', '--no-progress', f'{self._backup_rbd_pool}/{disk.backup_image}@{restore_point}', '-'])]
+        import_command = f'rbd import-diff --no-progress - {shlex.quote(f"{disk.image.pool}/{temporary}")}'
+        if codec:
+            stages.append(('compress', codec.get_compress_argv()))
+            import_command = f'{shlex.join(codec.get_decompress_argv())} | {import_command}'
+        stages.append(('import', shlex.split(remote) + [import_command]))
+        try:
+            pipeline = run_transfer(name, stages, 'pipeline', parse_size(self._config['global'].get('transfer_pipe_size', '1M')), progress, self._governor, progress_stage=0)
+            # import-diff created the snapshot of the stream, the proxmox vm does not know it
+            self._ceph.remove_rbd_snapshot(disk.image.pool, temporary, restore_point, command_inject=remote)
+        except Exception:
+            log.warn(f'remove incomplete image {disk.image.pool}/{temporary}')
+            self._remove_image(disk.image.pool, temporary)
+            raise
+        log.info(f'{name}: {pipeline.get_summary()}')
+        # received: bytes sent over the network, written: bytes of the disk
+        disk.stats = TransferStats(str(codec) if codec else None, pipeline.stages[-2].bytes, pipeline.stages[0].bytes)
+
+    def _remove_vm_snapshots(self, vm: VM or None, force: bool = False):
+        """
+        the snapshots refer to the disks being replaced
+
+        :param force: remove them from the vm config, even if the disk snapshots are gone already
+        """
+        if not vm:
+            return
+        for snapshot in self._proxmox.get_snapshots(vm):
+            log.warn(f'remove snapshot {snapshot["name"]} of {vm}')
+            self._proxmox.remove_vm_snapshot(vm, snapshot['name'], wait=True, tries=self._wait_for_snapshot_tries, force=force)
+
+    def _replace_disks(self, vm: VM or None, disks: [DiskRestore]):
+        remote = self.get_remote_connection_command()
+        self._remove_vm_snapshots(vm)
+        for disk in disks:
+            if self._ceph.is_rbd_image_existing(disk.image.pool, disk.image.name, command_inject=remote):
+                log.info(f'replace disk {disk} of vm')
+                self._remove_image(disk.image.pool, disk.image.name)
+            self._ceph.rename_rbd_image(disk.image.pool, disk.get_temporary_name(), disk.image.name, command_inject=remote)
+
+    def _restore_config(self, vm: VM or None, vm_id: int, node: Node, config: str, missing: [str]) -> VM:
+        """
+        :param missing: disks which have not been restored, see _get_disks
+        :return: the restored vm
+        """
+        restored = dict([(key, value) for key, value in parse_vm_config(config).items() if key not in READ_ONLY_CONFIG_KEYS])
+        if vm:
+            current = parse_vm_config(vm.get_config())
+            delete = [x for x in current if x not in restored and x not in READ_ONLY_CONFIG_KEYS]
+            self._proxmox.update_vm_config(vm, restored, delete, self._wait_for_snapshot_tries)
+            return vm
+        # a new vm can only refer to existing images
+        for key in list(restored.keys()):
+            if re.match(r'^unused\d+$', key) or restored[key].split(',')[0] in missing:
+                log.warn(f'config "{key}: {restored[key]}" of vm {vm_id} refers to a disk which has not been restored, it is left out')
+                del restored[key]
+        return self._proxmox.create_vm(node, vm_id, restored, self._wait_for_snapshot_tries)
+
+    def _is_latest_restore_point(self, disks: [DiskRestore], restore_point: str):
+        for disk in disks:
+            if self._ceph.get_rbd_snapshot_names(self._backup_rbd_pool, disk.backup_image)[-1:] != [restore_point]:
+                return False
+        return True
+
+    def _continue_backups(self, vm: VM or None, vm_uuid: str, disks: [DiskRestore], restore_point: str):
+        """
+        If restore_point is the latest one of the vm, it is recreated as proxmox snapshot of the restored vm: the disks
+        match the backup images and the next backup of the vm is incremental.
+        """
+        if not self._is_latest_restore_point(disks, restore_point):
+            log.warn(f'{restore_point} is not the latest restore point of vm {vm_uuid}, its next backup requires new backup images (see Readme)')
+        elif vm:
+            self._proxmox.create_vm_snapshot(vm, restore_point, self._wait_for_snapshot_tries)
+
+    def plan(self, vm_uuid: str, restore_point: str, node_id: str = None) -> RestorePlan:
+        """
+        :param node_id: node to create the vm on, if it does not exist anymore; default: the first one
+        :raises RuntimeError: if the vm is running, or if it does not exist anymore and its id or disks are used
+        """
+        detail = self._restore_point.get_restore_point_detail(vm_uuid, restore_point)
+        backup_images = [x['image'].split('/', 1)[1] for x in detail['images']]
+        metadata = self._restore_point.get_restore_point_config(vm_uuid, restore_point)
+        vm_id = int(metadata['vm.id'])
+        self.init_proxmox(VmFilter(ids=[str(vm_id)], uuids=[vm_uuid]))
+        vm = self._get_target_vm(vm_uuid, vm_id)
+        node = vm.node if vm else self._get_node(node_id)
+        disks, missing = self._get_disks(vm_uuid, vm_id, restore_point, metadata['config'], backup_images)
+        if not disks:
+            raise RuntimeError(f'restore point {restore_point} of vm {vm_uuid} has no disks to restore')
+        if not vm:
+            for disk in disks:
+                if self._ceph.is_rbd_image_existing(disk.image.pool, disk.image.name, command_inject=self.get_remote_connection_command()):
+                    raise RuntimeError(f'image {disk.image} exists, but vm {vm_uuid} does not; remove or rename it first')
+        return RestorePlan(vm_uuid, restore_point, detail['timestamp'], vm_id, vm, node, metadata['config'], disks, missing)
+
+    def run(self, vm_uuid: str, restore_point: str, node_id: str = None, skip_config: bool = False) -> [JobResult]:
+        """
+        Restores a vm, which must not be running. Its proxmox snapshots are removed.
+
+        If restore_point is the latest one of the vm, the next backup of the vm is incremental. Otherwise the backup
+        images no longer match the vm, see Readme.
+
+        :param node_id: node to create the vm on, if it does not exist anymore; default: the first one
+        :param skip_config: only restore the disks, keep the current config of the vm
+        :return: one JobResult per restored disk (item: DiskRestore)
+        """
+        plan = self.plan(vm_uuid, restore_point, node_id)
+        log.info(f'restore of {plan} starting, {len(plan.disks)} disks')
+        codec = self._get_transport_codec()
+        progress = ProgressLog(f'restore of vm {vm_uuid}', sum([x.estimate for x in plan.disks]), PROGRESS_INTERVAL)
+        scheduler = Scheduler(self._config['global'].getint('restore_concurrency', fallback=4))
+        results = scheduler.run(plan.disks, lambda disk: self._copy_disk(disk, restore_point, codec, progress), stop_on_error=True)
+        log_summary('restore', results)
+        failed = [x for x in results if x.status == JOB_FAILED]
+        if failed:
+            for result in results:
+                if result.status == JOB_SUCCEEDED:
+                    self._remove_image(result.item.image.pool, result.item.get_temporary_name())
+            raise RuntimeError(f'restore of {failed[0].item} failed: {failed[0].error}') from failed[0].error
+
+        self._replace_disks(plan.vm, plan.disks)
+        vm = plan.vm
+        if skip_config:
+            log.info(f'config of vm {vm_uuid} left unchanged')
+        else:
+            vm = self._restore_config(plan.vm, plan.vm_id, plan.node, plan.config, plan.missing)
+        self._continue_backups(vm, vm_uuid, plan.disks, restore_point)
+        log.info(f'restore of {plan} complete')
+        return results
+
+    def _get_source_spec(self, disk: DiskRestore, restore_point: str) -> dict:
+        """
+        :return: rbd migration source spec of the backup snapshot, read by the proxmox nodes from the backup cluster
+        """
+        return {
+            'type': 'native',
+            'cluster_name': self._config['global'].get('instant_restore_cluster_name', 'backup'),
+            'client_name': self._config['global'].get('instant_restore_client_name', 'client.admin'),
+            'pool_name': self._backup_rbd_pool,
+            'image_name': disk.backup_image,
+            'snap_name': restore_point
+        }
+
+    def run_instant(self, vm_uuid: str, restore_point: str, node_id: str = None, skip_config: bool = False) -> RestorePlan:
+        """
+        Replaces the disks of a vm by live migrations from the backup snapshots of restore_point, like run otherwise.
+        The vm can be started right away, reads of data not copied yet are served by the backup cluster. The backup
+        snapshots are protected until complete_instant_restore is done.
+
+        The backups of the vm continue like after run, the proxmox snapshot is created before the vm is started.
+
+        The current disks are renamed to <disk>.replaced and only removed once every migration has been prepared, if
+        one fails they are renamed back.
+        """
+        if self.get_instant_restores(vm_uuid):
+            raise RuntimeError(f'vm {vm_uuid} has a pending instant restore, complete it first')
+        plan = self.plan(vm_uuid, restore_point, node_id)
+        log.info(f'instant restore of {plan} starting, {len(plan.disks)} disks')
+        remote = self.get_remote_connection_command()
+        replaced = []
+        prepared = []
+        try:
+            for disk in plan.disks:
+                if self._ceph.get_rbd_snapshot(self._backup_rbd_pool, disk.backup_image, restore_point)['protected'] != 'true':
+                    self._ceph.protect_rbd_snapshot(self._backup_rbd_pool, disk.backup_image, restore_point)
+                self._ceph.set_rbd_image_meta_batch(self._backup_rbd_pool, {disk.backup_image: {INSTANT_RESTORE_POINT_KEY: restore_point, INSTANT_RESTORE_TARGET_KEY: str(disk.image)}})
+                if self._ceph.is_rbd_image_existing(disk.image.pool, disk.image.name, command_inject=remote):
+                    self._ceph.rename_rbd_image(disk.image.pool, disk.image.name, disk.get_replaced_name(), command_inject=remote)
+                    replaced.append(disk)
+                self._ceph.prepare_rbd_migration_import(disk.image.pool, disk.image.name, self._get_source_spec(disk, restore_point), command_inject=remote)
+                prepared.append(disk)
+        except Exception:
+            log.error(f'instant restore of {plan} failed, restore the current disks')
+            for disk in prepared:
+                self._ceph.abort_rbd_migration(disk.image.pool, disk.image.name, command_inject=remote)
+            for disk in replaced:
+                self._ceph.rename_rbd_image(disk.image.pool, disk.get_replaced_name(), disk.image.name, command_inject=remote)
+            for disk in plan.disks:
+                meta = self._ceph.list_rbd_image_meta(self._backup_rbd_pool, disk.backup_image)
+                if INSTANT_RESTORE_POINT_KEY in meta:
+                    self._ceph.unprotect_rbd_snapshot(self._backup_rbd_pool, disk.backup_image, restore_point)
+                    for key in [INSTANT_RESTORE_POINT_KEY, INSTANT_RESTORE_TARGET_KEY]:
+                        self._ceph.remove_rbd_image_meta(self._backup_rbd_pool, disk.backup_image, key)
+            raise
+
+        for disk in plan.disks:
+            # the snapshots imported with the backup snapshot, the proxmox vm does not know them
+            backup_snapshots = self._ceph.get_rbd_snapshot_names(self._backup_rbd_pool, disk.backup_image)
+            for snapshot in self._ceph.get_rbd_snapshot_names(disk.image.pool, disk.image.name, command_inject=remote):
+                if snapshot in backup_snapshots:
+                    self._ceph.remove_rbd_snapshot(disk.image.pool, disk.image.name, snapshot, command_inject=remote)
+        # their disk snapshots are on the replaced disks
+        self._remove_vm_snapshots(plan.vm, force=True)
+        for disk in replaced:
+            log.info(f'remove replaced disk {disk.image.pool}/{disk.get_replaced_name()}')
+            self._remove_image(disk.image.pool, disk.get_replaced_name())
+        vm = plan.vm
+        if skip_config:
+            log.info(f'config of vm {vm_uuid} left unchanged')
+        else:
+            vm = self._restore_config(plan.vm, plan.vm_id, plan.node, plan.config, plan.missing)
+        self._continue_backups(vm, vm_uuid, plan.disks, restore_point)
+        log.info(f'instant restore of {plan} prepared, the vm can be started; complete it with "restore complete {vm_uuid}"')
+        return plan
+
+    def get_instant_restores(self, vm_uuid: str = None) -> [dict]:
+        """
+        :param vm_uuid: only those of this vm
+        :return: [{
+            'vm_uuid': '...',
+            'image': 'backup image name',
+            'restore_point': 'restore point name',
+            'target': 'pool/image',  # disk on the proxmox cluster
+            'state': 'prepared',  # of the migration: prepared, executing, executed, ...; none if it is committed, missing if the disk does not exist
+            'size': 1234,  # bytes
+            'used': 1234  # bytes allocated in the disk so far, None if unknown
+        }]
+        """
+        images = [x for x in self._ceph.get_rbd_images(self._backup_rbd_pool) if re.match(f'^({REGEX_GUID})-', x) and (not vm_uuid or x.startswith(f'{vm_uuid}-'))]
+        remote = self.get_remote_connection_command()
+        restores = []
+        for image, meta in sorted(self._ceph.list_rbd_image_meta_batch(self._backup_rbd_pool, images).items()):
+            if INSTANT_RESTORE_POINT_KEY not in meta:
+                continue
+            pool, name = meta[INSTANT_RESTORE_TARGET_KEY].split('/', 1)
+            state, used = 'missing', None
+            if self._ceph.is_rbd_image_existing(pool, name, command_inject=remote):
+                migration = self._ceph.get_rbd_image_status(pool, name, command_inject=remote).get('migration') or {}
+                state = migration.get('state', 'none')
+                try:
+                    used = self._ceph.get_rbd_image_du(pool, name, command_inject=remote).get(None)
+                except Exception as error:
+                    log.debug(f'could not get the used bytes of {pool}/{name}: {error}')
+            restores.append({
+                'vm_uuid': image[:36],
+                'image': image,
+                'restore_point': meta[INSTANT_RESTORE_POINT_KEY],
+                'target': meta[INSTANT_RESTORE_TARGET_KEY],
+                'state': state,
+                'size': self._ceph.get_rbd_snapshot(self._backup_rbd_pool, image, meta[INSTANT_RESTORE_POINT_KEY])['size'],
+                'used': used
+            })
+        return restores
+
+    def _complete_disk(self, restore: dict):
+        """
+        :param restore: see get_instant_restores
+        """
+        remote = self.get_remote_connection_command()
+        pool, name = restore['target'].split('/', 1)
+        if restore['state'] in ['prepared', 'executing']:
+            self._ceph.execute_rbd_migration(pool, name, command_inject=remote)
+        if restore['state'] not in ['none', 'missing']:
+            self._ceph.commit_rbd_migration(pool, name, command_inject=remote)
+        self._ceph.unprotect_rbd_snapshot(self._backup_rbd_pool, restore['image'], restore['restore_point'])
+        for key in [INSTANT_RESTORE_POINT_KEY, INSTANT_RESTORE_TARGET_KEY]:
+            self._ceph.remove_rbd_image_meta(self._backup_rbd_pool, restore['image'], key)
+
+    def complete_instant_restore(self, vm_uuid: str) -> [JobResult]:
+        """
+        Copies the data of the disks of an instant restore not copied yet and detaches them from the backup snapshots.
+        The vm may be running meanwhile.
+
+        :return: one JobResult per disk (item: see get_instant_restores)
+        """
+        restores = self.get_instant_restores(vm_uuid)
+        if not restores:
+            raise RuntimeError(f'vm {vm_uuid} has no pending instant restore')
+        restore_point = restores[0]['restore_point']
+        log.info(f'completion of the instant restore of vm {vm_uuid} from {restore_point} starting, {len(restores)} disks')
+        scheduler = Scheduler(self._config['global'].getint('restore_concurrency', fallback=4))
+        results = scheduler.run(restores, self._complete_disk)
+        log_summary('instant restore completion', results)
+        failed = [x for x in results if x.status == JOB_FAILED]
+        if failed:
+            raise RuntimeError(f'completion of the instant restore of {failed[0].item["target"]} failed: {failed[0].error}') from failed[0].error
+        log.info(f'instant restore of vm {vm_uuid} from {restore_point} complete')
+        return results
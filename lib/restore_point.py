@@ -1,18 +1,23 @@
 import configparser
 import re
 
-from lib.ceph import Ceph
+from lib.ceph import Ceph, create_backend_from_config, get_command_timeout_from_config
 from .helper import Log as log, Time
 from lib.helper import is_list_empty, ArgumentError
 from lib.proxmox import Proxmox
-from datetime import datetime
+from .ssh import SshSessionPool, get_session_pool
+from .metadata import VmMetadata
+from .catalog import Catalog, get_catalog
+from .retention import Pruner
 
 
 class RestorePoint:
     _config: configparser.ConfigParser
     _ceph: Ceph
     _servers: [str]
-    _remote_connection_command: str
+    _ssh: SshSessionPool
+    _metadata: VmMetadata
+    _catalog: Catalog
     _proxmox: Proxmox
     _storages_to_ignore: [str]
     _vms_to_ignore: [str]
@@ -24,10 +29,12 @@ class RestorePoint:
             raise ArgumentError('config must not be None')
         self._servers = servers
         self._config = config
-        self._ceph = Ceph()
+        self._ceph = Ceph(create_backend_from_config(config), get_command_timeout_from_config(config))
         self._proxmox = None
         self._backup_rbd_pool = self._config['global']['ceph_backup_pool']
-        self._remote_connection_command = f'ssh {config["global"]["proxmox_ssh_user"]}@{servers[0]} -T -o Compression=no -x'
+        self._metadata = VmMetadata(self._ceph, self._backup_rbd_pool, config)
+        self._ssh = get_session_pool(config)
+        self._catalog = get_catalog(config)
         self._storages_to_ignore = []
         self._vms_to_ignore = []
         if 'ignore_storages' in config['global']:
@@ -37,6 +44,9 @@ class RestorePoint:
             if 'ignore' in config[section] and config[section]['ignore']:
                 self._vms_to_ignore.append(section)
 
+    def get_remote_connection_command(self):
+        return self._ssh.get_command(self._servers[0])
+
     def init_proxmox(self):
         if self._proxmox:
             return
@@ -45,6 +55,11 @@ class RestorePoint:
         self._proxmox.update_storages(self._storages_to_ignore)
         self._proxmox.update_vms(self._vms_to_ignore)
 
+    def _get_catalog(self):
+        if not self._catalog.is_synced(self._backup_rbd_pool):
+            self._catalog.resync(self._ceph, self._backup_rbd_pool)
+        return self._catalog
+
     def get_restore_points(self, vm_uuid: str):
         """
         :return: [
@@ -58,14 +73,12 @@ class RestorePoint:
         image = f'{vm_uuid}_vm_metadata'
         tmp_points = []
 
-        snapshots = self._ceph.get_rbd_snapshots(self._backup_rbd_pool, image)
-        for snapshot in snapshots:
+        for point in self._get_catalog().get_restore_points(self._backup_rbd_pool, vm_uuid):
             tmp_points.append({
                 'image': f'{self._backup_rbd_pool}/{image}',
-                "name": snapshot['name'],
-                "timestamp": snapshot['timestamp']
+                "name": point['name'],
+                "timestamp": point['timestamp']
             })
-        tmp_points = sorted(tmp_points, key=lambda x: datetime.strptime(x['timestamp'], '%a %b %d %H:%M:%S %Y'))
         return tmp_points
 
     def get_restore_point_detail(self, vm_uuid: str, restore_point: str, backup=None):
@@ -81,78 +94,81 @@ class RestorePoint:
             ]
         }
         """
-        images = self._ceph.get_rbd_images(self._backup_rbd_pool)
+        point = self._get_catalog().get_restore_point(self._backup_rbd_pool, vm_uuid, restore_point)
+        if not point:
+            raise RuntimeError(f'restore point {restore_point} of vm {vm_uuid} not found')
         tmp_images = []
         result = {
             'has_proxmox_snapshot': False,
             'images': tmp_images,
-            'timestamp': self._ceph.get_rbd_snapshot(self._backup_rbd_pool, f'{vm_uuid}_vm_metadata', restore_point)['timestamp']
+            'timestamp': point['timestamp']
         }
 
-        for image in images:
-            if vm_uuid and vm_uuid not in image:
-                continue
-            points = self._ceph.get_rbd_snapshots(self._backup_rbd_pool, image)
-            for point in points:
-                if restore_point != point['name']:
-                    continue
-                tmp_images.append({
-                    'image': f'{self._backup_rbd_pool}/{image}',
-                    "name": point['name']
-                })
+        for image in point['images']:
+            tmp_images.append({
+                'image': f'{self._backup_rbd_pool}/{image}',
+                "name": restore_point
+            })
         if backup:
             result['has_proxmox_snapshot'] = backup.is_vm_snapshot_existing(backup.get_vm(vm_uuid), restore_point)
         return result
 
+    def get_restore_point_config(self, vm_uuid: str, restore_point: str):
+        """
+        :return: the vm config saved with the restore point, see VmMetadata.read
+        """
+        return self._metadata.read(vm_uuid, restore_point)
+
     def remove_restore_point(self, vm_uuid: str = None, restore_point: str = None, age: str = None, match: str = None, backup=None):
         if not vm_uuid and not restore_point and not age and not match:
             raise ArgumentError('at least one parameter must be set; vm_uuid, restore_point, age or match')
         if vm_uuid and not (restore_point or age or match):
             raise ArgumentError('if vm_uuid is set, restore_point, age or match must be set')
 
-        points_to_remove = []
-        images = self._ceph.get_rbd_images(self._backup_rbd_pool)
+        pruner = Pruner(self._ceph, self._get_catalog(), self._backup_rbd_pool, self._config)
+        plan = pruner.plan(vm_uuid, [restore_point] if restore_point else None, age, match)
+        pruner.execute(plan, backup if vm_uuid else None)
 
-        for image in images:
-            if vm_uuid and vm_uuid not in image:
-                continue
-            points = self._ceph.get_rbd_snapshots(self._backup_rbd_pool, image)
-            for point in points:
-                if restore_point and restore_point != point['name']:
-                    continue
-                if age and not Time(point['timestamp']).is_older_than(age):
-                    continue
-                if match and not re.match(match, point['name']):
-                    continue
-                points_to_remove.append({
-                    'image': image,
-                    'restore_point': point['name']
-                })
-
-        for point in points_to_remove:
-            log.info(f'remove {point["restore_point"]} from image {self._backup_rbd_pool}/{point["image"]}')
-            self._ceph.remove_rbd_snapshot(self._backup_rbd_pool, point["image"], point["restore_point"])
-            if backup and vm_uuid:
-                backup.remove_vm_snapshot(backup.get_vm(vm_uuid), point['restore_point'])
+    def prune(self, vm_uuid: str = None, age: str = None, match: str = None, dry_run: bool = False, backup=None):
+        """
+        Removes the restore points not kept by the retention policies (retention_keep_* in the vm section or [global]).
+
+        :return: {
+            'points': {vm_uuid: [restore_point_name]},
+            'reclaimable': {image: {restore_point_name: bytes}}  # only on dry run
+        }
+        """
+        pruner = Pruner(self._ceph, self._get_catalog(), self._backup_rbd_pool, self._config)
+        plan = pruner.plan(vm_uuid, age=age, match=match, apply_policy=True)
+        result = {
+            'points': dict([(uuid, sorted(names)) for uuid, names in plan.points.items()]),
+            'reclaimable': {}
+        }
+        if dry_run:
+            result['reclaimable'] = pruner.get_reclaimable(plan)
+        elif not plan.is_empty():
+            pruner.execute(plan, backup)
+        return result
 
     def remove_restore_point_all(self, vm_uuid: str = None, backup=None):
         if not vm_uuid:
             raise ArgumentError('at least one parameter must be set; vm_uuid')
 
-        images = self._ceph.get_rbd_images(self._backup_rbd_pool)
+        images = self._ceph.get_rbd_images_by_prefix(self._backup_rbd_pool, vm_uuid)
 
+        points = set()
         for image in images:
-            if vm_uuid and vm_uuid not in image:
-                continue
-            points = self._ceph.get_rbd_snapshots(self._backup_rbd_pool, image)
-            for point in points:
-                backup.remove_vm_snapshot(backup.get_vm(vm_uuid), point['name'])
+            points.update(self._ceph.get_rbd_snapshot_names(self._backup_rbd_pool, image))
+        vm = backup.get_vm(vm_uuid)
+        for point in sorted(points):
+            backup.remove_vm_snapshot(vm, point)
 
+        for image in images:
             self._ceph.remove_rbd_snapshot_all(self._backup_rbd_pool, image)
+            self._catalog.remove_snapshots(self._backup_rbd_pool, image)
 
     def remove_backup(self, vm_uuid: str):
-        images = self._ceph.get_rbd_images(self._backup_rbd_pool)
+        images = self._ceph.get_rbd_images_by_prefix(self._backup_rbd_pool, vm_uuid if vm_uuid else '')
         for image in images:
-            if vm_uuid and vm_uuid not in image:
-                continue
             self._ceph.remove_rbd_image(self._backup_rbd_pool, image)
+            self._catalog.remove_image(self._backup_rbd_pool, image)
@@ -0,0 +1,230 @@
+import configparser
+import re
+import time
+from datetime import datetime
+from .catalog import Catalog
+from .ceph import Ceph
+from .helper import convert_to_seconds
+from .helper import Log as log
+from .scheduler import Scheduler, log_summary, JOB_FAILED
+
+_POLICY_KEYS = ['keep_last', 'keep_daily', 'keep_weekly', 'keep_monthly']
+# restore point names are the snapshot name prefix of the backup run plus 16 random hex digits
+REGEX_RESTORE_POINT_PREFIX = r'^(.*)[0-9a-f]{16}$'
+
+
+def get_restore_point_prefix(name: str) -> str:
+    """
+    :return: the snapshot name prefix a restore point was created with, i.e. "backup_daily_"
+    """
+    match = re.match(REGEX_RESTORE_POINT_PREFIX, name)
+    return match.group(1) if match else name
+
+
+class RetentionPolicy:
+    """
+    Grandfather-father-son retention: keeps the newest keep_last restore points, plus the newest restore point of each
+    of the last keep_daily days, keep_weekly iso weeks and keep_monthly months which have restore points.
+    """
+    keep_last: int
+    keep_daily: int
+    keep_weekly: int
+    keep_monthly: int
+
+    def __init__(self, keep_last: int = 0, keep_daily: int = 0, keep_weekly: int = 0, keep_monthly: int = 0):
+        self.keep_last = keep_last
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+        self.keep_monthly = keep_monthly
+
+    def __str__(self):
+        return ', '.join([f'{key}={getattr(self, key)}' for key in _POLICY_KEYS])
+
+    def is_empty(self):
+        return not any([getattr(self, key) for key in _POLICY_KEYS])
+
+    def select(self, points: [dict]) -> {str}:
+        """
+        :param points: [{"name": "restore_point_name", "time": unix_time}]
+        :return: names of the restore points to keep
+        """
+        points = sorted(points, key=lambda x: x['time'] or 0, reverse=True)
+        keep = set([x['name'] for x in points[:self.keep_last]])
+        for count, get_period in [(self.keep_daily, lambda x: x.date()),
+                                  (self.keep_weekly, lambda x: x.isocalendar()[:2]),
+                                  (self.keep_monthly, lambda x: (x.year, x.month))]:
+            periods = set()
+            for point in points:
+                if len(periods) >= count:
+                    break
+                period = get_period(datetime.fromtimestamp(point['time'] or 0))
+                if period not in periods:
+                    periods.add(period)
+                    keep.add(point['name'])
+        return keep
+
+
+def get_retention_policy(config: configparser.ConfigParser, vm_uuid: str) -> RetentionPolicy:
+    """
+    retention_keep_last / _daily / _weekly / _monthly of the section of the vm (vm SMBIOS uuid), falling back to [global]
+    """
+    values = {}
+    for key in _POLICY_KEYS:
+        value = 0
+        for section in [vm_uuid, 'global']:
+            if section in config and f'retention_{key}' in config[section]:
+                value = config[section].getint(f'retention_{key}')
+                break
+        values[key] = value
+    return RetentionPolicy(**values)
+
+
+class PrunePlan:
+    """
+    The restore points to remove, computed before anything is removed.
+    """
+    snapshots: {str: [str]}
+    images: {str: str}
+    points: {str: {str}}
+    kept: {str: {str}}
+    removed: {str: {str}}
+
+    def __init__(self):
+        # image -> snapshot names
+        self.snapshots = {}
+        # image -> vm uuid
+        self.images = {}
+        # vm uuid -> restore point names
+        self.points = {}
+        # vm uuid -> restore point names kept by the retention policy
+        self.kept = {}
+        # image -> snapshot names removed by Pruner.execute
+        self.removed = {}
+
+    def add(self, vm_uuid: str, image: str, snapshot: str):
+        self.snapshots.setdefault(image, []).append(snapshot)
+        self.images[image] = vm_uuid
+        self.points.setdefault(vm_uuid, set()).add(snapshot)
+
+    def is_empty(self):
+        return len(self.snapshots) == 0
+
+
+class Pruner:
+    """
+    Removes restore points in bulk: the removal set is computed up front from the catalog, then backup snapshots are
+    removed in parallel (one job per image) and proxmox snapshots in parallel (one job per vm, as proxmox locks the vm
+    while removing a snapshot).
+    """
+    _ceph: Ceph
+    _catalog: Catalog
+    _pool: str
+    _config: configparser.ConfigParser
+    _concurrency: int
+
+    def __init__(self, ceph: Ceph, catalog: Catalog, pool: str, config: configparser.ConfigParser):
+        self._ceph = ceph
+        self._catalog = catalog
+        self._pool = pool
+        self._config = config
+        self._concurrency = config['global'].getint('prune_concurrency', fallback=8)
+
+    def plan(self, vm_uuid: str = None, restore_points: [str] = None, age: str = None, match: str = None, apply_policy: bool = False) -> PrunePlan:
+        """
+        :param restore_points: only these restore points
+        :param age: only restore points older than this timespan, i.e.: 15m, 3h, 7d, 3M, 1y
+        :param match: only restore points whose name matches this regex
+        :param apply_policy: keep the restore points selected by the retention policy of each vm, vm's without a policy
+                             are left alone. The newest restore point of each snapshot name prefix of a vm is always
+                             kept, as the next incremental backup with that prefix is based on it.
+        """
+        snapshots = self._catalog.get_snapshots(self._pool, vm_uuid)
+        min_time = time.time() - convert_to_seconds(age) if age else None
+
+        # candidates, grouped by vm
+        vms = {}
+        for snapshot in snapshots:
+            if restore_points and snapshot['name'] not in restore_points:
+                continue
+            if match and not re.match(match, snapshot['name']):
+                continue
+            vms.setdefault(snapshot['vm_uuid'], []).append(snapshot)
+
+        result = PrunePlan()
+        for uuid, vm_snapshots in vms.items():
+            kept = set()
+            if apply_policy:
+                policy = get_retention_policy(self._config, uuid)
+                if policy.is_empty():
+                    log.debug(f'no retention policy for vm {uuid}, skip')
+                    continue
+                points = {}
+                for snapshot in vm_snapshots:
+                    if snapshot['name'] not in points or (snapshot['time'] or 0) < (points[snapshot['name']]['time'] or 0):
+                        points[snapshot['name']] = snapshot
+                kept = policy.select(list(points.values()))
+                prefixes = {}
+                for point in points.values():
+                    prefixes.setdefault(get_restore_point_prefix(point['name']), []).append(point)
+                for prefix_points in prefixes.values():
+                    kept.update(RetentionPolicy(keep_last=1).select(prefix_points))
+                log.debug(f'retention policy of vm {uuid} ({policy}) keeps {len(kept)} of {len(points)} restore points')
+            result.kept[uuid] = kept
+            for snapshot in vm_snapshots:
+                if snapshot['name'] in kept:
+                    continue
+                if min_time is not None and (snapshot['time'] is None or snapshot['time'] >= min_time):
+                    continue
+                result.add(uuid, snapshot['image'], snapshot['name'])
+        return result
+
+    def get_reclaimable(self, plan: PrunePlan) -> {str: {str: int}}:
+        """
+        Estimates the space freed by the plan using the per snapshot usage ("rbd du"). The data of a removed
+        snapshot that is still referenced by the next one is not freed, so this is an upper bound.
+
+        :return: {image: {snapshot: bytes}}
+        """
+        result = {}
+        for image, snapshot_names in plan.snapshots.items():
+            usage = self._ceph.get_rbd_image_du(self._pool, image)
+            result[image] = {x: usage.get(x, 0) for x in snapshot_names}
+        return result
+
+    def _remove_image_snapshots(self, plan: PrunePlan, image: str):
+        for snapshot in plan.snapshots[image]:
+            log.info(f'remove {snapshot} from image {self._pool}/{image}')
+            self._ceph.remove_rbd_snapshot(self._pool, image, snapshot)
+            self._catalog.remove_snapshot(self._pool, image, snapshot)
+            plan.removed.setdefault(image, set()).add(snapshot)
+
+    @staticmethod
+    def _remove_vm_snapshots(backup, vm, snapshot_names: {str}):
+        existing = set([x['name'] for x in backup.get_vm_snapshots(vm)])
+        for snapshot in sorted(snapshot_names & existing):
+            backup.remove_vm_snapshot(vm, snapshot)
+
+    def execute(self, plan: PrunePlan, backup=None):
+        """
+        :param backup: if set, remove the proxmox snapshots of the removed restore points, too; those with a backup
+                       snapshot left, because its removal failed, are kept
+        :raises RuntimeError: if any removal failed, after all others have been done
+        """
+        scheduler = Scheduler(self._concurrency)
+        results = scheduler.run(list(plan.snapshots.keys()), lambda x: self._remove_image_snapshots(plan, x))
+        log_summary('remove backup snapshots', results)
+        failed = len([x for x in results if x.status == JOB_FAILED])
+
+        if backup:
+            # vm uuid -> restore points with a backup snapshot left
+            remaining = {}
+            for image, snapshot_names in plan.snapshots.items():
+                remaining.setdefault(plan.images[image], set()).update(set(snapshot_names) - plan.removed.get(image, set()))
+            vms = dict([(x.uuid, x) for x in backup.get_vms_proxmox()])
+            items = [(vms[uuid], names - remaining.get(uuid, set())) for uuid, names in plan.points.items() if uuid in vms]
+            results = scheduler.run(items, lambda x: self._remove_vm_snapshots(backup, x[0], x[1]))
+            log_summary('remove proxmox snapshots', results)
+            failed += len([x for x in results if x.status == JOB_FAILED])
+
+        if failed:
+            raise RuntimeError(f'{failed} removal jobs failed, see summary above')
@@ -0,0 +1,148 @@
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from .helper import Log as log
+from .tracing import TRACER
+
+JOB_SUCCEEDED = 'succeeded'
+JOB_SKIPPED = 'skipped'
+JOB_FAILED = 'failed'
+
+
+class JobError(RuntimeError):
+    """
+    An expected failure of a job (i.e. a failed disk transfer), logged without a traceback. If reported, it has been
+    logged already (i.e. by a nested Scheduler.run) and is only recorded in the results.
+    """
+    reported: bool
+
+    def __init__(self, message: str, reported: bool = False):
+        super().__init__(message)
+        self.reported = reported
+
+
+class JobResult:
+    item: object
+    status: str
+    error: Exception or None
+    started: datetime
+    finished: datetime
+
+    def __init__(self, item, status: str, started: datetime, finished: datetime, error: Exception = None):
+        self.item = item
+        self.status = status
+        self.started = started
+        self.finished = finished
+        self.error = error
+
+    def get_duration(self):
+        return self.finished - self.started
+
+
+class Scheduler:
+    """
+    Runs jobs on a pool of worker threads.
+
+    The number of jobs running at the same time is limited globally and, optionally, per key group (i.e. per proxmox
+    node or per ceph pool). A limit of 0 means unlimited. Jobs are started in the given order, a job whose key groups
+    are saturated is skipped over until a slot becomes free, so it does not block an unrelated job behind it.
+    """
+    _concurrency: int
+    _group_limits: {str: int}
+
+    def __init__(self, concurrency: int = 1, group_limits: {str: int} = None):
+        self._concurrency = max(1, concurrency)
+        self._group_limits = group_limits if group_limits else {}
+
+    def _can_start(self, groups: {str: [str]}, running: {(str, str): int}):
+        for group, keys in groups.items():
+            limit = self._group_limits.get(group, 0)
+            if limit <= 0:
+                continue
+            for key in keys:
+                if running.get((group, key), 0) >= limit:
+                    return False
+        return True
+
+    @staticmethod
+    def _update_running(groups: {str: [str]}, running: {(str, str): int}, delta: int):
+        for group, keys in groups.items():
+            for key in keys:
+                running[(group, key)] = running.get((group, key), 0) + delta
+
+    @staticmethod
+    def _run_job(func, item, parent_span=None):
+        started = datetime.now()
+        try:
+            # spans of the job are children of the span that started the jobs
+            with TRACER.attach(parent_span):
+                status = JOB_SUCCEEDED if func(item) is not False else JOB_SKIPPED
+            return JobResult(item, status, started, datetime.now())
+        except JobError as error:
+            if not error.reported:
+                log.error(str(error))
+                log.debug(traceback.format_exc())
+            return JobResult(item, JOB_FAILED, started, datetime.now(), error=error)
+        except Exception as error:
+            log.error(f'unexpected exception while processing {item} (probably a bug): {error}')
+            log.error(traceback.format_exc())
+            return JobResult(item, JOB_FAILED, started, datetime.now(), error=error)
+
+    def run(self, items: [object], func, get_groups=None, stop_on_error: bool = False) -> [JobResult]:
+        """
+        :param func: called with one item per job; returning False marks the job as skipped, raising marks it as failed
+        :param get_groups: called with one item, returns {group_name: [key, ...]} used for the per group limits
+        :param stop_on_error: do not start any further jobs after one failed, they are marked as skipped
+        :return: one JobResult per item, in the order of items
+        """
+        pending = []
+        for index, item in enumerate(items):
+            groups = {}
+            if get_groups:
+                # noinspection PyBroadException
+                try:
+                    groups = get_groups(item)
+                except Exception as error:
+                    log.debug(f'could not determine scheduling groups of {item}: {error}')
+            pending.append((index, item, groups))
+
+        results = {}
+        running = {}
+        futures = {}
+        parent_span = TRACER.get_current_span()
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            while pending or futures:
+                for entry in list(pending):
+                    if len(futures) >= self._concurrency:
+                        break
+                    index, item, groups = entry
+                    if not self._can_start(groups, running):
+                        continue
+                    pending.remove(entry)
+                    self._update_running(groups, running, 1)
+                    futures[executor.submit(self._run_job, func, item, parent_span)] = entry
+
+                done, _ = wait(futures.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, item, groups = futures.pop(future)
+                    self._update_running(groups, running, -1)
+                    results[index] = future.result()
+                    if stop_on_error and results[index].status == JOB_FAILED:
+                        for index, item, groups in pending:
+                            results[index] = JobResult(item, JOB_SKIPPED, datetime.now(), datetime.now())
+                        pending.clear()
+
+        return [results[index] for index in range(len(items))]
+
+
+def log_summary(name: str, results: [JobResult]):
+    succeeded = [x for x in results if x.status == JOB_SUCCEEDED]
+    skipped = [x for x in results if x.status == JOB_SKIPPED]
+    failed = [x for x in results if x.status == JOB_FAILED]
+    if results:
+        duration = max(map(lambda x: x.finished, results)) - min(map(lambda x: x.started, results))
+    else:
+        duration = 0
+    log.info(f'{name} summary: {len(succeeded)} succeeded, {len(skipped)} skipped, {len(failed)} failed, took {duration}')
+    for result in results:
+        log.info(f'  {result.status:>9}  {result.get_duration()}  {result.item}' + (f': {result.error}' if result.error else ''))
@@ -0,0 +1,156 @@
+import atexit
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from .helper import Log as log
+
+_session_pools = {}
+_session_pools_lock = threading.Lock()
+# seconds the ssh master control commands may take beyond the connect timeout
+CONTROL_TIMEOUT = 10
+
+
+class SshSessionPool:
+    """
+    Keeps one multiplexed ssh master connection (ControlMaster / ControlPersist) per host, so remote commands do not
+    have to do a ssh handshake each.
+
+    Masters are opened on first use, health-checked at most every health_check_interval seconds and re-opened if they
+    went away. All of them are closed at interpreter exit. Each host has its own lock, a host not answering (up to
+    connect_timeout seconds) only holds up the workers using that host.
+    """
+    _user: str
+    _options: str
+    _enabled: bool
+    _control_persist: str
+    _health_check_interval: int
+    _connect_timeout: int
+    _control_dir: str or None
+    _last_checked: {str: float}
+    _unavailable: {str}
+    _host_locks: {str: threading.Lock}
+    _lock: threading.Lock
+
+    def __init__(self, user: str, options: str = '-T -o Compression=no -x', enabled: bool = True, control_persist: str = '10m', health_check_interval: int = 30,
+                 connect_timeout: int = 10):
+        self._user = user
+        self._options = options
+        self._enabled = enabled
+        self._control_persist = control_persist
+        self._health_check_interval = health_check_interval
+        self._connect_timeout = connect_timeout
+        self._control_dir = None
+        self._last_checked = {}
+        self._unavailable = set()
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    def _get_destination(self, host: str):
+        return f'{self._user}@{host}'
+
+    def _get_control_path(self, host: str):
+        with self._lock:
+            if not self._control_dir:
+                self._control_dir = tempfile.mkdtemp(prefix='proxmox-rbd-backup-ssh-')
+            return os.path.join(self._control_dir, self._get_destination(host))
+
+    def _get_host_lock(self, host: str) -> threading.Lock:
+        with self._lock:
+            if host not in self._host_locks:
+                self._host_locks[host] = threading.Lock()
+            return self._host_locks[host]
+
+    def _control(self, host: str, operation: str):
+        try:
+            return subprocess.call(['ssh', '-o', f'ControlPath={self._get_control_path(host)}', '-O', operation, self._get_destination(host)],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=CONTROL_TIMEOUT) == 0
+        except subprocess.TimeoutExpired:
+            log.debug(f'ssh -O {operation} for {self._get_destination(host)} timed out')
+            return False
+
+    def is_alive(self, host: str):
+        return self._control(host, 'check')
+
+    def open(self, host: str):
+        log.debug(f'open ssh master connection to {self._get_destination(host)}')
+        try:
+            code = subprocess.call(['ssh', '-o', 'ControlMaster=yes', '-o', f'ControlPath={self._get_control_path(host)}', '-o', f'ControlPersist={self._control_persist}',
+                                    '-o', f'ConnectTimeout={self._connect_timeout}', '-o', 'BatchMode=yes', '-o', 'Compression=no', '-x', '-f', '-N',
+                                    self._get_destination(host)], timeout=self._connect_timeout + CONTROL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            raise RuntimeError(f'could not open ssh master connection to {self._get_destination(host)}, timed out')
+        if code != 0:
+            raise RuntimeError(f'could not open ssh master connection to {self._get_destination(host)}, code: {code}')
+        with self._lock:
+            self._last_checked[host] = time.monotonic()
+
+    def close(self, host: str):
+        with self._get_host_lock(host):
+            with self._lock:
+                if host not in self._last_checked:
+                    return
+                del self._last_checked[host]
+            log.debug(f'close ssh master connection to {self._get_destination(host)}')
+            self._control(host, 'exit')
+
+    def close_all(self):
+        with self._lock:
+            hosts = list(self._last_checked.keys())
+        for host in hosts:
+            self.close(host)
+        if self._control_dir:
+            shutil.rmtree(self._control_dir, ignore_errors=True)
+            self._control_dir = None
+
+    def _ensure_master(self, host: str):
+        with self._get_host_lock(host):
+            with self._lock:
+                last_checked = self._last_checked.get(host)
+            if last_checked is not None and time.monotonic() - last_checked < self._health_check_interval:
+                return
+            if last_checked is not None and self.is_alive(host):
+                with self._lock:
+                    self._last_checked[host] = time.monotonic()
+                return
+            if last_checked is not None:
+                log.warn(f'ssh master connection to {self._get_destination(host)} went away, re-open it')
+            self.open(host)
+
+    def get_command(self, host: str) -> str:
+        """
+        :return: ssh command (without the remote command) to run a command on the given host
+        """
+        if not self._enabled or host in self._unavailable:
+            return f'ssh {self._get_destination(host)} {self._options}'
+        try:
+            self._ensure_master(host)
+        except Exception as error:
+            log.warn(f'{error}; continue without connection multiplexing')
+            self._unavailable.add(host)
+            return f'ssh {self._get_destination(host)} {self._options}'
+        # ControlMaster=auto: if the master dies between health checks, the next command becomes the new master
+        return f'ssh -o ControlMaster=auto -o ControlPath={self._get_control_path(host)} -o ControlPersist={self._control_persist} {self._get_destination(host)} {self._options}'
+
+
+def get_session_pool(config) -> SshSessionPool:
+    """
+    :return: the ssh session pool shared by everything using the same config within this process
+    """
+    user = config['global']['proxmox_ssh_user']
+    with _session_pools_lock:
+        if user not in _session_pools:
+            _session_pools[user] = SshSessionPool(user,
+                                                  enabled=config['global'].getboolean('ssh_multiplexing', fallback=True),
+                                                  control_persist=config['global'].get('ssh_control_persist', '10m'),
+                                                  connect_timeout=config['global'].getint('ssh_connect_timeout', fallback=10))
+        return _session_pools[user]
+
+
+@atexit.register
+def _close_session_pools():
+    with _session_pools_lock:
+        for pool in _session_pools.values():
+            pool.close_all()
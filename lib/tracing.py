@@ -0,0 +1,205 @@
+"""
+Span based tracing of the phases of a backup run, for a profile of where the wall time went (see Tracer.get_profile)
+and an export as Chrome trace (chrome://tracing, Perfetto) or OTLP JSON.
+
+Tracing is off until Tracer.enable is called, span() costs next to nothing then. This module must not import other
+modules of this package, the helpers use it.
+"""
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Span:
+    name: str
+    attributes: dict
+    parent: object
+    span_id: int
+    trace_id: int
+    thread_id: int
+    thread_name: str
+    start: float
+    end: float or None
+    error: str or None
+    _started: float
+    _children_duration: float
+
+    def __init__(self, name: str, attributes: dict, parent=None):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.span_id = random.getrandbits(64)
+        self.trace_id = parent.trace_id if parent else random.getrandbits(128)
+        self.thread_id = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.start = time.time()
+        self.end = None
+        self.error = None
+        self._started = time.monotonic()
+        self._children_duration = 0.0
+
+    def __str__(self):
+        return self.name
+
+    def finish(self):
+        self.end = self.start + (time.monotonic() - self._started)
+        if self.parent:
+            with _children_lock:
+                self.parent._children_duration += self.get_duration()
+
+    def get_duration(self):
+        return (self.end if self.end is not None else time.time()) - self.start
+
+    def get_self_duration(self):
+        """
+        :return: duration without the time spent in child spans, can be negative if children ran in parallel
+        """
+        return self.get_duration() - self._children_duration
+
+
+_children_lock = threading.Lock()
+
+
+class Tracer:
+    """
+    Collects finished spans. The current span is tracked per thread, attach() makes a span of another thread the parent
+    of the spans created by this one (see Scheduler).
+    """
+    enabled: bool
+    _spans: [Span]
+    _lock: threading.Lock
+    _local: threading.local
+
+    def __init__(self):
+        self.enabled = False
+        self._spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        with self._lock:
+            self._spans = []
+
+    def get_spans(self) -> [Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def get_current_span(self) -> Span or None:
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def attach(self, parent: Span or None):
+        """
+        Makes parent the current span of this thread, for work done on behalf of it.
+        """
+        if not self.enabled or parent is None:
+            yield
+            return
+        stack = getattr(self._local, 'stack', None)
+        self._local.stack = [parent]
+        try:
+            yield
+        finally:
+            self._local.stack = stack
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        if not self.enabled:
+            yield None
+            return
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        span = Span(name, attributes, self.get_current_span())
+        self._local.stack.append(span)
+        try:
+            yield span
+        except BaseException as error:
+            span.error = f'{type(error).__name__}: {error}'
+            raise
+        finally:
+            self._local.stack.pop()
+            span.finish()
+            with self._lock:
+                self._spans.append(span)
+
+    def get_profile(self) -> [dict]:
+        """
+        Wall time per span name, ordered by total time. Self is the time not spent in child spans. Share is relative to
+        the wall time of the root spans; spans running in parallel (i.e. disks, vm's) add up to more than 100%.
+
+        :return: [{"Phase": name, "Count": n, "Total": seconds, "Self": seconds, "Max": seconds, "Share": percent, "Errors": n}]
+        """
+        spans = self.get_spans()
+        wall = sum([x.get_duration() for x in spans if x.parent is None])
+        phases = {}
+        for span in spans:
+            phase = phases.setdefault(span.name, {'Phase': span.name, 'Count': 0, 'Total': 0.0, 'Self': 0.0, 'Max': 0.0, 'Share': 0.0, 'Errors': 0})
+            phase['Count'] += 1
+            phase['Total'] += span.get_duration()
+            phase['Self'] += max(0.0, span.get_self_duration())
+            phase['Max'] = max(phase['Max'], span.get_duration())
+            phase['Errors'] += 1 if span.error else 0
+        for phase in phases.values():
+            phase['Share'] = phase['Total'] * 100 / wall if wall > 0 else 0.0
+        return sorted(phases.values(), key=lambda x: x['Total'], reverse=True)
+
+    def export_chrome(self, path: str):
+        """
+        Writes the spans in the Chrome trace event format, one row per thread.
+        """
+        pid = os.getpid()
+        events = []
+        threads = {}
+        for span in self.get_spans():
+            threads[span.thread_id] = span.thread_name
+            args = dict([(key, str(value)) for key, value in span.attributes.items()])
+            if span.error:
+                args['error'] = span.error
+            events.append({'name': span.name, 'cat': span.name.split('.')[0], 'ph': 'X', 'pid': pid, 'tid': span.thread_id,
+                           'ts': int(span.start * 1e6), 'dur': int(span.get_duration() * 1e6), 'args': args})
+        for thread_id, thread_name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread_id, 'args': {'name': thread_name}})
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+    def export_otlp(self, path: str, service_name: str = 'proxmox-rbd-backup'):
+        """
+        Writes the spans as OTLP JSON (ExportTraceServiceRequest), i.e. for the file receiver of the opentelemetry collector.
+        """
+        spans = []
+        for span in self.get_spans():
+            entry = {
+                'traceId': f'{span.trace_id:032x}',
+                'spanId': f'{span.span_id:016x}',
+                'name': span.name,
+                'kind': 1,
+                'startTimeUnixNano': str(int(span.start * 1e9)),
+                'endTimeUnixNano': str(int((span.start + span.get_duration()) * 1e9)),
+                'attributes': [{'key': key, 'value': {'stringValue': str(value)}} for key, value in span.attributes.items()],
+                'status': {'code': 2, 'message': span.error} if span.error else {'code': 1}
+            }
+            if span.parent:
+                entry['parentSpanId'] = f'{span.parent.span_id:016x}'
+            spans.append(entry)
+        with open(path, 'w') as file:
+            json.dump({'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service_name}}]},
+                'scopeSpans': [{'scope': {'name': __name__}, 'spans': spans}]
+            }]}, file)
+
+
+TRACER = Tracer()
+
+
+def span(name: str, **attributes):
+    """
+    Context manager tracing the enclosed block as a child of the current span, see Tracer.span.
+    """
+    return TRACER.span(name, **attributes)
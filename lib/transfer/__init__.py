@@ -0,0 +1,72 @@
+import base64
+import os
+import shlex
+from ..helper import exec_raw, ArgumentError
+from ..helper import Log as log
+from .pipeline import Pipeline
+
+_scripts = {}
+
+
+def remote_python_command(script: str, *args) -> str:
+    """
+    :param script: file name of a self-contained python script in this package, i.e. rbd_read_range.py
+    :return: shell command running the script on a remote system with python3, without copying it there first
+    """
+    if script not in _scripts:
+        with open(os.path.join(os.path.dirname(__file__), script), 'rb') as file:
+            _scripts[script] = base64.b64encode(file.read()).decode('ascii')
+    bootstrap = f'import base64; exec(base64.b64decode("{_scripts[script]}"))'
+    return ' '.join(['python3', '-c', shlex.quote(bootstrap)] + [shlex.quote(str(x)) for x in args])
+
+
+class TransferStats:
+    """
+    Bytes of a transfer: received from the proxmox node (compressed, if a codec is used) and written to the backup image.
+    """
+    codec: str or None
+    received: int or None
+    written: int or None
+
+    def __init__(self, codec: str = None, received: int = None, written: int = None):
+        self.codec = codec
+        self.received = received
+        self.written = written
+
+    def add(self, pipeline: Pipeline or None):
+        """adds the bytes of a pipeline whose first stage receives the data and whose last stage writes it"""
+        if pipeline is None:
+            return
+        self.received = (self.received or 0) + pipeline.stages[0].bytes
+        self.written = (self.written or 0) + pipeline.stages[-2].bytes
+
+    def get_ratio(self):
+        """
+        :return: compression ratio achieved, None if not known
+        """
+        if not self.received or self.written is None:
+            return None
+        return self.written / self.received
+
+
+def run_transfer(name: str, stages: [(str, [str])], engine: str = 'pipeline', pipe_size: int = 1024 * 1024, on_progress=None, governor=None, progress_stage: int = -2):
+    """
+    Runs the stages connected stdout to stdin.
+
+    :param stages: [(name, argv)]
+    :param engine: pipeline (see Pipeline) or shell (a bash pipeline, without statistics and bandwidth limit)
+    :param governor: BandwidthGovernor, for the pipeline engine
+    :param progress_stage: see Pipeline
+    :return: the finished Pipeline with the statistics of each stage, None with the shell engine
+    """
+    if engine == 'shell':
+        command = ' | '.join([' '.join([shlex.quote(x) for x in argv]) for _, argv in stages])
+        # like the shell pipelines of Backup, the stages (i.e. pv, the remote rbd) report to the terminal
+        exec_raw(f'/bin/bash -c {shlex.quote("set -o pipefail; " + command)}', inherit_stderr=True)
+        return None
+    if engine != 'pipeline':
+        raise ArgumentError(f'unknown transfer engine: {engine}')
+    pipeline = Pipeline(name, stages, pipe_size, on_progress, governor, progress_stage)
+    pipeline.run()
+    log.debug(f'{name} complete; {pipeline.get_summary()}')
+    return pipeline
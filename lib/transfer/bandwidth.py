@@ -0,0 +1,142 @@
+import threading
+import time
+from datetime import datetime
+from ..helper import *
+from ..helper import Log as log
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def _parse_time(value: str) -> int:
+    """
+    :return: minutes since midnight
+    """
+    hours, _, minutes = value.strip().partition(':')
+    return int(hours) * 60 + int(minutes or 0)
+
+
+def parse_bandwidth_schedule(value: str) -> [(int or None, int or None, int)]:
+    """
+    :param value: comma separated "[HH:MM-HH:MM] rate" entries, rate in bytes per second (i.e. 200M), 0 or unlimited
+                  for no limit. An entry without time range applies outside of all time ranges, a time range may wrap
+                  around midnight, i.e. "08:00-18:00 200M, 18:00-22:00 500M, 0".
+    :return: [(start minute, end minute, bytes per second)], None / None for the default entry
+    """
+    schedule = []
+    for entry in [x.strip() for x in (value or '').split(',') if x.strip()]:
+        parts = entry.split()
+        if len(parts) > 2:
+            raise ArgumentError(f'invalid bandwidth limit entry: {entry}')
+        rate = 0 if parts[-1].lower() == 'unlimited' else parse_size(parts[-1])
+        if len(parts) == 1:
+            schedule.append((None, None, rate))
+            continue
+        start, _, end = parts[0].partition('-')
+        if not end:
+            raise ArgumentError(f'invalid bandwidth limit time range: {parts[0]}')
+        schedule.append((_parse_time(start), _parse_time(end), rate))
+    return schedule
+
+
+def get_scheduled_rate(schedule: [(int or None, int or None, int)], now: datetime) -> int:
+    """
+    :return: bytes per second at time now, 0 for unlimited
+    """
+    minute = now.hour * 60 + now.minute
+    default = 0
+    for start, end, rate in schedule:
+        if start is None:
+            default = rate
+        elif start <= minute < end or (end <= start and (minute >= start or minute < end)):
+            return rate
+    return default
+
+
+class BandwidthGovernor:
+    """
+    Token bucket shared by all transfers of this process, limiting the bytes received from the proxmox nodes per second.
+
+    Every stream takes tokens for the data it has just forwarded and waits while the bucket is in debt. Waiting
+    streams are served first come, first served and take at most a pipe buffer at a time, so the budget is split
+    evenly between the streams which are not limited by something else. The limit follows a time of day schedule and
+    can be replaced at runtime (set_schedule), waiting streams pick up the new limit right away.
+    """
+    _schedule: [(int or None, int or None, int)]
+    _burst: float
+    _tokens: float
+    _updated: float
+    _rate: int
+    _queue: [object]
+    _condition: threading.Condition
+
+    def __init__(self, schedule: [(int or None, int or None, int)] = None, burst: float = 0.5):
+        """
+        :param burst: seconds of the limit an idle bucket can accumulate
+        """
+        self._schedule = schedule if schedule else []
+        self._burst = burst
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._rate = 0
+        self._queue = []
+        self._condition = threading.Condition(threading.RLock())
+
+    def set_schedule(self, schedule: [(int or None, int or None, int)]):
+        with self._condition:
+            self._schedule = schedule
+            self._condition.notify_all()
+
+    def get_rate(self) -> int:
+        """
+        :return: current limit in bytes per second, 0 for unlimited
+        """
+        return get_scheduled_rate(self._schedule, datetime.now())
+
+    def is_limited(self):
+        return any([rate > 0 for _, _, rate in self._schedule])
+
+    def _refill(self, now: float):
+        rate = self.get_rate()
+        if rate != self._rate:
+            log.info(f'transfer bandwidth limit: {sizeof_fmt(rate) + "/s" if rate else "unlimited"}')
+            self._rate = rate
+        if rate > 0:
+            self._tokens = min(self._tokens + (now - self._updated) * rate, rate * self._burst)
+        else:
+            self._tokens = 0.0
+        self._updated = now
+
+    def consume(self, count: int):
+        """
+        Takes count tokens, blocks until the bucket is out of debt.
+        """
+        if not self.is_limited():
+            return
+        ticket = object()
+        with self._condition:
+            self._queue.append(ticket)
+            try:
+                while True:
+                    self._refill(time.monotonic())
+                    if self._rate <= 0:
+                        return
+                    if self._queue[0] is ticket and self._tokens >= 0:
+                        self._tokens -= count
+                        return
+                    # woken early by a new schedule or when the stream in front is done
+                    self._condition.wait(max(0.001, -self._tokens / self._rate) if self._queue[0] is ticket else None)
+            finally:
+                self._queue.remove(ticket)
+                self._condition.notify_all()
+
+
+def get_bandwidth_governor(config) -> BandwidthGovernor:
+    """
+    :return: the governor shared by all transfers within this process, see transfer_bandwidth_limit
+    """
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = BandwidthGovernor(parse_bandwidth_schedule(config['global'].get('transfer_bandwidth_limit', '0')))
+        return _governor
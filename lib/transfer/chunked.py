@@ -0,0 +1,191 @@
+import shlex
+import threading
+from ..ceph import Ceph, Image
+from ..helper import *
+from ..helper import Log as log
+from ..scheduler import Scheduler, JOB_FAILED
+from . import remote_python_command, run_transfer, TransferStats
+from .compression import Codec
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# image-meta of a backup image whose resumable copy has not completed yet
+CHECKPOINT_SNAPSHOT_KEY = 'initial_copy.snapshot'
+CHECKPOINT_CHUNK_SIZE_KEY = 'initial_copy.chunk_size'
+CHECKPOINT_DONE_KEY = 'initial_copy.done'
+
+
+def encode_ranges(values: {int}) -> str:
+    """
+    :return: i.e. "0-5,7,9-12" for {0, 1, 2, 3, 4, 5, 7, 9, 10, 11, 12}
+    """
+    ranges = []
+    for value in sorted(values):
+        if ranges and ranges[-1][1] == value - 1:
+            ranges[-1][1] = value
+        else:
+            ranges.append([value, value])
+    return ','.join([str(x[0]) if x[0] == x[1] else f'{x[0]}-{x[1]}' for x in ranges])
+
+
+def decode_ranges(value: str) -> {int}:
+    result = set()
+    for item in [x for x in (value or '').split(',') if x]:
+        first, _, last = item.partition('-')
+        result.update(range(int(first), int(last or first) + 1))
+    return result
+
+
+class ChunkedCopy:
+    """
+    Full copy of a snapshot of a source image into a new image of the backup cluster. The image is split into chunks,
+    which are transferred over several parallel streams.
+
+    Each chunk is read on the proxmox node by rbd_read_range.py and written locally with "rbd import-diff". The target
+    image is created with the layering feature only, so the parallel writers do not have to hand over the exclusive
+    lock to each other. The other features are enabled once all chunks are written.
+
+    A resumable copy records the completed chunks (an import-diff that has exited is durable) in the image-meta of the
+    target image and keeps the target image if it fails. A later run for the same snapshot only copies the remaining
+    chunks, see get_checkpoint.
+    """
+    _ceph: Ceph
+    _remote_command: str
+    _source: Image
+    _snapshot: str
+    _target_pool: str
+    _target_image: str
+    _size: int
+    _streams: int
+    _chunk_size: int
+    _codec: Codec or None
+    _features: [str]
+    _engine: str
+    _pipe_size: int
+    _governor: object
+    _resumable: bool
+    _done: int
+    _completed: {int}
+    _stats: TransferStats
+    _lock: threading.Lock
+
+    def __init__(self, ceph: Ceph, remote_command: str, source: Image, snapshot: str, target_pool: str, target_image: str, size: int,
+                 streams: int = 4, chunk_size: int = 4 * 1024 ** 3, codec: Codec = None, features: [str] = None, engine: str = 'shell', pipe_size: int = 1024 * 1024,
+                 governor=None, resumable: bool = False):
+        """
+        :param remote_command: command to run a command on the proxmox node, i.e. "ssh root@host"
+        :param size: size of the source image in bytes
+        :param chunk_size: bytes per chunk, rounded up to a multiple of BLOCK_SIZE
+        :param codec: transport compression, None for none
+        :param features: rbd image features to enable on the target image after the copy
+        :param engine: transfer engine, see run_transfer
+        :param governor: BandwidthGovernor shared by the streams
+        :param resumable: record the progress in the image-meta of the target image, keep the target image on failure
+        """
+        self._ceph = ceph
+        self._remote_command = remote_command
+        self._source = source
+        self._snapshot = snapshot
+        self._target_pool = target_pool
+        self._target_image = target_image
+        self._size = size
+        self._streams = max(1, streams)
+        self._chunk_size = max(1, -(-chunk_size // BLOCK_SIZE)) * BLOCK_SIZE
+        self._codec = codec
+        self._features = features if features else []
+        self._engine = engine
+        self._pipe_size = pipe_size
+        self._governor = governor
+        self._resumable = resumable
+        self._done = 0
+        # indexes of the chunks already in the target image
+        self._completed = set()
+        self._stats = TransferStats(str(codec) if codec else None)
+        self._lock = threading.Lock()
+
+    def get_chunks(self) -> [(int, int)]:
+        """
+        :return: [(offset, length)]
+        """
+        return [(offset, min(self._chunk_size, self._size - offset)) for offset in range(0, self._size, self._chunk_size)]
+
+    def get_checkpoint(self) -> {int} or None:
+        """
+        :return: indexes of the chunks completed by an earlier run of this copy, None if there is nothing to resume
+        """
+        if not self._ceph.is_rbd_image_existing(self._target_pool, self._target_image):
+            return None
+        meta = self._ceph.list_rbd_image_meta(self._target_pool, self._target_image) or {}
+        if meta.get(CHECKPOINT_SNAPSHOT_KEY) != self._snapshot or meta.get(CHECKPOINT_CHUNK_SIZE_KEY) != str(self._chunk_size):
+            return None
+        return decode_ranges(meta.get(CHECKPOINT_DONE_KEY))
+
+    def _save_checkpoint(self):
+        self._ceph.set_rbd_image_meta_batch(self._target_pool, {self._target_image: {
+            CHECKPOINT_SNAPSHOT_KEY: self._snapshot,
+            CHECKPOINT_CHUNK_SIZE_KEY: str(self._chunk_size),
+            CHECKPOINT_DONE_KEY: encode_ranges(self._completed)
+        }})
+
+    def _remove_checkpoint(self):
+        for key in [CHECKPOINT_SNAPSHOT_KEY, CHECKPOINT_CHUNK_SIZE_KEY, CHECKPOINT_DONE_KEY]:
+            self._ceph.remove_rbd_image_meta(self._target_pool, self._target_image, key)
+
+    def _copy_chunk(self, chunk: (int, int), count: int):
+        offset, length = chunk
+        remote = remote_python_command('rbd_read_range.py', self._source.pool, self._source.name, self._snapshot, offset, offset + length, BLOCK_SIZE)
+        if self._codec:
+            remote += f' | {self._codec.get_compress_command()}'
+        stages = [('read', shlex.split(self._remote_command) + [remote])]
+        if self._codec:
+            stages.append(('decompress', self._codec.get_decompress_argv()))
+        stages.append(('import-diff', ['rbd', 'import-diff', '--no-progress', '-', f'{self._target_pool}/{self._target_image}']))
+        pipeline = run_transfer(f'full copy of {self._source}@{self._snapshot} at offset {offset}', stages, self._engine, self._pipe_size, governor=self._governor)
+        with self._lock:
+            self._done += 1
+            self._stats.add(pipeline)
+            self._completed.add(offset // self._chunk_size)
+            if self._resumable:
+                self._save_checkpoint()
+            log.debug(f'full copy of {self._source}@{self._snapshot}: chunk {self._done}/{count} at offset {offset} done')
+
+    def run(self):
+        """
+        :return: TransferStats, without byte counts for the shell engine
+        """
+        chunks = self.get_chunks()
+        checkpoint = self.get_checkpoint() if self._resumable else None
+        if checkpoint is not None:
+            self._completed = set([x for x in checkpoint if x < len(chunks)])
+            log.info(f'resume full copy of {self._source}@{self._snapshot}, {len(self._completed)} of {len(chunks)} chunks already copied')
+        else:
+            log.info(f'full copy of {self._source}@{self._snapshot} ({sizeof_fmt(self._size)}) in {len(chunks)} chunks over {min(self._streams, max(1, len(chunks)))} streams')
+            self._ceph.create_rbd_image(self._target_pool, self._target_image, f'{self._size}B', features=['layering'])
+            if self._resumable:
+                self._save_checkpoint()
+        remaining = [x for index, x in enumerate(chunks) if index not in self._completed]
+        self._done = len(chunks) - len(remaining)
+        try:
+            results = Scheduler(self._streams).run(remaining, lambda x: self._copy_chunk(x, len(chunks)), stop_on_error=True)
+            for result in results:
+                if result.status == JOB_FAILED:
+                    raise RuntimeError(f'full copy of {self._source}@{self._snapshot}, chunk at offset {result.item[0]} failed: {result.error}') from result.error
+            if self._features:
+                self._ceph.enable_rbd_image_features(self._target_pool, self._target_image, self._features)
+        except Exception:
+            if self._resumable:
+                log.warn(f'full copy of {self._source}@{self._snapshot} failed after {len(self._completed)} of {len(chunks)} chunks, '
+                         f'keep {self._target_pool}/{self._target_image} to resume')
+                raise
+            # an incomplete image would block the next (initial) backup of this disk
+            log.warn(f'remove incomplete image {self._target_pool}/{self._target_image}')
+            # noinspection PyBroadException
+            try:
+                self._ceph.remove_rbd_image(self._target_pool, self._target_image)
+            except Exception:
+                pass
+            raise
+        if self._resumable:
+            self._remove_checkpoint()
+        self._ceph.invalidate_rbd_inventory(self._target_pool, self._target_image)
+        return self._stats
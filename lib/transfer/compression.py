@@ -0,0 +1,148 @@
+import json
+import shlex
+import time
+from ..helper import *
+from ..helper import Log as log
+from . import remote_python_command
+
+# compression on the proxmox node, decompression on the backup host
+_COMMANDS = {
+    'lz4': (['lz4', '-z', '-q', '-c'], ['lz4', '-d', '-q', '-c']),
+    'zstd': (['zstd', '-q', '-c'], ['zstd', '-d', '-q', '-c'])
+}
+
+
+class Codec:
+    """
+    A transport compression codec and level. Negative levels are "--fast" levels (lz4 and zstd), i.e. lz4:-12 is
+    "lz4 --fast=12".
+    """
+    name: str
+    level: int
+
+    def __init__(self, name: str, level: int):
+        if name not in _COMMANDS:
+            raise ArgumentError(f'unknown compression codec: {name}')
+        self.name = name
+        self.level = level
+
+    def __str__(self):
+        return f'{self.name}:{self.level}'
+
+    def __eq__(self, other):
+        return isinstance(other, Codec) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def get_compress_argv(self):
+        return _COMMANDS[self.name][0] + [f'--fast={-self.level}' if self.level < 0 else f'-{self.level}']
+
+    def get_compress_command(self):
+        """
+        :return: shell command (for the proxmox node) compressing stdin to stdout
+        """
+        return ' '.join([shlex.quote(x) for x in self.get_compress_argv()])
+
+    def get_decompress_argv(self):
+        return list(_COMMANDS[self.name][1])
+
+
+def parse_codec(value: str) -> Codec or None:
+    """
+    :param value: "none", codec ("zstd", level 1) or codec:level ("zstd:3", "lz4:-12")
+    :return: None for no compression
+    """
+    value = value.strip().lower()
+    if value in ['', 'none']:
+        return None
+    name, _, level = value.partition(':')
+    try:
+        return Codec(name, int(level) if level else 1)
+    except ValueError:
+        raise ArgumentError(f'invalid compression level: {value}')
+
+
+def parse_codecs(value: str) -> [Codec]:
+    return [x for x in [parse_codec(x) for x in value.split(',')] if x]
+
+
+class Sample:
+    """
+    Sampled blocks of an image and the state of the proxmox node they were read on.
+    """
+    data: bytes
+    cpus: int
+    load: float
+    codecs: [str]
+
+    def __init__(self, data: bytes, cpus: int = 1, load: float = 0.0, codecs: [str] = None):
+        self.data = data
+        self.cpus = cpus
+        self.load = load
+        # codecs installed on the proxmox node
+        self.codecs = codecs if codecs is not None else list(_COMMANDS.keys())
+
+    def get_idle_cpus(self):
+        return max(0.0, self.cpus - self.load)
+
+
+def read_sample(remote_command: str, pool: str, image: str, snapshot: str, size: int, block_size: int = 1024 * 1024, timeout: float = None) -> Sample:
+    """
+    Reads about size bytes of an image snapshot, at evenly spaced offsets, on the proxmox node, see rbd_sample.py.
+
+    :param remote_command: command to run a command on the proxmox node, i.e. "ssh root@host"
+    :param timeout: seconds, see get_command_timeout_from_config
+    :raises CommandError: if sampling failed or timed out
+    """
+    argv = shlex.split(remote_command) + [remote_python_command('rbd_sample.py', pool, image, snapshot, max(1, size // block_size), block_size)]
+    log.debug(f'sample {pool}/{image}@{snapshot} for transport compression')
+    header, _, data = exec_argv_bytes(argv, timeout=timeout).partition(b'\n')
+    header = json.loads(header.decode('utf-8'))
+    return Sample(data, header.get('cpus') or 1, header.get('load') or 0.0, header.get('codecs'))
+
+
+def measure(codec: Codec, data: bytes, timeout: float = None) -> (float, float):
+    """
+    Compresses data with codec on this host. The speed of the proxmox node is not known, this host is used as estimate.
+
+    :return: (compression ratio, compression speed in bytes per second of input)
+    :raises CommandError: if the codec failed or timed out
+    """
+    started = time.monotonic()
+    compressed = exec_argv_bytes(codec.get_compress_argv(), input=data, timeout=timeout)
+    duration = max(time.monotonic() - started, 1e-6)
+    return len(data) / max(1, len(compressed)), len(data) / duration
+
+
+def select_codec(sample: Sample, candidates: [Codec], bandwidth: float, min_gain: float = 0.05, timeout: float = None) -> (Codec or None, {str: dict}):
+    """
+    Chooses the codec with the shortest estimated transfer time: a transfer is limited either by the compression speed
+    (on the available cpu of the proxmox node, the codecs use a single thread) or by the network bandwidth times the
+    compression ratio. A codec has to be at least min_gain faster than the cheaper ones before it, so the candidates
+    should be ordered from cheap to expensive.
+
+    :param bandwidth: network bandwidth in bytes per second
+    :param timeout: seconds each measurement may take, see measure
+    :return: (codec, None for no compression; {codec: {"ratio", "speed", "time"}} of the measured candidates)
+    """
+    if len(sample.data) == 0:
+        return None, {}
+    cpu_share = min(1.0, max(0.1, sample.get_idle_cpus()))
+    best, best_time = None, 1.0 / bandwidth
+    results = {'none': {'ratio': 1.0, 'speed': None, 'time': best_time}}
+    for codec in candidates:
+        if codec.name not in sample.codecs:
+            log.debug(f'{codec.name} is not installed on the proxmox node, skip')
+            continue
+        try:
+            ratio, speed = measure(codec, sample.data, timeout)
+        except FileNotFoundError:
+            log.debug(f'{codec.name} is not installed, skip')
+            continue
+        # seconds per byte of image data
+        estimate = max(1.0 / (speed * cpu_share), 1.0 / (bandwidth * ratio))
+        results[str(codec)] = {'ratio': ratio, 'speed': speed, 'time': estimate}
+        if estimate < best_time * (1 - min_gain):
+            best, best_time = codec, estimate
+    return best, results
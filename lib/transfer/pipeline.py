@@ -0,0 +1,311 @@
+import fcntl
+import os
+import select
+import shlex
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from ..helper import *
+from ..helper import Log as log
+
+# not exported by the fcntl module before python 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+
+def set_pipe_size(fd: int, size: int) -> int:
+    """
+    :return: the resulting pipe buffer size, may be smaller than requested (see /proc/sys/fs/pipe-max-size)
+    """
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        return -1
+
+
+class PipelineError(RuntimeError):
+    stage: object
+
+    def __init__(self, message: str, stage=None):
+        super().__init__(message)
+        self.stage = stage
+
+
+class Stage:
+    """
+    One process of a pipeline and the statistics of its output.
+    """
+    name: str
+    argv: [str]
+    process: subprocess.Popen or None
+    bytes: int
+    started: float or None
+    finished: float or None
+    stalled: float
+    starved: float
+    throttled: float
+    returncode: int or None
+    _stderr: deque
+
+    def __init__(self, name: str, argv: [str]):
+        self.name = name
+        self.argv = argv
+        self.process = None
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+        # time its output waited for the next stage to accept it
+        self.stalled = 0.0
+        # time the next stage waited for output of this one
+        self.starved = 0.0
+        # time waited for the bandwidth governor
+        self.throttled = 0.0
+        self.returncode = None
+        self._stderr = deque(maxlen=20)
+
+    def __str__(self):
+        return self.name
+
+    def get_duration(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished if self.finished is not None else time.monotonic()) - self.started
+
+    def get_throughput(self):
+        """
+        :return: output bytes per second
+        """
+        duration = self.get_duration()
+        return self.bytes / duration if duration > 0 else 0.0
+
+    def get_stderr(self):
+        return '\n'.join(self._stderr)
+
+    def get_command(self):
+        return ' '.join([shlex.quote(x) for x in self.argv])
+
+
+class Pipeline:
+    """
+    Runs processes connected stdout to stdin, like a shell pipeline, without a shell.
+
+    The data between two processes is forwarded by a thread, using splice (zero-copy, linux) if available, through pipes
+    with a large buffer. This gives per stage byte counts, throughput and stall times; if the pipeline fails, the
+    stage causing the failure is reported together with its stderr output.
+    """
+    name: str
+    stages: [Stage]
+    _pipe_size: int
+    _chunk_size: int
+    _use_splice: bool
+    _on_progress: object
+    _progress_stage: int
+    _governor: object
+    _failed: threading.Event
+
+    def __init__(self, name: str, stages: [(str, [str])], pipe_size: int = 1024 * 1024, on_progress=None, governor=None, progress_stage: int = -2):
+        """
+        :param stages: [(name, argv)]
+        :param on_progress: called with (stage, bytes) for every block of data passed to the last stage
+        :param progress_stage: index of the stage whose output is passed to on_progress instead, i.e. 0 for the
+                               uncompressed data of a pipeline compressing in a later stage
+        :param governor: BandwidthGovernor limiting the output of the first stage (the data received from the network)
+        """
+        if len(stages) == 0:
+            raise ArgumentError('a pipeline requires at least one stage')
+        self.name = name
+        self.stages = [Stage(name, argv) for name, argv in stages]
+        self._pipe_size = pipe_size
+        self._chunk_size = pipe_size
+        self._use_splice = hasattr(os, 'splice')
+        self._on_progress = on_progress
+        self._progress_stage = progress_stage
+        self._governor = governor
+        self._failed = threading.Event()
+
+    def _read_stderr(self, stage: Stage):
+        for line in iter(stage.process.stderr.readline, b''):
+            line = line.decode('utf-8', errors='replace').rstrip()
+            stage._stderr.append(line)
+            log.debug('%s [%s]: %s', self.name, stage, line)
+
+    @staticmethod
+    def _wait_readable(poller: select.poll, stage: Stage):
+        """
+        :param poller: registered for the fd to read; unlike select, poll is not limited to fds below FD_SETSIZE
+        """
+        started = time.monotonic()
+        poller.poll()
+        stage.starved += time.monotonic() - started
+
+    def _forward(self, stage: Stage, source: int, target: int):
+        """forwards the output of stage to the next one, until end of file"""
+        try:
+            buffer = None if self._use_splice else bytearray(self._chunk_size)
+            poller = select.poll()
+            poller.register(source, select.POLLIN)
+            while True:
+                self._wait_readable(poller, stage)
+                started = time.monotonic()
+                if self._use_splice:
+                    # source has data, so blocking here means the next stage does not keep up
+                    count = os.splice(source, target, self._chunk_size)
+                else:
+                    count = os.readv(source, [buffer])
+                    view = memoryview(buffer)[:count]
+                    while len(view) > 0:
+                        view = view[os.write(target, view):]
+                stage.stalled += time.monotonic() - started
+                if count == 0:
+                    break
+                stage.bytes += count
+                if self._governor and stage is self.stages[0]:
+                    started = time.monotonic()
+                    self._governor.consume(count)
+                    stage.throttled += time.monotonic() - started
+                if self._on_progress and stage is self.stages[self._progress_stage]:
+                    self._on_progress(stage, count)
+        except OSError as error:
+            # i.e. broken pipe, if the next stage died; reported by its exit code
+            log.debug(f'{self.name} [{stage}]: forwarding stopped: {error}')
+            self._failed.set()
+        finally:
+            os.close(source)
+            os.close(target)
+
+    def _start(self) -> [threading.Thread]:
+        threads = []
+        previous_output = None
+        for index, stage in enumerate(self.stages):
+            is_last = index == len(self.stages) - 1
+            if not is_last:
+                output, stage_stdout = os.pipe()
+                set_pipe_size(stage_stdout, self._pipe_size)
+            else:
+                output, stage_stdout = None, subprocess.DEVNULL
+            stage_stdin = subprocess.DEVNULL
+            if previous_output is not None:
+                stage_stdin, input_writer = os.pipe()
+                set_pipe_size(input_writer, self._pipe_size)
+            log.debug(f'{self.name} [{stage}]: exec command \'{stage.get_command()}\'')
+            stage.started = time.monotonic()
+            try:
+                stage.process = subprocess.Popen(stage.argv, stdin=stage_stdin, stdout=stage_stdout, stderr=subprocess.PIPE)
+            except Exception:
+                for started in self.stages[:index]:
+                    started.process.kill()
+                    started.process.wait()
+                raise
+            finally:
+                # the child holds its own copies
+                if previous_output is not None:
+                    os.close(stage_stdin)
+                if not is_last:
+                    os.close(stage_stdout)
+            threads.append(threading.Thread(target=self._read_stderr, args=(stage,), name=f'pipeline-{stage}-stderr', daemon=True))
+            if previous_output is not None:
+                threads.append(threading.Thread(target=self._forward, args=(self.stages[index - 1], previous_output, input_writer), name=f'pipeline-{stage}-input', daemon=True))
+            previous_output = output
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _get_failed_stage(self) -> Stage or None:
+        """
+        :return: the stage which failed first, stages dying of a broken pipe only follow a failure further down
+        """
+        failed = [x for x in self.stages if x.returncode not in (0, None)]
+        if not failed:
+            return None
+        causes = [x for x in failed if x.returncode not in (-signal.SIGPIPE, -signal.SIGTERM, 128 + signal.SIGPIPE)]
+        return min(causes if causes else failed, key=lambda x: x.finished)
+
+    def run(self, timeout: float = None) -> [Stage]:
+        """
+        :raises PipelineError: if any stage exited with a non-zero exit code
+        :return: the stages with their statistics
+        """
+        started = time.monotonic()
+        threads = self._start()
+        try:
+            while any([x.returncode is None for x in self.stages]):
+                for stage in self.stages:
+                    if stage.returncode is None and stage.process.poll() is not None:
+                        stage.returncode = stage.process.returncode
+                        stage.finished = time.monotonic()
+                        if stage.returncode != 0:
+                            self._failed.set()
+                if self._failed.is_set() or (timeout is not None and time.monotonic() - started > timeout):
+                    break
+                time.sleep(0.05)
+        finally:
+            self._terminate()
+        for thread in threads:
+            thread.join(5)
+
+        failed = self._get_failed_stage()
+        if failed:
+            stderr = failed.get_stderr()
+            raise PipelineError(f'{self.name}: stage {failed} failed with code {failed.returncode}: {failed.get_command()}' + (f'\n{stderr}' if stderr else ''), failed)
+        if any([x.returncode is None for x in self.stages]):
+            raise PipelineError(f'{self.name}: timed out after {timeout} seconds')
+        return self.stages
+
+    def _terminate(self):
+        # give the other stages a moment to exit on their own (they get end of file / broken pipe)
+        deadline = time.monotonic() + (2 if self._failed.is_set() else 0)
+        for stage in self.stages:
+            if stage.returncode is not None:
+                continue
+            try:
+                stage.process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                stage.process.terminate()
+                stage.process.wait()
+            stage.returncode = stage.process.returncode
+            stage.finished = time.monotonic()
+
+    def get_summary(self):
+        return ', '.join([f'{x}: {sizeof_fmt(x.bytes)} in {x.get_duration():.1f}s ({sizeof_fmt(x.get_throughput())}/s, stalled {x.stalled:.1f}s, starved {x.starved:.1f}s'
+                          f'{f", throttled {x.throttled:.1f}s" if x.throttled else ""})'
+                          for x in self.stages[:-1]])
+
+
+class ProgressLog:
+    """
+    on_progress callback for Pipeline, logs the bytes passed to the last stage every interval seconds (like pv does).
+    """
+    name: str
+    total: int or None
+    bytes: int
+    _interval: float
+    _started: float
+    _last_logged: float
+    _lock: threading.Lock
+
+    def __init__(self, name: str, total: int = None, interval: float = 30):
+        """
+        :param total: expected bytes, to estimate the remaining time
+        """
+        self.name = name
+        self.total = total
+        self.bytes = 0
+        self._interval = interval
+        self._started = time.monotonic()
+        self._last_logged = self._started
+        self._lock = threading.Lock()
+
+    def __call__(self, stage: Stage, count: int):
+        with self._lock:
+            self.bytes += count
+            now = time.monotonic()
+            if now - self._last_logged < self._interval:
+                return
+            self._last_logged = now
+        rate = self.bytes / (now - self._started)
+        message = f'{self.name}: {sizeof_fmt(self.bytes)} ({sizeof_fmt(rate)}/s)'
+        if self.total and rate > 0:
+            message += f', {min(100.0, self.bytes * 100 / self.total):.1f}%, eta {timedelta(seconds=int(max(0, self.total - self.bytes) / rate))}'
+        log.info(message)
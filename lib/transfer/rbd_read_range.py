@@ -0,0 +1,67 @@
+"""
+Executed on a proxmox node (see remote_python_command), requires the python3-rados / python3-rbd bindings there.
+
+Reads the byte range [start, end) of an image snapshot and writes it to stdout as rbd diff v1 stream, which can be
+applied with "rbd import-diff". Only the allocated extents are read (using the object map, if the fast-diff feature is
+enabled), blocks containing only zeros are skipped, the target image reads them as zeros anyway.
+
+usage: rbd_read_range.py pool image snapshot start end [block_size]
+"""
+import struct
+import sys
+
+import rados
+import rbd
+
+
+def get_allocated_extents(source, start: int, end: int) -> [(int, int)]:
+    """
+    :return: [(offset, length)] of the allocated extents within [start, end), adjacent ones merged
+    """
+    extents = []
+
+    def add(offset, length, exists):
+        if not exists:
+            return
+        offset, length = max(offset, start), min(offset + length, end) - max(offset, start)
+        if length <= 0:
+            return
+        if extents and extents[-1][0] + extents[-1][1] == offset:
+            extents[-1] = (extents[-1][0], extents[-1][1] + length)
+        else:
+            extents.append((offset, length))
+
+    source.diff_iterate(start, end - start, None, add, include_parent=True, whole_object=True)
+    return extents
+
+
+def main(pool: str, image: str, snapshot: str, start: int, end: int, block_size: int = 4 * 1024 * 1024):
+    out = sys.stdout.buffer
+    zeros = bytes(block_size)
+    cluster = rados.Rados(conffile='/etc/ceph/ceph.conf')
+    cluster.connect()
+    try:
+        with cluster.open_ioctx(pool) as ioctx:
+            with rbd.Image(ioctx, image, snapshot=snapshot, read_only=True) as source:
+                size = source.size()
+                end = min(end, size)
+                out.write(b'rbd diff v1\n')
+                out.write(b's' + struct.pack('<Q', size))
+                extents = get_allocated_extents(source, start, end) if start < end else []
+                for extent_offset, extent_length in extents:
+                    offset, extent_end = extent_offset, extent_offset + extent_length
+                    while offset < extent_end:
+                        length = min(block_size, extent_end - offset)
+                        data = source.read(offset, length, rados.LIBRADOS_OP_FLAG_FADVISE_SEQUENTIAL)
+                        if data != zeros[:length]:
+                            out.write(b'w' + struct.pack('<QQ', offset, length))
+                            out.write(data)
+                        offset += length
+                out.write(b'e')
+                out.flush()
+    finally:
+        cluster.shutdown()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]), *[int(x) for x in sys.argv[6:7]])
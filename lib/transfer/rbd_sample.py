@@ -0,0 +1,45 @@
+"""
+Executed on a proxmox node (see remote_python_command), requires the python3-rados / python3-rbd bindings there.
+
+Writes a json line describing the node ({"size": image_size, "cpus": n, "load": 1min_load_average, "codecs": [...]})
+followed by count blocks of block_size bytes, read at evenly spaced offsets of an image snapshot, to stdout. This is
+the sample used to choose the transport compression, see lib.transfer.compression.
+
+usage: rbd_sample.py pool image snapshot count [block_size]
+"""
+import json
+import os
+import shutil
+import sys
+
+import rados
+import rbd
+
+
+def main(pool: str, image: str, snapshot: str, count: int, block_size: int = 1024 * 1024):
+    out = sys.stdout.buffer
+    cluster = rados.Rados(conffile='/etc/ceph/ceph.conf')
+    cluster.connect()
+    try:
+        with cluster.open_ioctx(pool) as ioctx:
+            with rbd.Image(ioctx, image, snapshot=snapshot, read_only=True) as source:
+                size = source.size()
+                header = {
+                    'size': size,
+                    'cpus': os.cpu_count(),
+                    'load': os.getloadavg()[0],
+                    'codecs': [x for x in ['lz4', 'zstd'] if shutil.which(x)]
+                }
+                out.write(json.dumps(header).encode('utf-8') + b'\n')
+                count = max(1, min(count, size // block_size))
+                step = (size // count) // block_size * block_size
+                for index in range(count):
+                    offset = index * step
+                    out.write(source.read(offset, min(block_size, size - offset)))
+                out.flush()
+    finally:
+        cluster.shutdown()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4]), *[int(x) for x in sys.argv[5:6]])
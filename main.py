@@ -2,6 +2,7 @@
 
 import configparser
 import os.path
+import signal
 import argparse
 import argcomplete
 import traceback
@@ -9,8 +10,10 @@ import traceback
 from lib.backup import Backup
 from lib.helper import *
 from lib.helper import Log as log
+from lib import metrics, tracing
 from tabulate import tabulate
-from lib.proxmox import VM
+from lib.proxmox import VM, VmFilter
+from lib.restore import Restore
 from lib.restore_point import RestorePoint
 
 parser = argparse.ArgumentParser(description='Manage and perform backup / restore of ceph rbd enabled proxmox vms')
@@ -29,6 +32,9 @@ parser_backup_run.add_argument('--vm_uuid', action='store', nargs='*', help='per
 parser_backup_run.add_argument('--vm_id', action='store', nargs='*', help='perform backup of this vm(s)')
 parser_backup_run.add_argument('--vm_name', action='store', help='perform backup of this vm(s) (regex)')
 parser_backup_run.add_argument('--snapshot_name_prefix', action='store', help='override "snapshot_name_prefix" from config')
+parser_backup_run.add_argument('--profile', action='store_true', help='print where the wall time of the run went (per phase) at the end')
+parser_backup_run.add_argument('--trace', action='store', metavar='FILE', help='write a trace of the run to FILE')
+parser_backup_run.add_argument('--trace-format', action='store', choices=['chrome', 'otlp'], default='chrome', help='chrome (chrome://tracing, Perfetto) or otlp (OTLP JSON), default: chrome')
 parser_backup_run.add_argument('--allow_using_any_existing_snapshot', action='store_true', help='use the latest existing snapshot, instead of one that matches the snapshot_name_prefix. This implies that the existing found snapshot will not be removed after backup completion, if it does not match snapshot_name_prefix.This option is mostly used for adding a new backup interval to an existing backup (only the first backup of that interval needs this option) or for manual / temporary / development backups.')
 
 # backup remove
@@ -50,6 +56,7 @@ parser_restore_point_list.add_argument('vm-uuid', action='store')
 parser_restore_point_info = subparsers_restore_point.add_parser('info', help='get details of a restore point')
 parser_restore_point_info.add_argument('vm-uuid', action='store')
 parser_restore_point_info.add_argument('restore-point', action='store')
+parser_restore_point_info.add_argument('--show-config', action='store_true', help='print the vm config saved with the restore point')
 
 # restore-point remove
 parser_restore_point_remove = subparsers_restore_point.add_parser('remove', aliases=['rm'], help='remove a restore point from a vm and all associated disks')
@@ -58,6 +65,47 @@ parser_restore_point_remove.add_argument('--restore-point', action='store', narg
 parser_restore_point_remove.add_argument('--age', action='store', help='timespan, i.e.: 15m, 3h, 7d, 3M, 1y')
 parser_restore_point_remove.add_argument('--match', action='store', help='restore point name matches regex')
 
+# restore-point prune
+parser_restore_point_prune = subparsers_restore_point.add_parser('prune', help='remove restore points according to the retention policies (retention_keep_* in config)')
+parser_restore_point_prune.add_argument('--vm-uuid', action='store', help='only prune restore points of this vm')
+parser_restore_point_prune.add_argument('--age', action='store', help='only prune restore points older than this timespan, i.e.: 15m, 3h, 7d, 3M, 1y')
+parser_restore_point_prune.add_argument('--match', action='store', help='only consider restore points whose name matches regex')
+parser_restore_point_prune.add_argument('--dry-run', action='store_true', help='only list the restore points to remove and the space they use')
+
+# restore
+parser_restore = subparsers.add_parser('restore', help='restore vms from restore points')
+subparsers_restore = parser_restore.add_subparsers(dest='action_restore', required=True)
+
+# restore run
+parser_restore_run = subparsers_restore.add_parser('run', help='restore the disks & config of a vm, the vm must be stopped; it is created if it does not exist')
+parser_restore_run.add_argument('vm-uuid', action='store')
+parser_restore_run.add_argument('restore-point', action='store')
+parser_restore_run.add_argument('--node', action='store', help='proxmox node to create the vm on, if it does not exist anymore; default: the first one')
+parser_restore_run.add_argument('--skip-config', action='store_true', help='only restore the disks, keep the current vm config')
+
+# restore instant
+parser_restore_instant = subparsers_restore.add_parser('instant', help='like run, but the vm can be started right away, its disks are copied from the backup cluster in the background by "restore complete"')
+parser_restore_instant.add_argument('vm-uuid', action='store')
+parser_restore_instant.add_argument('restore-point', action='store')
+parser_restore_instant.add_argument('--node', action='store', help='proxmox node to create the vm on, if it does not exist anymore; default: the first one')
+parser_restore_instant.add_argument('--skip-config', action='store_true', help='only restore the disks, keep the current vm config')
+
+# restore status
+parser_restore_status = subparsers_restore.add_parser('status', help='list the pending instant restores')
+parser_restore_status.add_argument('--vm-uuid', action='store', help='only those of this vm')
+
+# restore complete
+parser_restore_complete = subparsers_restore.add_parser('complete', help='copy the remaining data of the disks of an instant restore and release the backup snapshots')
+parser_restore_complete.add_argument('vm-uuid', action='store')
+
+# catalog
+parser_catalog = subparsers.add_parser('catalog', help='manage the local catalog of backups & restore points')
+subparsers_catalog = parser_catalog.add_subparsers(dest='action_catalog', required=True)
+
+# catalog resync
+parser_catalog_resync = subparsers_catalog.add_parser('resync', help='update the catalog from the backup pool, i.e. after changes made without this tool')
+parser_catalog_resync.add_argument('--full', action='store_true', help='rebuild the catalog completely, instead of only reading changed images')
+
 argcomplete.autocomplete(parser)
 args = parser.parse_args()
 
@@ -72,6 +120,9 @@ if is_list_empty(servers):
     raise RuntimeError('no servers found in config')
 
 log.set_loglevel(map_loglevel(config['global']['log_level']))
+log.set_buffer(config['global'].getint('log_buffer_lines', fallback=10000), map_loglevel(config['global'].get('log_buffer_level', fallback='debug')))
+if config['global'].get('log_file', fallback=''):
+    log.open_file(config['global']['log_file'], map_loglevel(config['global'].get('log_file_level', fallback='info')))
 log.debug(f'CLI args: {vars(args)}')
 
 try:
@@ -82,10 +133,10 @@ try:
                 print('There is already an instance running, abort', file=sys.stderr, flush=True)
                 exit(1)
 
-            backup.init_proxmox()
-            vms_uuid = args.vm_uuid
-            vms_id = args.vm_id
-            vm_name_match = args.vm_name
+            if args.profile or args.trace:
+                tracing.TRACER.enable()
+            vm_filter = VmFilter(ids=args.vm_id, uuids=args.vm_uuid, name_match=args.vm_name)
+            backup.init_proxmox(vm_filter)
             snapshot_name_prefix = args.snapshot_name_prefix
             allow_using_any_existing_snapshot = args.allow_using_any_existing_snapshot
 
@@ -94,42 +145,39 @@ try:
             else:
                 backup.set_snapshot_name_prefix(config['global']['snapshot_name_prefix'])
 
+            # kill -HUP <pid> re-reads transfer_bandwidth_limit, i.e. to throttle a run that reaches into business hours
+            def reload_bandwidth_limit(signum, frame):
+                reloaded = configparser.ConfigParser()
+                reloaded.read('config/global.ini')
+                backup.set_bandwidth_limit(reloaded['global'].get('transfer_bandwidth_limit', '0'))
+            signal.signal(signal.SIGHUP, reload_bandwidth_limit)
+
+            if config['global'].getint('metrics_port', fallback=0):
+                metrics.REGISTRY.start_http_server(config['global'].getint('metrics_port'), config['global'].get('metrics_address', ''))
+
             lock_file = open('/tmp/proxmox-rbd-backup.lock', 'w')
             lock_file.write(str(os.getpid()))
             lock_file.close()
 
-            if not vms_uuid and not vm_name_match and not vms_id:
-                backup.run_backup(allow_using_any_existing_snapshot=allow_using_any_existing_snapshot)
-                os.remove('/tmp/proxmox-rbd-backup.lock')
-                exit(0)
-
-            existing_vms = backup.get_vms_proxmox()
-            tmp_vms = []
-
-            if vms_uuid and len(vms_uuid) > 0:
-                for vm_uuid in vms_uuid:
-                    for vm in existing_vms:
-                        if vm.uuid == vm_uuid:
-                            tmp_vms.append(vm)
-                            break
-
-            if vms_id and len(vms_id) > 0:
-                for vm_id in vms_id:
-                    for vm in existing_vms:
-                        if vm.id == vm_id:
-                            tmp_vms.append(vm)
-                            break
-
-            if vm_name_match:
-                for vm_name in map(lambda x: x.name, existing_vms):
-                    if re.match(vm_name_match, vm_name):
-                        for vm in existing_vms:
-                            if vm.name == vm_name:
-                                tmp_vms.append(vm)
-                            break
-
-            tmp_vms = unique_list(tmp_vms)
-            backup.run_backup(tmp_vms, allow_using_any_existing_snapshot=allow_using_any_existing_snapshot)
+            try:
+                # only vm's matching the filter have been discovered
+                tmp_vms = unique_list(backup.get_vms_proxmox())
+                if vm_filter.is_empty() or len(tmp_vms) > 0:
+                    backup.run_backup(tmp_vms, allow_using_any_existing_snapshot=allow_using_any_existing_snapshot)
+            finally:
+                if args.trace:
+                    if args.trace_format == 'otlp':
+                        tracing.TRACER.export_otlp(args.trace)
+                    else:
+                        tracing.TRACER.export_chrome(args.trace)
+                    log.info(f'trace written to {args.trace}')
+                if args.profile:
+                    profile = tracing.TRACER.get_profile()
+                    for phase in profile:
+                        for key in ['Total', 'Self', 'Max']:
+                            phase[key] = f'{phase[key]:.2f}s'
+                        phase['Share'] = f'{phase["Share"]:.1f}%'
+                    print(tabulate(profile, headers='keys', colalign=['left'] + ['right'] * 6))
             os.remove('/tmp/proxmox-rbd-backup.lock')
         if re.match(r'^(list|ls)$', args.action_backup):
             tmp_vms = []
@@ -225,6 +273,10 @@ try:
                 })
             print('Images:')
             print(tabulate(tmp_points, headers='keys'))
+            if args.show_config:
+                point_config = restore_point.get_restore_point_config(arg_uuid, arg_restore_point)
+                print(f'\nConfig ({point_config["config_file"]}):')
+                print(point_config['config'])
         if re.match(r'^(remove|rm)$', args.action_restore_point):
             vm_uuid = args.vm_uuid
             restore_point_names = args.restore_point
@@ -239,6 +291,78 @@ try:
                     restore_point.remove_restore_point(vm_uuid, restore_point_name, age, match, backup=backup)
             else:
                 restore_point.remove_restore_point(vm_uuid, age=age, match=match, backup=backup)
+        if args.action_restore_point == 'prune':
+            backup = None
+            if not args.dry_run:
+                backup = Backup(servers, config)
+                backup.init_proxmox()
+            result = restore_point.prune(args.vm_uuid, args.age, args.match, dry_run=args.dry_run, backup=backup)
+            tmp_points = []
+            total = 0
+            for vm_uuid, names in sorted(result['points'].items()):
+                for name in names:
+                    point = {
+                        'VM UUID': vm_uuid,
+                        'Restore point': name
+                    }
+                    if args.dry_run:
+                        size = sum([x.get(name, 0) for image, x in result['reclaimable'].items() if image.startswith(vm_uuid)])
+                        total += size
+                        point['Reclaimable'] = sizeof_fmt(size)
+                    tmp_points.append(point)
+            print(tabulate(tmp_points, headers='keys'))
+            if args.dry_run:
+                print(f'\n{len(tmp_points)} restore points would be removed, reclaimable: {sizeof_fmt(total)} (upper bound)')
+
+    if args.action == 'restore':
+        restore = Restore(servers, config)
+        if args.action_restore in ['run', 'instant', 'complete']:
+            if os.path.isfile('/tmp/proxmox-rbd-backup.lock'):
+                print('There is already an instance running, abort', file=sys.stderr, flush=True)
+                exit(1)
+            lock_file = open('/tmp/proxmox-rbd-backup.lock', 'w')
+            lock_file.write(str(os.getpid()))
+            lock_file.close()
+            try:
+                if args.action_restore == 'run':
+                    results = restore.run(getattr(args, 'vm-uuid'), getattr(args, 'restore-point'), args.node, args.skip_config)
+                elif args.action_restore == 'instant':
+                    restore.run_instant(getattr(args, 'vm-uuid'), getattr(args, 'restore-point'), args.node, args.skip_config)
+                else:
+                    results = restore.complete_instant_restore(getattr(args, 'vm-uuid'))
+            finally:
+                os.remove('/tmp/proxmox-rbd-backup.lock')
+        if args.action_restore in ['instant', 'status']:
+            tmp_restores = []
+            for pending in restore.get_instant_restores(args.vm_uuid if args.action_restore == 'status' else getattr(args, 'vm-uuid')):
+                tmp_restores.append({
+                    'VM UUID': pending['vm_uuid'],
+                    'Restore point': pending['restore_point'],
+                    'Disk': pending['target'],
+                    'State': pending['state'],
+                    'Copied': f'{sizeof_fmt(pending["used"])} of {sizeof_fmt(pending["size"])}' if pending['used'] is not None else ''
+                })
+            print(tabulate(tmp_restores, headers='keys'))
+        if args.action_restore == 'complete':
+            print(tabulate([{'Disk': x.item['target'], 'Backup image': x.item['image'], 'Duration': x.get_duration()} for x in results], headers='keys'))
+        if args.action_restore == 'run':
+            tmp_disks = []
+            for result in results:
+                stats = result.item.stats
+                tmp_disks.append({
+                    'Disk': str(result.item),
+                    'Backup image': result.item.backup_image,
+                    'Duration': result.get_duration(),
+                    'Written': sizeof_fmt(stats.written),
+                    'Transferred': sizeof_fmt(stats.received) + (f' ({stats.codec})' if stats.codec else '')
+                })
+            print(tabulate(tmp_disks, headers='keys'))
+
+    if args.action == 'catalog':
+        if args.action_catalog == 'resync':
+            backup = Backup(servers, config)
+            stats = backup.resync_catalog(full=args.full)
+            print(tabulate([{'Added': stats['added'], 'Updated': stats['updated'], 'Removed': stats['removed']}], headers='keys'))
 
 except KeyboardInterrupt:
     log.warn('Interrupt, terminating...')
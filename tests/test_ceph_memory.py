@@ -0,0 +1,90 @@
+"""
+Ceph on top of the in-memory backend, see lib.ceph.memory.
+"""
+import unittest
+from lib.ceph import Ceph, create_backend
+
+POOL = 'backup'
+
+
+class CephMemoryTest(unittest.TestCase):
+    ceph: Ceph
+
+    def setUp(self):
+        self.ceph = Ceph(create_backend('memory'))
+        self.ceph.create_rbd_image(POOL, 'disk', '4M')
+
+    def test_create_image(self):
+        self.assertTrue(self.ceph.is_rbd_image_existing(POOL, 'disk'))
+        self.assertFalse(self.ceph.is_rbd_image_existing(POOL, 'other'))
+        self.assertEqual(['disk'], self.ceph.get_rbd_images(POOL))
+        self.assertEqual(4 * 1024 ** 2, self.ceph.get_rbd_image_info(POOL, 'disk')['size'])
+
+    def test_snapshots(self):
+        self.assertEqual('first', self.ceph.create_rbd_snapshot(POOL, 'disk', new_snapshot_name='first'))
+        name = self.ceph.create_rbd_snapshot(POOL, 'disk', snapshot_prefix='backup_')
+        self.assertRegex(name, r'^backup_[0-9a-f]{16}$')
+        self.assertEqual(['first', name], self.ceph.get_rbd_snapshot_names(POOL, 'disk'))
+        self.assertEqual([name], [x['name'] for x in self.ceph.get_rbd_snapshots_by_prefix(POOL, 'disk', 'backup_')])
+        self.assertEqual('first', self.ceph.get_rbd_snapshot(POOL, 'disk', 'first')['name'])
+        self.assertIsNone(self.ceph.get_rbd_snapshot(POOL, 'disk', 'missing'))
+
+        self.ceph.remove_rbd_snapshot(POOL, 'disk', 'first')
+        self.assertEqual([name], self.ceph.get_rbd_snapshot_names(POOL, 'disk'))
+        with self.assertRaises(RuntimeError):
+            self.ceph.remove_rbd_snapshot(POOL, 'disk', 'first')
+
+        self.ceph.remove_rbd_snapshot_all(POOL, 'disk')
+        self.assertEqual([], self.ceph.get_rbd_snapshot_names(POOL, 'disk'))
+
+    def test_protected_snapshot(self):
+        self.ceph.create_rbd_snapshot(POOL, 'disk', new_snapshot_name='first')
+        self.ceph.protect_rbd_snapshot(POOL, 'disk', 'first')
+        with self.assertRaises(RuntimeError):
+            self.ceph.remove_rbd_snapshot(POOL, 'disk', 'first')
+        self.ceph.unprotect_rbd_snapshot(POOL, 'disk', 'first')
+        self.ceph.remove_rbd_snapshot(POOL, 'disk', 'first')
+        self.assertEqual([], self.ceph.get_rbd_snapshot_names(POOL, 'disk'))
+
+    def test_remove_image(self):
+        self.ceph.create_rbd_snapshot(POOL, 'disk', new_snapshot_name='first')
+        with self.assertRaises(RuntimeError):
+            self.ceph.remove_rbd_image(POOL, 'disk')
+        self.ceph.remove_rbd_snapshot(POOL, 'disk', 'first')
+        self.ceph.remove_rbd_image(POOL, 'disk')
+        self.assertFalse(self.ceph.is_rbd_image_existing(POOL, 'disk'))
+
+    def test_image_meta_batch(self):
+        self.ceph.create_rbd_image(POOL, 'other', '1M')
+        self.assertEqual({'disk': {}, 'other': {}}, self.ceph.list_rbd_image_meta_batch(POOL, ['disk', 'other']))
+        self.assertEqual({}, self.ceph.list_rbd_image_meta_batch(POOL, []))
+
+        self.ceph.set_rbd_image_meta_batch(POOL, {'disk': {'a': '1', 'b': '2'}, 'other': {'a': '3'}})
+        self.ceph.set_rbd_image_meta_batch(POOL, {'disk': {'b': '4'}})
+        self.assertEqual({'disk': {'a': '1', 'b': '4'}, 'other': {'a': '3'}}, self.ceph.list_rbd_image_meta_batch(POOL, ['disk', 'other']))
+        self.assertEqual('4', self.ceph.get_rbd_image_meta(POOL, 'disk', 'b'))
+
+        self.ceph.remove_rbd_image_meta(POOL, 'other', 'a')
+        self.assertIsNone(self.ceph.list_rbd_image_meta(POOL, 'other'))
+
+    def test_read_write(self):
+        self.ceph.write_rbd_image(POOL, 'disk', b'hello', offset=1024)
+        self.assertEqual(b'hello', self.ceph.read_rbd_image(POOL, 'disk', 5, offset=1024))
+        # never written data reads as zeros, like a sparse rbd image
+        self.assertEqual(bytes(4), self.ceph.read_rbd_image(POOL, 'disk', 4))
+        self.assertEqual(bytes(4), self.ceph.read_rbd_image(POOL, 'disk', 4, offset=2048))
+        with self.assertRaises(RuntimeError):
+            self.ceph.write_rbd_image(POOL, 'disk', b'x', offset=4 * 1024 ** 2)
+
+    def test_read_snapshot(self):
+        self.ceph.write_rbd_image(POOL, 'disk', b'old')
+        self.ceph.create_rbd_snapshot(POOL, 'disk', new_snapshot_name='first')
+        self.ceph.write_rbd_image(POOL, 'disk', b'new')
+        self.assertEqual(b'new', self.ceph.read_rbd_image(POOL, 'disk', 3))
+        self.assertEqual(b'old', self.ceph.read_rbd_image(POOL, 'disk', 3, snapshot='first'))
+        with self.assertRaises(RuntimeError):
+            self.ceph.read_rbd_image(POOL, 'disk', 3, snapshot='missing')
+
+
+if __name__ == '__main__':
+    unittest.main()